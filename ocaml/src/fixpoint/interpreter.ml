@@ -678,6 +678,7 @@ struct
             | None -> ()
             end;
             Log.latest_finished_address := Some v.Cfa.State.ip;  (* v.Cfa.State.ip can change because of calls and jumps *)
+            Log.progress (fun () -> Vertices.cardinal !waiting);
 
           with
           | Exceptions.Too_many_concrete_elements _ as e -> L.exc e (fun p -> p "imprecision here"); dump g; L.abort (fun p -> p "analysis stopped (computed value too much imprecise)")
@@ -57,6 +57,34 @@ let current_address = ref None
 (** store the latest analysed address *)
 let latest_finished_address = ref None
 
+(** number of states processed by the forward fixpoint iteration *)
+let processed_nodes = ref 0
+
+(** date of the latest progress record *)
+let latest_progress = ref 0.
+
+(** minimal delay between two progress records, in seconds *)
+let progress_period = 1.
+
+(** count a processed state and dump a progress record if the previous one is
+    older than progress_period. waiting returns the number of states that
+    still have to be processed; it is only evaluated when a record is dumped *)
+let progress waiting =
+  processed_nodes := !processed_nodes + 1;
+  let now = Unix.gettimeofday () in
+  if now -. !latest_progress >= progress_period then
+    begin
+      latest_progress := now;
+      let adrs =
+        match !current_address with
+        | None -> "?"
+        | Some a -> Data.Address.to_string a
+      in
+      Printf.fprintf !logfid "[PROGRESS] address=%s processed=%d waiting=%d\n"
+        adrs !processed_nodes (waiting ());
+      flush !logfid
+    end
+
 
 module Make(Modname: sig val name : string end) = struct
   let modname = Modname.name
@@ -18,8 +18,10 @@
 from __future__ import absolute_import
 import ctypes
 import collections
+import copy
 import functools
 import glob
+import marshal
 import os
 import os.path
 import sys
@@ -31,6 +33,7 @@ import idaapi
 import idautils
 import ida_segment
 import idabincat.netnode
+import idabincat.npkgen
 from idabincat.plugin_options import PluginOptions
 
 # Logging
@@ -240,6 +243,30 @@ class ConfigHelpers(object):
             idaapi.enum_import_names(i, imp_cb)
         return imports
 
+    @staticmethod
+    def get_headers_filenames(libdir):
+        """
+        list all files in libdir/*.{c,no}.
+        for each lib (same base filename) keep .no if it exists, else .c
+        """
+        headers_filenames = glob.glob(os.path.join(libdir, '*.no'))
+        # Add .c if there is no associated .no
+        for c in glob.glob(os.path.join(libdir, '*.c')):
+            if c[:-2] + '.no' not in headers_filenames:
+                headers_filenames.append(c)
+        return headers_filenames
+
+    @staticmethod
+    def read_file(path):
+        """
+        Returns the contents of path, or None if it cannot be read
+        """
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
     @staticmethod
     def register_size(arch, reg):
         if arch == 'x86':
@@ -319,6 +346,183 @@ class ConfigHelpers(object):
                 return "armv8"
 
 
+class IDBMetadataCache(object):
+    """
+    Caches data that is used to generate default configurations:
+    * imports and sections, extracted from the IDB and persisted in it
+    * C headers describing the IDB's types, used to generate TNPK files
+    * file type, calling convention, stack width and memory model
+    * configuration files and headers list, until they are modified
+
+    Data extracted from the IDB is invalidated by MetadataHooks, and when
+    the number of import modules changes.
+    """
+    #: version of the data stored in the IDB
+    VERSION = 2
+
+    def __init__(self, netnode=None):
+        if netnode is None:
+            netnode = idabincat.netnode.Netnode()
+        self._netnode = netnode
+        #: (imports, sections), see ConfigHelpers
+        self._idb_data = None
+        #: number of import modules when _idb_data was extracted
+        self._idb_nimps = None
+        #: False if data may be cached in memory or in the IDB
+        self._invalidated = False
+        #: name -> value, for ConfigHelpers functions that take no argument
+        self._globals = {}
+        #: headers generated by NpkGen.get_header_data
+        self._header_data = None
+        #: True while headers are generated: NpkGen imports types, which
+        #: triggers MetadataHooks
+        self._generating = False
+        #: path -> (mtime, value) for data read from the config directory
+        self._file_data = {}
+
+    def invalidate(self):
+        """
+        Forget all data extracted from the IDB. Cheap if nothing has been
+        cached since the last call, as it is called on frequent IDB events.
+        """
+        if self._invalidated or self._generating:
+            return
+        self._idb_data = None
+        self._globals = {}
+        self._header_data = None
+        if "config_metadata" in self._netnode:
+            del self._netnode["config_metadata"]
+        self._invalidated = True
+
+    def _load_idb_data(self):
+        nimps = idaapi.get_import_module_qty()
+        if self._idb_data is not None and self._idb_nimps == nimps:
+            return self._idb_data
+        self._invalidated = False
+        self._idb_nimps = nimps
+        stored = self._netnode.get("config_metadata", None)
+        if stored is not None:
+            try:
+                version, snimps, imports, sections = marshal.loads(stored)
+                if version == self.VERSION and snimps == nimps:
+                    self._idb_data = (
+                        dict((ea, (module, name))
+                             for ea, module, name in imports),
+                        sections)
+                    return self._idb_data
+            except (ValueError, EOFError, TypeError):
+                bc_log.debug("Ignoring invalid metadata stored in IDB")
+        imports = ConfigHelpers.get_imports()
+        sections = ConfigHelpers.get_sections()
+        self._netnode.set_binary("config_metadata", marshal.dumps(
+            (self.VERSION, nimps,
+             [(ea, module, name)
+              for ea, (module, name) in imports.iteritems()],
+             sections)))
+        self._idb_data = (imports, sections)
+        return self._idb_data
+
+    def get_imports(self):
+        """
+        Same as ConfigHelpers.get_imports. The returned dict must not be
+        modified.
+        """
+        return self._load_idb_data()[0]
+
+    def get_sections(self):
+        return self._load_idb_data()[1]
+
+    def _get_global(self, func):
+        name = func.__name__
+        if name not in self._globals:
+            self._invalidated = False
+            self._globals[name] = func()
+        return self._globals[name]
+
+    def get_header_data(self):
+        """
+        Same as NpkGen.get_header_data, regenerated when types or names
+        are modified
+        """
+        if self._header_data is None:
+            self._generating = True
+            try:
+                self._header_data = \
+                    idabincat.npkgen.NpkGen().get_header_data()
+            finally:
+                self._generating = False
+            self._invalidated = False
+        return self._header_data
+
+    def get_file_type(self):
+        return self._get_global(ConfigHelpers.get_file_type)
+
+    def get_call_convention(self):
+        return self._get_global(ConfigHelpers.get_call_convention)
+
+    def get_stack_width(self):
+        return self._get_global(ConfigHelpers.get_stack_width)
+
+    def get_memory_model(self):
+        return self._get_global(ConfigHelpers.get_memory_model)
+
+    def _get_file_data(self, path, func):
+        """
+        Returns func(path), cached until the modification time of path
+        changes
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+        cached = self._file_data.get(path, None)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        value = func(path)
+        self._file_data[path] = (mtime, value)
+        return value
+
+    def get_headers_filenames(self, config_path):
+        return self._get_file_data(os.path.join(config_path, 'lib'),
+                                   ConfigHelpers.get_headers_filenames)
+
+    def read_config(self, config, path):
+        """
+        Same as config.read(path), without reading the file again if it has
+        not changed. Returns the list of successfully read files.
+        """
+        contents = self._get_file_data(path, ConfigHelpers.read_file)
+        if contents is None:
+            return []
+        config.readfp(StringIO.StringIO(contents), path)
+        return [path]
+
+
+class MetadataHooks(idaapi.IDB_Hooks):
+    """
+    Invalidates IDBMetadataCache when segments, names (ex. imports), types
+    or compiler settings are modified
+    """
+    def __init__(self, cache):
+        super(MetadataHooks, self).__init__()
+        self.cache = cache
+
+    def _invalidate(self, *args):
+        self.cache.invalidate()
+        return 0
+
+    segm_added = _invalidate
+    segm_deleted = _invalidate
+    segm_start_changed = _invalidate
+    segm_end_changed = _invalidate
+    segm_moved = _invalidate
+    allsegs_moved = _invalidate
+    renamed = _invalidate
+    ti_changed = _invalidate
+    local_types_changed = _invalidate
+    compiler_changed = _invalidate
+
+
 class InitialState(object):
     """
     Stores the initial state configuration:
@@ -593,11 +797,15 @@ class AnalyzerConfig(object):
 
     @staticmethod
     def get_default_config(analysis_start_va, analysis_stop_va,
-                           analysis_method):
+                           analysis_method, metadata=None):
         """
         Returns a new AnalyzerConfig for the given entry point, cut and
         analysis method
+
+        :param metadata: IDBMetadataCache used to get data from the IDB
         """
+        if metadata is None:
+            metadata = IDBMetadataCache()
         # this function will use the default parameters
         config = ConfigParser.RawConfigParser()
         config.optionxform = str
@@ -606,7 +814,7 @@ class AnalyzerConfig(object):
         # Load default part - XXX move this logic to PluginOptions
         configfile = os.path.join(config_path, "conf", "default.ini")
         bc_log.debug("Reading config from %s", configfile)
-        r = config.read(configfile)
+        r = metadata.read_config(config, configfile)
         if len(r) != 1:
             bc_log.warning("Default config file %s could not be found",
                            configfile)
@@ -621,18 +829,17 @@ class AnalyzerConfig(object):
         config.add_section('program')
         # IDA doesn't really support real mode
         config.set('program', 'mode', 'protected')
-        config.set('program', 'call_conv',
-                   ConfigHelpers.get_call_convention())
+        config.set('program', 'call_conv', metadata.get_call_convention())
         config.set('program', 'mem_sz',
                    ConfigHelpers.get_bitness(code_start_va))
-        config.set('program', 'op_sz', ConfigHelpers.get_stack_width())
-        config.set('program', 'stack_width', ConfigHelpers.get_stack_width())
+        config.set('program', 'op_sz', metadata.get_stack_width())
+        config.set('program', 'stack_width', metadata.get_stack_width())
 
         arch = ConfigHelpers.get_arch(analysis_start_va)
         config.set('program', 'architecture', arch)
 
         input_file = ConfigHelpers.guess_file_path()
-        ftype = ConfigHelpers.get_file_type()
+        ftype = metadata.get_file_type()
         config.set('program', 'filepath', '"%s"' % input_file.encode('utf-8'))
 
         # For now BinCAT engine only parses elf files
@@ -643,7 +850,7 @@ class AnalyzerConfig(object):
 
         # [sections section]
         config.add_section('sections')
-        for s in ConfigHelpers.get_sections():
+        for s in metadata.get_sections():
             config.set('sections', 'section[%s]' % s[0],
                        '0x%x, 0x%x, 0x%x, 0x%x' % (s[1], s[2], s[3], s[4]))
 
@@ -667,7 +874,7 @@ class AnalyzerConfig(object):
                        '; This will be overriden by values from the BinCAT '
                        'Overrides view')
 
-        imports = ConfigHelpers.get_imports()
+        imports = metadata.get_imports()
         # [import] section
         config.add_section('imports')
         for ea, imp in imports.iteritems():
@@ -676,13 +883,7 @@ class AnalyzerConfig(object):
             else:
                 name = "all,\"%s\"" % imp[1]
             config.set('imports', ("0x%x" % ea), name)
-        # list all files in config_path/lib/*.{c,no}.
-        # for each lib (same base filename) keep .no if it exists, else .c
-        headers_filenames = glob.glob(os.path.join(config_path, 'lib', '*.no'))
-        # Add .c if there is no associated .no
-        for c in glob.glob(os.path.join(config_path, 'lib', '*.c')):
-            if c[:-2] + '.no' not in headers_filenames:
-                headers_filenames.append(c)
+        headers_filenames = metadata.get_headers_filenames(config_path)
         # remove duplicates
         quoted_filenames = ['"%s"' % h for h in headers_filenames]
         config.set('analyzer', 'headers', ','.join(quoted_filenames))
@@ -696,7 +897,7 @@ class AnalyzerConfig(object):
         os_specific = os.path.join(
             config_path, "conf", "%s-%s.ini" % (os_name, arch))
         bc_log.debug("Reading OS config from %s", os_specific)
-        config.read(os_specific)
+        metadata.read_config(config, os_specific)
 
         # arch-specifig sections
         if arch == 'x86':
@@ -705,7 +906,7 @@ class AnalyzerConfig(object):
             except ConfigParser.DuplicateSectionError:
                 # already exists in (arch,OS)-specific config
                 pass
-            config.set('x86', 'mem_model', ConfigHelpers.get_memory_model())
+            config.set('x86', 'mem_model', metadata.get_memory_model())
             if analysis_method == 'backward':
                 # remove segment registers
                 for seg_reg in ('cs', 'ds', 'ss', 'es', 'fs', 'gs'):
@@ -723,19 +924,40 @@ class AnalyzerConfig(object):
 
 
 class AnalyzerConfigurations(object):
+    """
+    Named configurations and preferred configuration for each address,
+    stored in the IDB.
+
+    Each configuration is stored under its own netnode key, and only modified
+    entries are written back to the IDB.
+    """
+    #: netnode key prefix for serialized configurations
+    CONFIG_KEY_PREFIX = "analyzer_config:"
+
     def __init__(self, state):
         self._state = state
         self._netnode = idabincat.netnode.Netnode()
         #: name -> serialized AnalyzerConfig
         self._configs = {}
+        #: name -> AnalyzerConfig, parsed when first requested
+        self._parsed = {}
         #: address (int) -> name
         self._prefs = {}
+        #: names of configs that have to be written to (or removed from) the
+        #: IDB
+        self._dirty = set()
+        #: True if the list of names has to be written to the IDB
+        self._names_dirty = False
+        #: True if prefs have to be written to the IDB
+        self._prefs_dirty = False
         #: list of functions to be called prior to updating overrides
         self.pre_callbacks = []
         #: list of functions to be called after updating overrides
         self.post_callbacks = []
         #: list of sorted names - cache used by UI
         self.names_cache = []
+        #: data used to generate default configurations
+        self.metadata = IDBMetadataCache(self._netnode)
         #: list configs from IDB
         self._load_from_idb()
 
@@ -754,27 +976,69 @@ class AnalyzerConfigurations(object):
             for cb in self.pre_callbacks:
                 cb()
             f(self, *args, **kwargs)
+            self.flush()
             self.refresh_cache()
             for cb in self.post_callbacks:
                 cb()
         return wrap
 
+    def _config_key(self, name):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        return self.CONFIG_KEY_PREFIX + name
+
     def _load_from_idb(self):
-        self._configs = self._netnode.get('analyzer_configs', dict())
+        self._configs = {}
+        self._parsed = {}
+        names = self._netnode.get('analyzer_config_names', None)
+        if names is None:
+            # previous format: all configs are stored in a single entry
+            self._configs = self._netnode.get('analyzer_configs', dict())
+            if self._configs:
+                self._dirty.update(self._configs)
+                self._names_dirty = True
+        else:
+            for name in names:
+                config_str = self._netnode.get(self._config_key(name), None)
+                if config_str is not None:
+                    self._configs[name] = config_str
         self._prefs = {}
         for k, v in self._netnode.get('analyzer_prefs', dict()).items():
             self._prefs[int(k)] = v
         for k, v in list(self._prefs.items()):
             if v not in self._configs:
                 del self._prefs[k]
+                self._prefs_dirty = True
+        self.flush()
         self.refresh_cache()
 
+    def flush(self):
+        """
+        Writes modified configurations and prefs to the IDB
+        """
+        for name in self._dirty:
+            key = self._config_key(name)
+            if name in self._configs:
+                self._netnode[key] = self._configs[name]
+            elif key in self._netnode:
+                del self._netnode[key]
+        self._dirty.clear()
+        if self._names_dirty:
+            self._netnode['analyzer_config_names'] = sorted(self._configs)
+            if 'analyzer_configs' in self._netnode:
+                del self._netnode['analyzer_configs']
+            self._names_dirty = False
+        if self._prefs_dirty:
+            self._netnode['analyzer_prefs'] = self._prefs
+            self._prefs_dirty = False
+
     def new_config(self, start_va, stop_va, analysis_config):
         """
         return new configuration
         """
         return AnalyzerConfig.get_default_config(start_va, stop_va,
-                                                 analysis_config)
+                                                 analysis_config,
+                                                 self.metadata)
 
     def __getitem__(self, name_or_address):
         """
@@ -786,33 +1050,50 @@ class AnalyzerConfigurations(object):
             name = self._prefs.get(name_or_address, None)
             if not name:
                 return
-            config_str = self._configs[name]
         else:
-            config_str = self._configs.get(name_or_address, None)
-        return AnalyzerConfig.load_from_str(config_str)
+            name = name_or_address
+        if name not in self._configs:
+            return
+        config = self._parsed.get(name, None)
+        if config is None:
+            config = AnalyzerConfig.load_from_str(self._configs[name])
+            self._parsed[name] = config
+        # callers may modify the returned config
+        return copy.deepcopy(config)
 
     def set_pref(self, address, name):
+        if self._prefs.get(address, None) == name:
+            return
         self._prefs[address] = name
-        self._netnode['analyzer_prefs'] = self._prefs
+        self._prefs_dirty = True
+        self.flush()
 
     def get_pref(self, address):
         return self._prefs.get(address, None)
 
     @_callback_wrap
     def __setitem__(self, name, config):
-        self._configs[name] = str(config)
-        self._netnode['analyzer_configs'] = self._configs
+        config_str = str(config)
+        if self._configs.get(name, None) == config_str:
+            return
+        if name not in self._configs:
+            self._names_dirty = True
+        self._configs[name] = config_str
+        self._parsed.pop(name, None)
+        self._dirty.add(name)
 
     @_callback_wrap
     def __delitem__(self, name):
         if name not in self._configs:
             return
         del self._configs[name]
+        self._parsed.pop(name, None)
+        self._dirty.add(name)
+        self._names_dirty = True
         for k, v in list(self._prefs.items()):
             if v == name:
                 del self._prefs[k]
-        self._netnode['analyzer_configs'] = self._configs
-        self._netnode['analyzer_prefs'] = self._prefs
+                self._prefs_dirty = True
 
     def __len__(self):
         return len(self._configs)
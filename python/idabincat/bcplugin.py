@@ -20,12 +20,18 @@
 """
 
 import collections
+import distutils.spawn
+import functools
 import hashlib
+import itertools
+import json
 import logging
+import multiprocessing.pool
 import os
 import shutil
 import sys
 import tempfile
+import threading
 import traceback
 import zlib
 # Ugly but IDA Python Linux doesn't have it !
@@ -41,13 +47,16 @@ except ImportError:
     pass
 
 import idaapi
+import idautils
 from idaapi import NW_OPENIDB, NW_CLOSEIDB, NW_TERMIDA, NW_REMOVE
 import idabincat.netnode
 import idabincat.npkgen
 from idabincat.plugin_options import PluginOptions
-from idabincat.analyzer_conf import AnalyzerConfig, AnalyzerConfigurations, ConfigHelpers
+from idabincat.analyzer_conf import AnalyzerConfig, AnalyzerConfigurations, ConfigHelpers, MetadataHooks
+from idabincat.dump_binary import DumpTracker
 from idabincat.gui import GUI
 import pybincat
+from pybincat.tools.progress import LogTail
 
 from PyQt5 import QtCore
 # used in idaapi
@@ -171,27 +180,216 @@ class BincatPlugin(idaapi.plugin_t):
     def term(self):
         if self.state:
             bc_log.debug("Terminating BinCAT")
+            self.state.cancel_loading(wait=True)
+            self.state.cancel_analysis(wait=True)
+            self.state.stop_prefetch()
+            self.state.metadata_hooks.unhook()
+            self.state.dump_tracker.unhook()
             self.state.clear_background()
             self.state.gui.term()
             self.state.gui = None
             self.state = None
 
 
+class HashCache(object):
+    """
+    On-disk cache of sha256 digests of files, keyed by path. Entries are
+    used as long as the file's size, mtime and inode do not change. When the
+    cache is full, least recently used entries are evicted.
+    """
+    BLOCK_SIZE = 1024*1024
+    MAX_ENTRIES = 1000
+
+    def __init__(self, fname):
+        self.fname = fname
+        #: unicode path -> [size, mtime, inode, sha256], least recently used
+        #: first
+        self.entries = None
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        try:
+            with open(self.fname, 'rb') as f:
+                self.entries = json.load(
+                    f, object_pairs_hook=collections.OrderedDict)
+        except (IOError, ValueError):
+            self.entries = collections.OrderedDict()
+
+    def _save(self):
+        try:
+            dirname = os.path.dirname(self.fname)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(self.fname + ".tmp", 'wb') as f:
+                json.dump(self.entries, f)
+            if os.path.exists(self.fname):
+                # rename does not replace files on Windows
+                os.remove(self.fname)
+            os.rename(self.fname + ".tmp", self.fname)
+        except (IOError, OSError):
+            bc_log.warning("Could not save hash cache %s", self.fname,
+                           exc_info=True)
+
+    @staticmethod
+    def compute(path):
+        """
+        Hashes file contents, in fixed-size blocks
+        """
+        h = hashlib.new('sha256')
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(HashCache.BLOCK_SIZE)
+                if not data:
+                    break
+                h.update(data)
+        return h.hexdigest().lower()
+
+    @staticmethod
+    def key(path):
+        """
+        Returns path as unicode, as keys are after a JSON round trip
+        """
+        if isinstance(path, unicode):
+            return path
+        try:
+            return path.decode(sys.getfilesystemencoding() or 'utf-8')
+        except UnicodeDecodeError:
+            # any reversible decoding will do
+            return path.decode('latin-1')
+
+    def sha256_digest(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime, st.st_ino]
+        key = self.key(path)
+        self._load()
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry[:3] == stamp:
+            # most recently used, saved along with the next new entry
+            self.entries[key] = entry
+            return entry[3]
+        sha256 = self.compute(path)
+        while len(self.entries) >= HashCache.MAX_ENTRIES:
+            self.entries.popitem(last=False)
+        self.entries[key] = stamp + [sha256]
+        self._save()
+        return sha256
+
+
 class Analyzer(object):
-    def __init__(self, path, finish_cb):
+    def __init__(self, path, finish_cb, status_cb=None):
         self.path = path
         self.finish_cb = finish_cb
+        #: called from the UI thread with a short description of the
+        #: analysis progress, or "" when it is over
+        self.status_cb = status_cb
+        #: generated .no files, shared by all analyzers
+        self.tnpk_cache = idabincat.npkgen.TnpkCache(
+            os.path.join(PluginOptions.config_path, "cache", "tnpk"))
+        #: (fname, headers_data, destfname) of TNPK files to generate before
+        #: the analysis, see generate_tnpk_files
+        self.tnpk_sources = []
+
+    def cancel(self, wait=False):
+        """
+        Cancels a running analysis, if supported. finish_cb must not be
+        called afterwards.
+        """
+        pass
+
+    def log(self, level, msg, *args):
+        bc_log.log(level, msg, *args)
 
-    def generate_tnpk(self, fname=None, destfname=None):
+    def show_status(self, text):
+        if self.status_cb is not None:
+            self.status_cb(text)
+
+    def show_progress(self, record):
+        """
+        Displays a progress record written by the analyzer to its log
+        """
+        text = ("Analysis in progress: at %s, %d states processed, "
+                "%d waiting" % (record['address'], record['processed'],
+                                record['waiting']))
+        bc_log.debug(text)
+        self.show_status(text)
+
+    def generate_tnpk(self, fname=None, destfname=None, headers_data=None):
         """
         Generates TNPK file for provided fname. If None, generate one for the
-        binary that is currently being analyzed in IDA, using IDA-provided
-        headers.
+        binary that is currently being analyzed in IDA, from headers_data
+        (IDA-provided headers, see IDBMetadataCache.get_header_data), which
+        are generated if it is not set. Files that have already been
+        compiled by the same toolchain are fetched from the TNPK cache.
 
         Returns file path to generated tnpk (string), or None if generation was
         not successful.
         """
-        return None
+        if fname:
+            with open(fname, 'rb') as f:
+                headers_data = f.read()
+        elif headers_data is None:
+            headers_data = idabincat.npkgen.NpkGen().get_header_data()
+        if destfname is None:
+            destfname = os.path.join(self.path, "pre-processed.no")
+        toolchain = self.toolchain_id()
+        key = None
+        if toolchain is not None:
+            key = self.tnpk_cache.key(headers_data, toolchain)
+            if self.tnpk_cache.get(key, destfname):
+                self.log(logging.DEBUG, "Using cached TNPK file for %s",
+                         fname or "IDA-generated headers")
+                return destfname
+        if not self.compile_tnpk(headers_data, destfname):
+            return None
+        if key is not None:
+            self.tnpk_cache.put(key, destfname)
+        return destfname
+
+    def generate_tnpk_files(self, config):
+        """
+        Generates the TNPK files listed in tnpk_sources, which are expected
+        in the headers of config. Files that could not be generated are
+        removed from these headers.
+        """
+        headers = config.headers_files.split(',')
+        for fname, headers_data, destfname in self.tnpk_sources:
+            if self.generate_tnpk(fname, destfname, headers_data):
+                continue
+            if fname:
+                self.log(logging.WARNING,
+                         ".no file containing type data for the headers "
+                         "file %s could not be generated, continuing", fname)
+            else:
+                self.log(logging.WARNING,
+                         ".no file containing type data for the file being "
+                         "analyzed could not be generated, continuing. The "
+                         "ida-generated header could be invalid.")
+            headers.remove(destfname)
+        config.headers_files = ','.join(headers)
+        self.log(logging.DEBUG, "Final npk files: %r", headers)
+
+    def prepare_config(self, config):
+        """
+        Called from the UI thread, before config is written to initfname
+        and run() is called. Generates TNPK files.
+        """
+        self.generate_tnpk_files(config)
+
+    def compile_tnpk(self, headers_data, destfname):
+        """
+        Compiles headers_data (string) to a TNPK file stored as destfname.
+        Returns True if compilation was successful.
+        """
+        return False
+
+    def toolchain_id(self):
+        """
+        Returns a string identifying the tools used by compile_tnpk, or None
+        if they cannot be identified: generated files are not cached.
+        """
+        return ""
 
     @property
     def initfname(self):
@@ -218,27 +416,41 @@ class LocalAnalyzer(Analyzer, QtCore.QProcess):
     """
     Runs BinCAT locally using QProcess.
     """
+    #: delay between two checks for new progress records, in milliseconds
+    PROGRESS_INTERVAL = 1000
 
     def __init__(self, *args, **kwargs):
         QtCore.QProcess.__init__(self)
         Analyzer.__init__(self, *args, **kwargs)
+        self.log_tail = None
+        self.progress_timer = QtCore.QTimer()
+        self.progress_timer.setInterval(LocalAnalyzer.PROGRESS_INTERVAL)
+        self.progress_timer.timeout.connect(self.check_progress)
         # Qprocess signal handlers
         self.error.connect(self.procanalyzer_on_error)
         self.stateChanged.connect(self.procanalyzer_on_state_change)
         self.started.connect(self.procanalyzer_on_start)
         self.finished.connect(self.procanalyzer_on_finish)
 
-    def generate_tnpk(self, fname=None, destfname=None):
-        if fname:
-            imports_data = open(fname, 'rb').read()
-        else:
-            imports_data = ""
+    def compile_tnpk(self, headers_data, destfname):
         try:
-            npk_fname = idabincat.npkgen.NpkGen().generate_tnpk(
-                imports_data=imports_data, destfname=destfname)
-            return npk_fname
-        except idabincat.npkgen.NpkGenException as e:
-            return
+            workdir = self.tnpk_cache.workdir()
+        except OSError:
+            bc_log.warning("Could not create TNPK cache directory",
+                           exc_info=True)
+            return False
+        try:
+            idabincat.npkgen.NpkGen().generate_tnpk(
+                imports_data=headers_data, destfname=destfname,
+                dirname=workdir)
+        except idabincat.npkgen.NpkGenException:
+            return False
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        return os.path.isfile(destfname)
+
+    def toolchain_id(self):
+        return idabincat.npkgen.toolchain_id()
 
     def run(self):
         cmdline = [ "bincat",
@@ -269,6 +481,13 @@ class LocalAnalyzer(Analyzer, QtCore.QProcess):
 
     def procanalyzer_on_start(self):
         bc_log.info("Analyzer: starting process")
+        self.log_tail = LogTail(self.logfname)
+        self.progress_timer.start()
+
+    def check_progress(self):
+        record = self.log_tail.progress()
+        if record is not None:
+            self.show_progress(record)
 
     def procanalyzer_on_finish(self):
         bc_log.info("Analyzer process finished")
@@ -281,6 +500,8 @@ class LocalAnalyzer(Analyzer, QtCore.QProcess):
         """
         Try to process analyzer output.
         """
+        self.progress_timer.stop()
+        self.show_status("")
         bc_log.info("---- stdout ----------------")
         bc_log.info(str(self.readAllStandardOutput()))
         bc_log.info("---- stderr ----------------")
@@ -300,19 +521,103 @@ class LocalAnalyzer(Analyzer, QtCore.QProcess):
         self.finish_cb(self.outfname, self.logfname, self.cfaoutfname)
 
 
-class WebAnalyzer(Analyzer):
-    API_VERSION = "1.2"
+class WebAnalyzerThread(QtCore.QThread):
+    """
+    Runs a remote analysis, so that IDA does not freeze while files are
+    transferred and the server is busy.
+    """
+    def __init__(self, analyzer):
+        super(WebAnalyzerThread, self).__init__()
+        self.analyzer = analyzer
+
+    def run(self):
+        try:
+            res = self.analyzer.run_remote()
+        except Exception as e:
+            self.analyzer.log(logging.ERROR, "Remote analysis failed: %s\n%s",
+                              e, traceback.format_exc())
+            res = None
+        self.analyzer.remote_finished.emit(res)
+
+
+class WebAnalyzer(Analyzer, QtCore.QObject):
+    """
+    Runs BinCAT on a remote server. The version check, TNPK generation,
+    transfers and the analysis run in a WebAnalyzerThread; finish_cb is
+    called from the UI thread.
+    """
+    API_VERSION = "1.3"
+    #: number of files transferred simultaneously
+    TRANSFER_THREADS = 4
+    #: retries for idempotent requests, on connection errors
+    MAX_RETRIES = 3
+    DOWNLOAD_BLOCK_SIZE = 1024*1024
+
+    #: current step of the remote analysis
+    progress = QtCore.pyqtSignal(str)
+    #: progress record written by the analyzer
+    analysis_progress = QtCore.pyqtSignal(object)
+    #: (level, message), logged from the UI thread
+    log_message = QtCore.pyqtSignal(int, str)
+    #: list of paths. Asks the user before uploading files, from the UI thread
+    upload_confirmation = QtCore.pyqtSignal(list)
+    #: bincat stdout if results have been downloaded, else None
+    remote_finished = QtCore.pyqtSignal(object)
+    #: analyzers having a running thread, kept alive until it finishes
+    running = set()
 
     def __init__(self, *args, **kwargs):
+        QtCore.QObject.__init__(self)
         Analyzer.__init__(self, *args, **kwargs)
+        self.worker = None
+        self.cancelled = False
+        self.upload_confirmed = False
+        self.log_message.connect(self.on_log_message)
+        self.progress.connect(self.on_progress)
+        self.analysis_progress.connect(self.show_progress)
+        self.upload_confirmation.connect(
+            self.on_upload_confirmation, QtCore.Qt.BlockingQueuedConnection)
+        self.remote_finished.connect(self.on_remote_finished)
         self.server_url = PluginOptions.get("server_url").rstrip("/")
         self.reachable_server = False
-        self.check_version()  # raises exception if server is unreachable
-        self.reachable_server = True
+        #: per-thread requests sessions, see the session property
+        self._sessions = threading.local()
+        #: identifies the server's TNPK toolchain, None if unknown
+        self.server_toolchain = None
+        self.hash_cache = HashCache(
+            os.path.join(PluginOptions.config_path, "cache", "hashes.json"))
+
+    @property
+    def session(self):
+        """
+        requests session of the current thread. Sessions are not
+        thread-safe: each transfer thread uses its own.
+        """
+        session = getattr(self._sessions, "session", None)
+        if session is None:
+            session = self._sessions.session = self.new_session()
+        return session
+
+    def new_session(self):
+        """
+        Returns a requests session: connections to the server are kept alive
+        and requests are retried on connection errors.
+        """
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            max_retries=requests.packages.urllib3.util.retry.Retry(
+                total=WebAnalyzer.MAX_RETRIES, backoff_factor=0.5))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
 
     def check_version(self):
+        """
+        Raises AnalyzerUnavailable if the server is unreachable or does not
+        support this plugin. Called from the WebAnalyzerThread.
+        """
         try:
-            version_req = requests.get(self.server_url + "/version")
+            version_req = self.session.get(self.server_url + "/version")
             srv_api_version = str(version_req.text)
         except:
             raise AnalyzerUnavailable(
@@ -322,51 +627,160 @@ class WebAnalyzer(Analyzer):
                 "API mismatch: this plugin supports version %s, while server "
                 "supports version %s." % (WebAnalyzer.API_VERSION,
                                           srv_api_version))
+        try:
+            toolchain_req = self.session.get(
+                self.server_url + "/toolchain_version")
+        except requests.exceptions.RequestException:
+            toolchain_req = None
+        if toolchain_req is not None and toolchain_req.status_code == 200:
+            self.server_toolchain = toolchain_req.text
         return True
 
-    def generate_tnpk(self, fname=None, destfname=None):
+    def compile_tnpk(self, headers_data, destfname):
         if not self.reachable_server:
-            return
-        if not fname:
-            headers_data = idabincat.npkgen.NpkGen().get_header_data()
-            fname = os.path.join(self.path, "ida_generated_headers.h")
-            with open(fname, 'wb') as f:
-                f.write(headers_data)
+            return False
+        fname = os.path.join(self.path, "ida_generated_headers.h")
+        with open(fname, 'wb') as f:
+            f.write(headers_data)
         sha256 = self.sha256_digest(fname)
-        if not self.upload_file(fname, sha256):
-            return
-        npk_res = requests.post(self.server_url + "/convert_to_tnpk/" + sha256)
+        if not self.upload_files({sha256: fname}):
+            return False
+        npk_res = self.session.post(
+            self.server_url + "/convert_to_tnpk/" + sha256)
         if npk_res.status_code != 200:
-            bc_log.error("Error while compiling file to tnpk "
-                         "on BinCAT analysis server.")
-            return
+            self.log(logging.ERROR, "Error while compiling file to tnpk "
+                     "on BinCAT analysis server.")
+            return False
         res = npk_res.json()
         if 'status' not in res or res['status'] != 'ok':
-            return
+            return False
         sha256 = res['sha256']
-        npk_contents = self.download_file(sha256)
-        npk_fname = os.path.join(self.path, "headers.npk")
-        with open(npk_fname, 'wb') as f:
-            f.write(npk_contents)
-        return npk_fname
+        return bool(self.download_file(sha256, destfname))
+
+    def toolchain_id(self):
+        if self.server_toolchain is None:
+            # older server
+            return None
+        return "web:%s:%s:%s" % (self.server_url, WebAnalyzer.API_VERSION,
+                                 self.server_toolchain)
+
+    def prepare_config(self, config):
+        # TNPK files are generated on the server, from run_remote
+        pass
 
     def run(self):
-        if not self.reachable_server:
-            return
         if 'requests' not in sys.modules:
             bc_log.error("python module 'requests' could not be imported, "
                          "so remote BinCAT cannot be used.")
             return
+        self.cancelled = False
+        self.worker = WebAnalyzerThread(self)
+        WebAnalyzer.running.add(self)
+        self.worker.start()
+        bc_log.info("Remote analysis started.")
+
+    def cancel(self, wait=False):
+        """
+        Stops the remote analysis at the next step. The analysis keeps
+        running on the server, finish_cb will not be called.
+        """
+        self.cancelled = True
+        if wait and self.worker is not None:
+            # do not wait forever if the thread is waiting for the UI thread
+            self.worker.wait(5000)
+
+    def log(self, level, msg, *args):
+        """
+        Logs from any thread
+        """
+        if args:
+            msg = msg % args
+        self.log_message.emit(level, msg)
+
+    def on_log_message(self, level, msg):
+        bc_log.log(level, msg)
+
+    def on_progress(self, step):
+        bc_log.info("Remote analysis: %s", step)
+        self.show_status("Remote analysis: %s" % step)
+
+    def on_upload_confirmation(self, paths):
+        # Confirmation dialog before uploading files?
+        msgBox = QtWidgets.QMessageBox()
+        msgBox.setText("Do you really want to upload %s to %s?" %
+                       (", ".join(paths), self.server_url))
+        msgBox.setStandardButtons(QtWidgets.QMessageBox.Yes |
+                                  QtWidgets.QMessageBox.No)
+        msgBox.setIcon(QtWidgets.QMessageBox.Question)
+        ret = msgBox.exec_()
+        self.upload_confirmed = (ret == QtWidgets.QMessageBox.Yes)
+
+    def confirm_upload(self, paths):
+        if QtCore.QThread.currentThread() == self.thread():
+            # UI thread, blocking signals would dead lock
+            self.on_upload_confirmation(paths)
+        else:
+            self.upload_confirmation.emit(paths)
+        return self.upload_confirmed
+
+    def on_remote_finished(self, stdout):
+        self.worker.wait()
+        self.worker = None
+        WebAnalyzer.running.discard(self)
+        self.show_status("")
+        if self.cancelled:
+            bc_log.info("Remote analysis cancelled.")
+            return
+        if stdout is None:
+            return
+        bc_log.info("---- stdout+stderr ----------------")
+        bc_log.info(stdout)
+        bc_log.info("---- logfile ---------------")
+        with open(self.logfname, 'rb') as logfp:
+            log_lines = logfp.read().split('\n')
+
+        log_lines = dedup_loglines(log_lines, max=100)
+        if len(log_lines) > 100:
+            bc_log.info("---- Only the last 100 log lines (deduped) are displayed here ---")
+            bc_log.info("---- See full log in %s ---" % self.logfname)
+        for line in log_lines:
+            bc_log.info(line.rstrip())
+
+        bc_log.info("----------------------------")
+        self.finish_cb(self.outfname, self.logfname, self.cfaoutfname)
+
+    def run_remote(self):
+        """
+        Runs in a WebAnalyzerThread. Checks the server version, generates
+        TNPK files, uploads files, runs the analysis job and downloads
+        results.
+        Returns bincat's stdout, or None if results have not been
+        downloaded.
+        """
+        self.progress.emit("checking server version")
+        try:
+            self.check_version()
+        except AnalyzerUnavailable as e:
+            self.log(logging.ERROR, "Analyzer is unavailable: %s", e)
+            return
+        self.reachable_server = True
         # create temporary AnalyzerConfig to replace referenced file names with
         # sha256 of their contents
         with open(self.initfname, 'rb') as f:
             temp_config = AnalyzerConfig.load_from_str(f.read())
-        # patch filepath - set filepath to sha256, upload file
+        if self.tnpk_sources:
+            self.progress.emit("generating .no files")
+            self.generate_tnpk_files(temp_config)
+            if self.cancelled:
+                return
+        #: sha256 -> path of files that will be uploaded
+        upload = {}
+        self.progress.emit("hashing input files")
+        # patch filepath - set filepath to sha256
         sha256 = self.sha256_digest(temp_config.binary_filepath)
-        if not self.upload_file(temp_config.binary_filepath, sha256):
-            return
+        upload[sha256] = temp_config.binary_filepath
         temp_config.binary_filepath = sha256
-        # patch [imports] headers - replace with sha256, upload files
+        # patch [imports] headers - replace with sha256
         files = temp_config.headers_files.split(',')
         h_shalist = []
         for f in files:
@@ -375,116 +789,374 @@ class WebAnalyzer(Analyzer):
             try:
                 f_sha256 = self.sha256_digest(f)
                 h_shalist.append('"%s"' % f_sha256)
-            except IOError as e:
-                bc_log.error("Could not open file %s" % f, exc_info=1)
-                return
-            if not self.upload_file(f, f_sha256):
-                bc_log.error("Could not upload file %s" % f, exc_info=1)
+            except (IOError, OSError) as e:
+                self.log(logging.ERROR, "Could not open file %s (%s)", f, e)
                 return
+            upload[f_sha256] = f
         temp_config.headers_files = ','.join(h_shalist)
 
         # patch in_marshalled_cfa_file - replace with file contents sha256
         if os.path.exists(self.cfainfname):
             cfa_sha256 = self.sha256_digest(self.cfainfname)
+            upload[cfa_sha256] = self.cfainfname
             temp_config.in_marshalled_cfa_file = '"%s"' % cfa_sha256
         else:
             temp_config.in_marshalled_cfa_file = '"no-input-file"'
         temp_config.out_marshalled_cfa_file = '"cfaout.marshal"'
+        # upload all files that the server does not have yet
+        if self.cancelled or not self.upload_files(upload):
+            return
         # write patched config file
         init_ini_str = str(temp_config)
         # --- Run analysis
-        run_res = requests.post(
-            self.server_url + "/analyze",
+        run_res = self.session.post(
+            self.server_url + "/jobs",
             files={'init.ini': ('init.ini', init_ini_str)})
-        if run_res.status_code != 200:
-            bc_log.error("Error while uploading analysis configuration file "
-                         "to BinCAT analysis server (%r)" % run_res.text)
+        if run_res.status_code != 202:
+            self.log(logging.ERROR,
+                     "Error while uploading analysis configuration file "
+                     "to BinCAT analysis server (%r)", run_res.text)
+            return
+        job_id = run_res.json()['job_id']
+        if not self.follow_job(job_id):
+            return
+        job_res = self.session.get(self.server_url + "/jobs/" + job_id)
+        if job_res.status_code != 200:
+            self.log(logging.ERROR,
+                     "Error while getting analysis status from BinCAT "
+                     "analysis server (%r)", job_res.text)
             return
-        files = run_res.json()
+        job = job_res.json()
+        if job['status'] != 'done':
+            self.log(logging.ERROR, "Analysis failed on server: %s",
+                     job.get('error'))
+            return
+        files = job['result']
         if files["errorcode"]:
-            bc_log.error("Error while analyzing file. Bincat output is:\n"
-                         "----------------\n%s\n----------------"
-                         % self.download_file(files["stdout.txt"]))
+            self.log(logging.ERROR,
+                     "Error while analyzing file. Bincat output is:\n"
+                     "----------------\n%s\n----------------",
+                     self.download_file(files["stdout.txt"]))
             if not files["out.ini"]:  # try to parse out.ini if it exists
                 return
-        with open(self.outfname, 'wb') as outfp:
-
-            outfp.write(self.download_file(files["out.ini"]))
-        analyzer_log_contents = self.download_file(files["analyzer.log"])
-        with open(self.logfname, 'wb') as logfp:
-            logfp.write(analyzer_log_contents)
-        bc_log.info("---- stdout+stderr ----------------")
-        bc_log.info(self.download_file(files["stdout.txt"]))
-        bc_log.info("---- logfile ---------------")
-        log_lines = analyzer_log_contents.split('\n')
-
-        log_lines = dedup_loglines(log_lines, max=100)
-        if len(log_lines) > 100:
-            bc_log.info("---- Only the last 100 log lines (deduped) are displayed here ---")
-            bc_log.info("---- See full log in %s ---" % self.logfname)
-        for line in log_lines:
-            bc_log.info(line.rstrip())
-
-        bc_log.info("----------------------------")
+        self.progress.emit("downloading results")
+        # (sha256, destination file name or None to get contents)
+        downloads = [(files["out.ini"], self.outfname),
+                     (files["analyzer.log"], self.logfname),
+                     (files["stdout.txt"], None)]
         if "cfaout.marshal" in files:
             # might be absent (ex. when analysis failed, or not requested)
-            with open(self.cfaoutfname, 'wb') as cfaoutfp:
-                cfaoutfp.write(self.download_file(files["cfaout.marshal"]))
-        self.finish_cb(self.outfname, self.logfname, self.cfaoutfname)
+            downloads.append((files["cfaout.marshal"], self.cfaoutfname))
+        res = self.download_files(downloads)
+        if None in res:
+            self.log(logging.ERROR, "Could not download analysis results.")
+            return
+        return res[2]
 
-    def download_file(self, fname):
-        r = requests.get(self.server_url + '/download/' + fname + '/zlib')
+    def follow_job(self, job_id):
+        """
+        Reads progress events sent by the server, until the job is over.
+        Returns False if the analysis has been cancelled or the server could
+        not be reached.
+        """
+        try:
+            r = self.session.get(
+                self.server_url + "/jobs/%s/progress" % job_id, stream=True)
+        except requests.exceptions.RequestException as e:
+            self.log(logging.ERROR,
+                     "Error when contacting the BinCAT server: %s", e)
+            return False
+        if r.status_code != 200:
+            self.log(logging.ERROR,
+                     "Error while getting analysis progress from BinCAT "
+                     "analysis server (%r)", r.text)
+            r.close()
+            return False
+        event = None
         try:
-            return zlib.decompress(r.content)
+            # events are small: do not wait for a larger chunk
+            for line in r.iter_lines(chunk_size=1):
+                if self.cancelled:
+                    return False
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    data = json.loads(line[len("data: "):])
+                    if event == "status":
+                        self.progress.emit("analysis %s" % data)
+                    else:
+                        self.analysis_progress.emit(data)
+                elif not line:
+                    # end of event
+                    event = None
+        except requests.exceptions.RequestException as e:
+            self.log(logging.ERROR,
+                     "Connection to the BinCAT server lost: %s", e)
+            return False
+        finally:
+            r.close()
+        return not self.cancelled
+
+    def download_file(self, fname, destfname=None):
+        """
+        Downloads file having sha256 fname. Its contents are written to
+        destfname, as they are received, if it is set, else returned.
+        Returns True if it has been written, None on error.
+        """
+        try:
+            r = self.session.get(
+                self.server_url + '/download/' + fname + '/zlib', stream=True)
+        except requests.exceptions.RequestException as e:
+            self.log(logging.ERROR,
+                     "Error when contacting the BinCAT server: %s", e)
+            return
+        if r.status_code != 200:
+            self.log(logging.ERROR, "Error while downloading file [%s] (%r)",
+                     fname, r.status_code)
+            r.close()
+            return
+        decomp = zlib.decompressobj()
+        parts = []
+        out = open(destfname, 'wb') if destfname else None
+        try:
+            for chunk in r.iter_content(WebAnalyzer.DOWNLOAD_BLOCK_SIZE):
+                data = decomp.decompress(chunk)
+                if out:
+                    out.write(data)
+                else:
+                    parts.append(data)
+            data = decomp.flush()
+            if out:
+                out.write(data)
+            else:
+                parts.append(data)
         except Exception as e:
-            bc_log.error("Error uncompressing downloaded file [%s] (%s)" %
-                         (fname, e))
+            self.log(logging.ERROR,
+                     "Error uncompressing downloaded file [%s] (%s)",
+                     fname, e)
+            return
+        finally:
+            r.close()
+            if out:
+                out.close()
+        if out:
+            return True
+        return "".join(parts)
+
+    def download_files(self, downloads):
+        """
+        Downloads files in parallel, each worker thread using its own
+        session.
+        downloads: list of (sha256, destfname) as expected by download_file
+        Returns the list of download_file results, None for downloads that
+        failed, including those which raised an exception.
+        """
+        def download(d):
+            try:
+                return self.download_file(*d)
+            except Exception as e:
+                self.log(logging.ERROR,
+                         "Error while downloading file [%s] (%s)", d[0], e)
+                return None
+
+        pool = multiprocessing.pool.ThreadPool(WebAnalyzer.TRANSFER_THREADS)
+        try:
+            return pool.map(download, downloads)
+        finally:
+            pool.close()
+            pool.join()
 
     def sha256_digest(self, path):
-        with open(path, 'rb') as f:
-            h = hashlib.new('sha256')
-            h.update(f.read())
-            sha256 = h.hexdigest().lower()
-        return sha256
+        return self.hash_cache.sha256_digest(path)
 
-    def upload_file(self, path, sha256):
-        # check whether file has already been uploaded
+    def upload_files(self, files):
+        """
+        files: dict sha256 -> path
+        Uploads files that are missing on the server, using one request to
+        check which are missing, and one request to upload them.
+        Returns True on success.
+        """
         try:
-            check_res = requests.head(
-                self.server_url + "/download/%s" % sha256)
+            check_res = self.session.post(
+                self.server_url + "/exists",
+                json={'sha256': list(files.keys())})
         except requests.exceptions.ConnectionError as e:
-            bc_log.error("Error when contacting the BinCAT server: %s", e)
-            return
-        if check_res.status_code == 404:
-            # Confirmation dialog before uploading file?
-            msgBox = QtWidgets.QMessageBox()
-            msgBox.setText("Do you really want to upload %s to %s?" %
-                           (path, self.server_url))
-            msgBox.setStandardButtons(QtWidgets.QMessageBox.Yes |
-                                      QtWidgets.QMessageBox.No)
-            msgBox.setIcon(QtWidgets.QMessageBox.Question)
-            ret = msgBox.exec_()
-            if ret == QtWidgets.QMessageBox.No:
-                bc_log.info("Upload aborted.")
-                return
-            # upload
-            upload_res = requests.put(
+            self.log(logging.ERROR,
+                     "Error when contacting the BinCAT server: %s", e)
+            return
+        if check_res.status_code != 200:
+            self.log(logging.ERROR,
+                     "Error while checking for files on BinCAT analysis "
+                     "server (%r)", check_res.text)
+            return
+        missing = check_res.json()['missing']
+        if not missing:
+            return True
+        paths = [files[sha256] for sha256 in missing]
+        if not self.confirm_upload(paths):
+            self.log(logging.INFO, "Upload aborted.")
+            return
+        # upload
+        self.progress.emit("uploading %d file(s)" % len(paths))
+        fileobjs = [open(path, 'rb') for path in paths]
+        try:
+            upload_res = self.session.put(
                 self.server_url + "/add",
-                files={'file': ('file', open(path, 'rb').read())})
-            if upload_res.status_code != 200:
-                bc_log.error("Error while uploading file %s "
-                             "to BinCAT analysis server.", path)
-                return
+                files=[('file', ('file', f)) for f in fileobjs])
+        finally:
+            for f in fileobjs:
+                f.close()
+        if upload_res.status_code != 200:
+            self.log(logging.ERROR, "Error while uploading files %s "
+                     "to BinCAT analysis server.", ", ".join(paths))
+            return
+        uploaded = upload_res.json()['files']
+        if uploaded != missing:
+            self.log(logging.ERROR,
+                     "Files have been modified while being uploaded to "
+                     "BinCAT analysis server.")
+            return
         return True
 
 
+class ResultLoader(QtCore.QThread):
+    """
+    Parses analyzer results in a worker thread, so that IDA does not freeze
+    while large output files are being parsed.
+    The parsed CFA is handed back to the UI thread using the loaded signal.
+
+    If outfname is None, results are loaded from the snapshot file
+    snapshotfname. Else, once loaded has been emitted, a snapshot of the
+    results is written to snapshotfname, if it is set.
+    """
+    #: (parsed sections, total sections)
+    progress = QtCore.pyqtSignal(int, int)
+    #: parsed CFA
+    loaded = QtCore.pyqtSignal(object)
+    #: error message
+    failed = QtCore.pyqtSignal(str)
+    #: emitted after loaded, once snapshotfname has been written, or could
+    #: not be written
+    snapshot_done = QtCore.pyqtSignal()
+
+    def __init__(self, outfname, logfname, snapshotfname=None):
+        super(ResultLoader, self).__init__()
+        self.outfname = outfname
+        self.logfname = logfname
+        self.snapshotfname = snapshotfname
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Parsing stops at the next progress report, no signal is emitted
+        afterwards.
+        """
+        self.cancelled = True
+
+    def progress_cb(self, done, total):
+        if self.cancelled:
+            return False
+        self.progress.emit(done, total)
+        return True
+
+    def run(self):
+        try:
+            if self.outfname is None:
+                with open(self.snapshotfname, 'rb') as f:
+                    cfa = cfa_module.CFA.load_snapshot(f)
+            else:
+                cfa = cfa_module.CFA.parse(self.outfname, logs=self.logfname,
+                                           progress_cb=self.progress_cb)
+        except cfa_module.PyBinCATParseCancelled:
+            return
+        except Exception as e:
+            # exceptions must not escape from a QThread
+            if not self.cancelled:
+                self.failed.emit("%s\n%s" % (e, traceback.format_exc()))
+            return
+        if self.cancelled:
+            return
+        self.loaded.emit(cfa)
+        if self.outfname is not None and self.snapshotfname is not None:
+            if cfa:
+                self.save_snapshot()
+            if not self.cancelled:
+                self.snapshot_done.emit()
+
+    def save_snapshot(self):
+        """
+        Parses the result file again, and writes a snapshot of all its
+        states: states of the CFA handed to the UI thread stay lazily
+        parsed, and are not all kept in memory. If the snapshot cannot be
+        written, no snapshot file is left behind.
+        """
+        def check_cancelled(done, total):
+            return not self.cancelled
+
+        try:
+            cfa = cfa_module.CFA.parse(self.outfname, logs=self.logfname,
+                                       progress_cb=check_cancelled)
+            with open(self.snapshotfname, 'wb') as f:
+                cfa.save_snapshot(f, progress_cb=check_cancelled)
+        except Exception:
+            if os.path.exists(self.snapshotfname):
+                os.remove(self.snapshotfname)
+
+
+class StatePrefetcher(QtCore.QThread):
+    """
+    Parses states that are likely to be displayed next (neighbours of the
+    current node) in a worker thread, so that they are ready when the user
+    navigates to them.
+    """
+    def __init__(self):
+        super(StatePrefetcher, self).__init__()
+        self.cond = threading.Condition()
+        #: cfa.State objects that remain to be parsed, most likely first
+        self.pending = []
+        self.stopped = False
+
+    def prefetch(self, states):
+        """
+        Replaces states waiting to be parsed with states
+        """
+        with self.cond:
+            self.pending = list(states)
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.pending = []
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                state = self.pending.pop(0)
+            try:
+                state.prefetch()
+            except Exception:
+                # reported when the state is displayed
+                pass
+
+
 class State(object):
     """
     Container for (static) plugin state related data & methods.
     """
+    #: maximum number of heads of the current function looked up for
+    #: states to prefetch
+    PREFETCH_MAX_HEADS = 1024
+
     def __init__(self):
         self.current_ea = None
-        self.cfa = None
+        #: analysis results, use the cfa property or get_cfa()
+        self._cfa = None
         self.current_state = None
         self.current_node_ids = []
         #: last run config
@@ -500,18 +1172,49 @@ class State(object):
         self.overrides = CallbackWrappedList()
         #: list of (name, config)
         self.configurations = AnalyzerConfigurations(self)
+        #: invalidates cached IDB metadata when the IDB changes
+        self.metadata_hooks = MetadataHooks(self.configurations.metadata)
+        self.metadata_hooks.hook()
+        #: skips dumps of the remapped binary when the IDB has not changed
+        self.dump_tracker = DumpTracker(self.netnode)
+        self.dump_tracker.hook()
         # XXX store in idb after encoding?
         self.last_cfaout_marshal = None
         #: filepath to last dumped remapped binary
         self.remapped_bin_path = None
         self.remap_binary = True
+        #: ResultLoader currently parsing analysis results
+        self.loader = None
+        #: ResultLoaders that have been cancelled, but are still running
+        self.stale_loaders = set()
+        #: last progress decile that has been logged
+        self.loader_decile = -1
+        #: address (int) -> taint status (bool) shown in IDA's background
+        #: colors
+        self.colored = {}
+        #: iterator on (address, taint status or None) color updates that
+        #: still have to be applied
+        self.color_updates = None
+        #: True if analysis results stored in the IDB have not been loaded
+        #: yet (lazy loading)
+        self.idb_results_pending = False
+        #: StatePrefetcher, started when first needed
+        self.prefetcher = None
+        #: prefetch states up to this number of edges from the current node
+        self.prefetch_depth = int(PluginOptions.get("prefetch_depth"))
+        #: maximum number of states prefetched after each move
+        self.prefetch_max_states = int(
+            PluginOptions.get("prefetch_max_states"))
+        #: maximum number of parsed states kept in memory
+        self.max_parsed_states = int(PluginOptions.get("max_parsed_states"))
         # for debugging purposes, to interact with this object from the console
         global bc_state
         bc_state = self
 
         self.gui = GUI(self)
         if PluginOptions.get("load_from_idb") == "True":
-            self.load_from_idb()
+            self.load_from_idb(
+                lazy=(PluginOptions.get("lazy_load_from_idb") == "True"))
 
     def new_analyzer(self, *args, **kwargs):
         """
@@ -523,22 +1226,56 @@ class State(object):
         else:
             return LocalAnalyzer(*args, **kwargs)
 
-    def load_from_idb(self):
-        if "out.ini" in self.netnode and "analyzer.log" in self.netnode:
-            bc_log.info("Loading analysis results from idb")
-            path = tempfile.mkdtemp(suffix='bincat')
-            outfname = os.path.join(path, "out.ini")
-            logfname = os.path.join(path, "analyzer.log")
-            with open(outfname, 'wb') as outfp:
-                outfp.write(self.netnode["out.ini"])
-            with open(logfname, 'wb') as logfp:
-                logfp.write(self.netnode["analyzer.log"])
-            if "current_ea" in self.netnode:
-                ea = self.netnode["current_ea"]
+    @property
+    def cfa(self):
+        """
+        Analysis results. Results stored in the IDB are loaded if they have
+        not been loaded yet.
+        """
+        return self.get_cfa()
+
+    @cfa.setter
+    def cfa(self, value):
+        if value:
+            value.parsed_states.max_states = self.max_parsed_states
+        self._cfa = value
+
+    def get_cfa(self, load=True, wait=True, ea=None):
+        """
+        Returns analysis results. All accesses to results go through this
+        method, so that results stored in the IDB are loaded when first
+        needed.
+
+        :param load: load results stored in the IDB if they have not been
+            loaded yet
+        :param wait: if False, results are loaded in the background, None is
+            returned meanwhile
+        :param ea: address displayed once results have been loaded,
+            defaults to the one stored in the IDB
+        """
+        if load and self.idb_results_pending:
+            if ea is None:
+                ea = self.netnode.get("current_ea")
+            self.load_results_from_idb(ea, wait=wait)
+        return self._cfa
+
+    def load_from_idb(self, lazy=False):
+        """
+        :param lazy: only record that analysis results are stored in the IDB,
+            they will be loaded when a BinCAT view needs them
+        """
+        if ("cfa_snapshot" in self.netnode or
+                ("out.ini" in self.netnode and "analyzer.log" in self.netnode)):
+            if lazy:
+                bc_log.info("Analysis results are stored in idb, they will "
+                            "be loaded when needed")
+                self.idb_results_pending = True
             else:
-                ea = None
-            self.analysis_finish_cb(outfname, logfname, cfaoutfname=None,
-                                    ea=ea)
+                if "current_ea" in self.netnode:
+                    ea = self.netnode["current_ea"]
+                else:
+                    ea = None
+                self.load_results_from_idb(ea)
         if "remapped_bin_path" in self.netnode:
             fname = self.netnode["remapped_bin_path"]
             if os.path.isfile(fname):
@@ -546,41 +1283,190 @@ class State(object):
         if "remap_binary" in self.netnode:
             self.remap_binary = self.netnode["remap_binary"]
 
+    def load_results_from_idb(self, ea=None, wait=False):
+        """
+        Loads analysis results stored in the IDB
+
+        :param wait: parse results in the current thread
+        """
+        self.idb_results_pending = False
+        bc_log.info("Loading analysis results from idb")
+        path = tempfile.mkdtemp(suffix='bincat')
+        if "cfa_snapshot" in self.netnode:
+            snapshotfname = os.path.join(path, "cfa.snapshot")
+            with open(snapshotfname, 'wb') as fp:
+                shutil.copyfileobj(self.netnode.open("cfa_snapshot"), fp)
+            self.analysis_finish_cb(None, None, cfaoutfname=None, ea=ea,
+                                    store=False, snapshotfname=snapshotfname,
+                                    wait=wait)
+            return
+        # results stored by previous versions
+        outfname = os.path.join(path, "out.ini")
+        logfname = os.path.join(path, "analyzer.log")
+        with open(outfname, 'wb') as outfp:
+            shutil.copyfileobj(self.netnode.open("out.ini"), outfp)
+        with open(logfname, 'wb') as logfp:
+            shutil.copyfileobj(self.netnode.open("analyzer.log"), logfp)
+        self.analysis_finish_cb(outfname, logfname, cfaoutfname=None,
+                                ea=ea, store=False, wait=wait)
+
+    def cancel_loading(self, wait=False):
+        """
+        cancel parsing of analysis results, if any is in progress
+
+        :param wait: wait for all worker threads to be finished
+        """
+        loader = self.loader
+        self.loader = None
+        if loader is not None:
+            loader.cancel()
+            # keep a reference until the thread has finished, else Qt crashes
+            self.stale_loaders.add(loader)
+            loader.finished.connect(
+                functools.partial(self.stale_loaders.discard, loader))
+        if wait:
+            for loader in list(self.stale_loaders):
+                loader.wait()
+            self.stale_loaders.clear()
+
+    def cancel_analysis(self, wait=False):
+        """
+        cancel remote analyses which are in progress, if any
+        """
+        if self.analyzer is not None:
+            self.analyzer.cancel()
+        for analyzer in list(WebAnalyzer.running):
+            analyzer.cancel(wait)
+
     def clear_background(self):
         """
         reset background color for previous analysis
         """
-        if self.cfa:
-            color = idaapi.calc_bg_color(idaapi.NIF_BG_COLOR)
-            for v in self.cfa.states:
-                ea = v.value
-                idaapi.set_item_color(ea, color)
+        self.color_updates = None
+        color = idaapi.calc_bg_color(idaapi.NIF_BG_COLOR)
+        for ea in self.colored:
+            idaapi.set_item_color(ea, color)
+        self.colored = {}
+
+    def update_background(self):
+        """
+        Only recolor addresses whose taint status differs between the
+        current analysis and the colors that are currently displayed.
+        Colors are updated by batches, to keep the UI responsive.
+        """
+        cfa = self.get_cfa(load=False)
+        if cfa:
+            addr_tainted = cfa.addr_tainted
+        else:
+            addr_tainted = {}
+        colored = self.colored
+        updates = [(ea, tainted) for ea, tainted in addr_tainted.iteritems()
+                   if colored.get(ea) != tainted]
+        updates.extend((ea, None) for ea in colored
+                       if ea not in addr_tainted)
+        updates.sort()
+        self.color_updates = iter(updates)
+        QtCore.QTimer.singleShot(0, self.apply_color_updates)
+
+    def apply_color_updates(self, batch_size=5000):
+        """
+        Applies the next batch_size background color updates
+        """
+        if self.color_updates is None:
+            return
+        default_color = idaapi.calc_bg_color(idaapi.NIF_BG_COLOR)
+        count = 0
+        for ea, tainted in itertools.islice(self.color_updates, batch_size):
+            count += 1
+            if tainted is None:
+                idaapi.set_item_color(ea, default_color)
+                del self.colored[ea]
+                continue
+            if tainted:
+                idaapi.set_item_color(ea, 0xDDFFDD)
+            else:
+                idaapi.set_item_color(ea, 0xCDCFCE)
+            self.colored[ea] = tainted
+        if count == batch_size:
+            QtCore.QTimer.singleShot(0, self.apply_color_updates)
+        else:
+            self.color_updates = None
 
-    def analysis_finish_cb(self, outfname, logfname, cfaoutfname, ea=None):
+    def analysis_finish_cb(self, outfname, logfname, cfaoutfname, ea=None,
+                           store=True, snapshotfname=None, wait=False):
+        """
+        Starts parsing the analyzer result file in a worker thread. Results
+        are used when parsing is done, in analysis_loaded_cb.
+
+        :param store: store results to the IDB once they have been parsed
+        :param snapshotfname: if outfname is None, load results from this
+            snapshot file instead of parsing the result file
+        :param wait: parse results in the current thread, signals are
+            handled before returning
+        """
         bc_log.debug("Parsing analyzer result file")
-        try:
-            cfa = cfa_module.CFA.parse(outfname, logs=logfname)
-        except (pybincat.PyBinCATException):
-            bc_log.error("Could not parse result file")
-            return None
-        self.clear_background()
+        self.cancel_loading()
+        if outfname is not None and store:
+            snapshotfname = outfname + ".snapshot"
+        loader = ResultLoader(outfname, logfname, snapshotfname)
+        loader.progress.connect(self.analysis_progress_cb)
+        loader.failed.connect(
+            functools.partial(self.analysis_failed_cb, loader))
+        loader.loaded.connect(functools.partial(
+            self.analysis_loaded_cb, loader, outfname, logfname,
+            cfaoutfname, ea, store, snapshotfname))
+        loader.snapshot_done.connect(functools.partial(
+            self.analysis_snapshot_cb, loader, outfname, logfname, store,
+            snapshotfname))
+        self.loader = loader
+        self.loader_decile = -1
+        if wait:
+            loader.run()
+        else:
+            loader.start()
+        return loader
+
+    def analysis_status_cb(self, text):
+        if self.gui:
+            self.gui.set_analysis_status(text)
+
+    def analysis_progress_cb(self, done, total):
+        if total == 0:
+            return
+        decile = (10 * done) / total
+        if decile != self.loader_decile:
+            self.loader_decile = decile
+            bc_log.info("Parsing analysis results: %d%%", 10 * decile)
+
+    def analysis_failed_cb(self, loader, errmsg):
+        if loader is not self.loader:
+            return
+        self.loader = None
+        bc_log.error("Could not parse result file")
+        bc_log.debug(errmsg)
+
+    def analysis_loaded_cb(self, loader, outfname, logfname, cfaoutfname, ea,
+                           store, snapshotfname, cfa):
+        if loader is not self.loader:
+            # results from a cancelled load
+            return
+        if outfname is None or snapshotfname is None:
+            self.loader = None
+        # else the loader is kept until it has written the snapshot, see
+        # analysis_snapshot_cb
         self.cfa = cfa
-        if cfa:
+        if cfa and store:
             # XXX add user preference for saving to idb? in that case, store
             # reference to marshalled cfa elsewhere
-            bc_log.info("Storing analysis results to idb...")
-            with open(outfname, 'rb') as f:
-                self.netnode["out.ini"] = f.read()
-            with open(logfname, 'rb') as f:
-                self.netnode["analyzer.log"] = f.read()
             if self.remapped_bin_path:
                 self.netnode["remapped_bin_path"] = self.remapped_bin_path
             self.netnode["remap_binary"] = self.remap_binary
             if cfaoutfname is not None and os.path.isfile(cfaoutfname):
                 with open(cfaoutfname, 'rb') as f:
                     self.last_cfaout_marshal = f.read()
-            bc_log.info("Analysis results have been stored idb.")
-        else:
+            if self.loader is None:
+                self.store_results(outfname, logfname, snapshotfname)
+        elif not cfa:
             bc_log.info("Empty or unparseable result file.")
         bc_log.debug("----------------------------")
         # Update current RVA to start address (nodeid = 0)
@@ -599,23 +1485,40 @@ class State(object):
                 pass
         self.set_current_ea(current_ea, force=True)
         self.netnode["current_ea"] = current_ea
-        if not cfa:
-            return
-        for addr, nodeids in cfa.states.items():
-            ea = addr.value
-            tainted = False
-            for n_id in nodeids:
-                # is it tainted?
-                # find children state
-                state = cfa[n_id]
-                if state.tainted:
-                    tainted = True
-                    break
+        self.update_background()
 
-            if tainted:
-                idaapi.set_item_color(ea, 0xDDFFDD)
-            else:
-                idaapi.set_item_color(ea, 0xCDCFCE)
+    def analysis_snapshot_cb(self, loader, outfname, logfname, store,
+                             snapshotfname):
+        if loader is not self.loader:
+            # snapshot of cancelled results
+            return
+        self.loader = None
+        if self.cfa and store:
+            self.store_results(outfname, logfname, snapshotfname)
+
+    def store_results(self, outfname, logfname, snapshotfname):
+        """
+        Stores the results snapshot to the IDB, or the raw analyzer output if
+        no snapshot could be written
+        """
+        bc_log.info("Storing analysis results to idb...")
+        if snapshotfname is not None and os.path.isfile(snapshotfname):
+            with open(snapshotfname, 'rb') as f:
+                self.netnode.set_stream("cfa_snapshot", f)
+            # raw results are not needed anymore
+            for key in ("out.ini", "analyzer.log"):
+                if key in self.netnode:
+                    del self.netnode[key]
+        else:
+            bc_log.warning("Could not create results snapshot, storing "
+                           "raw analyzer output")
+            with open(outfname, 'rb') as f:
+                self.netnode.set_stream("out.ini", f)
+            with open(logfname, 'rb') as f:
+                self.netnode.set_stream("analyzer.log", f)
+            if "cfa_snapshot" in self.netnode:
+                del self.netnode["cfa_snapshot"]
+        bc_log.info("Analysis results have been stored idb.")
 
     def set_current_node(self, node_id):
         if self.cfa:
@@ -630,23 +1533,87 @@ class State(object):
         """
         if not (force or ea != self.current_ea):
             return
+        # lazy loading: results are displayed once they have been parsed
+        cfa = self.get_cfa(load=self.gui.results_shown(), wait=False, ea=ea)
         self.gui.before_change_ea()
         self.current_ea = ea
         nonempty_state = False
-        if self.cfa:
-            node_ids = self.cfa.node_id_from_addr(ea)
+        if cfa:
+            node_ids = cfa.node_id_from_addr(ea)
             if node_ids:
                 nonempty_state = True
                 if node_id in node_ids:
-                    self.current_state = self.cfa[node_id]
+                    self.current_state = cfa[node_id]
                 else:
-                    self.current_state = self.cfa[node_ids[0]]
+                    self.current_state = cfa[node_ids[0]]
                 self.current_node_ids = node_ids
         if not nonempty_state:
             self.current_state = None
             self.current_node_ids = []
 
         self.gui.after_change_ea()
+        self.prefetch_neighbours()
+
+    def prefetch_neighbours(self):
+        """
+        Parses in the background states that may be displayed next:
+        successors and predecessors of the current nodes, up to
+        prefetch_depth edges away, then nodes that follow the current
+        address in the current function.
+        """
+        cfa = self.get_cfa(load=False)
+        if (not cfa or not self.current_node_ids or
+                self.prefetch_max_states <= 0):
+            return
+        # breadth-first walk from the current nodes
+        seen = set(self.current_node_ids)
+        node_ids = list(self.current_node_ids)
+        level = list(self.current_node_ids)
+        for _ in range(self.prefetch_depth):
+            next_level = []
+            for node_id in level:
+                for neighbour in itertools.chain(
+                        cfa.edges.get(node_id, ()),
+                        cfa.parent_node_ids(node_id)):
+                    if neighbour not in seen:
+                        seen.add(neighbour)
+                        next_level.append(neighbour)
+            node_ids.extend(next_level)
+            level = next_level
+        func = idaapi.get_func(self.current_ea)
+        if func is not None and len(node_ids) < self.prefetch_max_states:
+            end_ea = func.end_ea if hasattr(func, "end_ea") else func.endEA
+            # heads are walked in the UI thread: bound the walk in large
+            # functions
+            heads = itertools.islice(idautils.Heads(self.current_ea, end_ea),
+                                     State.PREFETCH_MAX_HEADS)
+            for ea in heads:
+                # do not use node_id_from_addr, which adds missing addresses
+                for node_id in cfa.states.get(cfa_module.Value("g", ea, 0),
+                                              ()):
+                    if node_id not in seen:
+                        seen.add(node_id)
+                        node_ids.append(node_id)
+                if len(node_ids) >= self.prefetch_max_states:
+                    break
+        states = []
+        for node_id in node_ids[:self.prefetch_max_states]:
+            # not cfa[node_id]: prefetched states are not used yet
+            state = cfa.nodes.get(node_id)
+            if state is not None and state._regaddrs is None:
+                states.append(state)
+        if not states:
+            return
+        if self.prefetcher is None:
+            self.prefetcher = StatePrefetcher()
+            self.prefetcher.start()
+        self.prefetcher.prefetch(states)
+
+    def stop_prefetch(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher.wait()
+            self.prefetcher = None
 
     def guess_filepath(self):
         filepath = self.current_config.binary_filepath
@@ -677,10 +1644,13 @@ class State(object):
 
         path = tempfile.mkdtemp(suffix='bincat')
 
+        # results of a previous remote analysis would replace these
+        self.cancel_analysis()
         # instance variable: we don't want the garbage collector to delete the
         # *Analyzer instance, killing an unlucky QProcess in the process
         try:
-            self.analyzer = self.new_analyzer(path, self.analysis_finish_cb)
+            self.analyzer = self.new_analyzer(path, self.analysis_finish_cb,
+                                              self.analysis_status_cb)
         except AnalyzerUnavailable as e:
             bc_log.error("Analyzer is unavailable", exc_info=True)
             return
@@ -718,18 +1688,12 @@ class State(object):
                     bc_log.warning(
                         "header file %s could not be found, continuing", f)
                     continue
-                new_npk_fname = f[:-2] + '.no'
-                headers_filenames.remove(f)
-                if not os.path.isfile(new_npk_fname):
-                    # compile
-                    self.analyzer.generate_tnpk(fname=f,
-                                                destfname=new_npk_fname)
-                    if not os.path.isfile(new_npk_fname):
-                        bc_log.warning(
-                            ".no file containing type data for the headers "
-                            "file %s could not be generated, continuing", f)
-                        continue
-                    f = new_npk_fname
+                # do not write next to the source file
+                new_npk_fname = os.path.join(
+                    path, os.path.basename(f)[:-2] + '.no')
+                # compiled, or fetched from the TNPK cache, by the analyzer
+                self.analyzer.tnpk_sources.append((f, None, new_npk_fname))
+                f = new_npk_fname
             # Relative paths are copied
             elif f.endswith('.no') and os.path.isfile(f):
                 if f[0] != os.path.sep:
@@ -748,17 +1712,15 @@ class State(object):
         # already been generated)
         if not any(
                 [s.endswith('pre-processed.no') for s in headers_filenames]):
-            npk_filename = self.analyzer.generate_tnpk()
-            if not npk_filename:
-                bc_log.warning(
-                    ".no file containing type data for the file being "
-                    "analyzed could not be generated, continuing. The "
-                    "ida-generated header could be invalid.")
-            else:
-                headers_filenames.append(npk_filename)
-            bc_log.debug("Final npk files: %r" % headers_filenames)
+            # headers are extracted from the IDB here, in the UI thread
+            npk_filename = os.path.join(path, "pre-processed.no")
+            self.analyzer.tnpk_sources.append(
+                (None, self.configurations.metadata.get_header_data(),
+                 npk_filename))
+            headers_filenames.append(npk_filename)
         self.current_config.headers_files = ','.join(headers_filenames)
 
+        self.analyzer.prepare_config(self.current_config)
         self.current_config.write(self.analyzer.initfname)
         self.analyzer.run()
 
@@ -15,57 +15,206 @@
     You should have received a copy of the GNU Affero General Public License
     along with BinCAT.  If not, see <http://www.gnu.org/licenses/>.
 """
+import hashlib
 import logging
+import os
 import idaapi
 from idabincat.analyzer_conf import ConfigHelpers
 
 dump_log = logging.getLogger('bincat.plugin.dump_binary')
 dump_log.setLevel(logging.INFO)
 
+#: size of the blocks read from the IDB and written to the dump
+BLOCK_SIZE = 1024 * 1024
+#: version of the manifest stored in the IDB
+MANIFEST_VERSION = 2
+
+
+class DumpTracker(idaapi.IDB_Hooks):
+    """
+    Counts changes to segments and bytes, and stores the manifest of the
+    last dump, in netnode: dump_binary does not read the IDB again if
+    nothing has changed since then.
+    The counter is only written to the netnode on the first change after a
+    dump.
+    """
+    def __init__(self, netnode):
+        super(DumpTracker, self).__init__()
+        self.netnode = netnode
+        #: True if a change has been counted since the last dump
+        self.dirty = False
+
+    def _changed(self, *args):
+        if not self.dirty:
+            self.netnode["dump_changes"] = self.changes() + 1
+            self.dirty = True
+        return 0
+
+    byte_patched = _changed
+    segm_added = _changed
+    segm_deleted = _changed
+    segm_start_changed = _changed
+    segm_end_changed = _changed
+    segm_moved = _changed
+    allsegs_moved = _changed
+    segm_name_changed = _changed
+
+    def changes(self):
+        return self.netnode.get("dump_changes", 0)
+
+    def load_manifest(self, path):
+        """
+        Returns the manifest recorded for the dump at path, or None
+        """
+        manifest = self.netnode.get("dump_manifest", None)
+        if (not isinstance(manifest, dict) or
+                manifest.get("version") != MANIFEST_VERSION or
+                manifest.get("path") != path):
+            return None
+        return manifest
+
+    def save_manifest(self, path, sections, hashes):
+        st = os.stat(path)
+        self.netnode["dump_manifest"] = {
+            "version": MANIFEST_VERSION, "path": path,
+            "changes": self.changes(), "sections": sections,
+            "hashes": hashes, "size": st.st_size, "mtime": st.st_mtime}
+        self.dirty = False
+
+    def up_to_date(self, manifest, path):
+        """
+        True if the dump at path has not been modified since manifest was
+        saved, and the IDB has not changed
+        """
+        if manifest["changes"] != self.changes():
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return (st.st_size == manifest["size"] and
+                st.st_mtime == manifest["mtime"])
+
+
+def _segment_blocks(start_ea, size):
+    """
+    Yields the contents of [start_ea, start_ea+size[ by blocks of at most
+    BLOCK_SIZE bytes
+    """
+    for offset in xrange(0, size, BLOCK_SIZE):
+        length = min(BLOCK_SIZE, size - offset)
+        # Only works with fixed IDAPython.
+        yield idaapi.get_many_bytes_ex(start_ea + offset, length)[0]
+
+
+def _segment_hash(start_ea, size):
+    h = hashlib.sha256()
+    for block in _segment_blocks(start_ea, size):
+        h.update(block)
+    return h.hexdigest()
+
+
+def _write_segment(f, start_ea, size, sparse):
+    """
+    Writes segment contents at the current position of f. If sparse is
+    True, zero-filled blocks are skipped, leaving holes in the file.
+    Returns the sha256 of the segment contents.
+    """
+    h = hashlib.sha256()
+    for block in _segment_blocks(start_ea, size):
+        h.update(block)
+        if sparse and block.count("\0") == len(block):
+            f.seek(len(block), os.SEEK_CUR)
+        else:
+            f.write(block)
+    return h.hexdigest()
+
+
+def _dump_binary_base2file(path):
+    """
+    Dumps all segments at their address, for IDA versions with a buggy
+    get_many_bytes_ex. Space between segments is left as holes.
+    """
+    segments = [idaapi.getnseg(x) for x in range(idaapi.get_segm_qty())]
+    if not segments:
+        return None
+    # no need for IDA 7 compat, it's not buggy
+    max_addr = segments[-1].endEA
+    data_size = sum(seg.endEA - seg.startEA for seg in segments)
+    if data_size > 200*1024*1024:
+        if idaapi.ask_yn(idaapi.ASKBTN_NO, "Dump file is over 200MB,"
+                                           " do you want to dump it anyway ?") != idaapi.ASKBTN_YES:
+            return None
+
+    f = idaapi.qfile_t()
+    f.open(path, 'wb+')
+    for seg in segments:
+        idaapi.base2file(f.get_fp(), seg.startEA, seg.startEA, seg.endEA)
+    f.close()
+    with open(path, 'r+b') as f:
+        f.truncate(max_addr)
+    return [("dump", 0, max_addr, 0, max_addr)]
+
 
 # Dumps a remapped binary (as seen in IDA to disk)
 # returns a list of sections
 # [(name, va, vasize, raw_addr, raw_size)]
-def dump_binary(path):
-    max_addr = 0
+# If tracker (DumpTracker) is set and path contains a previous dump: the dump
+# is skipped if the IDB has not changed, else if the segments layout is the
+# same, only segments whose contents have changed are written again.
+def dump_binary(path, tracker=None):
     # Check if we have a buggy IDA or not
     try:
         idaapi.get_many_bytes_ex(0, 1)
     except TypeError:
-        buggy = True
-    else:
-        buggy = False
-    if buggy:
-        f = idaapi.qfile_t()
-        f.open(path, 'wb+')
-        segments = [idaapi.getnseg(x) for x in range(idaapi.get_segm_qty())]
-        max_addr = segments.endEA # no need for IDA 7 compat, it's not buggy
-        if max_addr > 200*1024*1024:
-            if idaapi.ask_yn(idaapi.ASKBTN_NO, "Dump file is over 200MB,"
-                                               " do you want to dump it anyway ?") != idaapi.ASKBTN_YES:
-                return None
-
-        idaapi.base2file(f.get_fp(), 0, 0, max_addr)
-        f.close()
-        return [("dump", 0, max_addr, 0, max_addr)]
+        return _dump_binary_base2file(path)
+
+    manifest = tracker.load_manifest(path) if tracker else None
+    if manifest is not None and tracker.up_to_date(manifest, path):
+        dump_log.info("Remapped binary %s is up to date", path)
+        return [tuple(s) for s in manifest["sections"]]
+
+    sections = []
+    current_offset = 0
+    # over all segments
+    for n in range(idaapi.get_segm_qty()):
+        seg = idaapi.getnseg(n)
+        start_ea = seg.start_ea if hasattr(seg, "start_ea") else seg.startEA
+        end_ea = seg.end_ea if hasattr(seg, "end_ea") else seg.endEA
+        size = end_ea - start_ea
+        sections.append((idaapi.get_segm_name(seg), start_ea, size, current_offset, size))
+        current_offset += size
+    dump_log.debug(repr(sections))
 
+    if (manifest is not None and
+            [tuple(s) for s in manifest["sections"]] == sections and
+            os.path.isfile(path) and os.path.getsize(path) == current_offset):
+        old_hashes = manifest["hashes"]
+        mode = 'r+b'
     else:
-        sections = []
-        current_offset = 0
-        with open(path, 'wb+') as f:
-            # over all segments
-            for n in range(idaapi.get_segm_qty()):
-                seg = idaapi.getnseg(n)
-                start_ea = seg.start_ea if hasattr(seg, "start_ea") else seg.startEA
-                end_ea = seg.end_ea if hasattr(seg, "end_ea") else seg.endEA
-                size = end_ea - start_ea
-                # print "Start: %x, end: %x, size: %x" % (start, end, end-start)
-                # Only works with fixed IDAPython.
-                f.write(idaapi.get_many_bytes_ex(start_ea, size)[0])
-                sections.append((idaapi.get_segm_name(seg), start_ea, size, current_offset, size))
-                current_offset += size
-        dump_log.debug(repr(sections))
-        return sections
+        old_hashes = [None] * len(sections)
+        mode = 'wb'
+    hashes = []
+    rewritten = 0
+    with open(path, mode) as f:
+        for (_, start_ea, size, offset, _), old_hash in zip(sections,
+                                                            old_hashes):
+            if old_hash is not None:
+                new_hash = _segment_hash(start_ea, size)
+                if new_hash == old_hash:
+                    hashes.append(new_hash)
+                    continue
+            f.seek(offset)
+            # holes may only be left in new files
+            hashes.append(_write_segment(f, start_ea, size,
+                                         sparse=(mode == 'wb')))
+            rewritten += 1
+        f.truncate(current_offset)
+    if tracker:
+        tracker.save_manifest(path, sections, hashes)
+    if rewritten == 0:
+        dump_log.info("Remapped binary %s is up to date", path)
+    return sections
 
 if __name__ == '__main__':
     fname = ConfigHelpers.askfile("*.*", "Save to binary")
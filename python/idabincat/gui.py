@@ -19,6 +19,8 @@
     along with BinCAT.  If not, see <http://www.gnu.org/licenses/>.
 """
 import os
+import bisect
+import collections
 import logging
 import string
 import re
@@ -91,6 +93,8 @@ class BinCATOptionsForm_t(QtWidgets.QDialog):
         # Save config in IDB by default
         self.chk_save = QtWidgets.QCheckBox('Save &configuration to IDB')
         self.chk_load = QtWidgets.QCheckBox('&Load configuration from IDB')
+        self.chk_lazy = QtWidgets.QCheckBox(
+            'Load results from IDB &when needed')
 
         btn_start = QtWidgets.QPushButton('&Save', self)
         btn_start.clicked.connect(self.save_config)
@@ -107,13 +111,14 @@ class BinCATOptionsForm_t(QtWidgets.QDialog):
         layout.addWidget(lbl_default_bhv, 0, 0)
         layout.addWidget(self.chk_save, 1, 0)
         layout.addWidget(self.chk_load, 2, 0)
-        layout.addWidget(lbl_plug_opts, 3, 0)
-        layout.addWidget(self.chk_start, 4, 0)
-        layout.addWidget(self.chk_remote, 5, 0)
-        layout.addWidget(lbl_url, 6, 0)
-        layout.addWidget(self.url, 7, 0)
-        layout.addWidget(btn_start, 8, 0)
-        layout.addWidget(btn_cancel, 8, 1)
+        layout.addWidget(self.chk_lazy, 3, 0)
+        layout.addWidget(lbl_plug_opts, 4, 0)
+        layout.addWidget(self.chk_start, 5, 0)
+        layout.addWidget(self.chk_remote, 6, 0)
+        layout.addWidget(lbl_url, 7, 0)
+        layout.addWidget(self.url, 8, 0)
+        layout.addWidget(btn_start, 9, 0)
+        layout.addWidget(btn_cancel, 9, 1)
 
         self.setLayout(layout)
 
@@ -125,6 +130,8 @@ class BinCATOptionsForm_t(QtWidgets.QDialog):
             PluginOptions.get("save_to_idb") == "True")
         self.chk_load.setChecked(
             PluginOptions.get("load_from_idb") == "True")
+        self.chk_lazy.setChecked(
+            PluginOptions.get("lazy_load_from_idb") == "True")
         self.chk_remote.setChecked(
             PluginOptions.get("web_analyzer") == "True")
         url = PluginOptions.get("server_url")
@@ -134,6 +141,8 @@ class BinCATOptionsForm_t(QtWidgets.QDialog):
         PluginOptions.set("autostart", str(self.chk_start.isChecked()))
         PluginOptions.set("save_to_idb", str(self.chk_save.isChecked()))
         PluginOptions.set("load_from_idb", str(self.chk_load.isChecked()))
+        PluginOptions.set("lazy_load_from_idb",
+                          str(self.chk_lazy.isChecked()))
         PluginOptions.set("web_analyzer", str(self.chk_remote.isChecked()))
         PluginOptions.set("server_url", self.url.text())
         PluginOptions.save()
@@ -141,24 +150,68 @@ class BinCATOptionsForm_t(QtWidgets.QDialog):
         return
 
     def show(self):
-        self.setFixedSize(460, 200)
+        self.setFixedSize(460, 220)
         self.setWindowTitle("BinCAT configuration")
         super(BinCATOptionsForm_t, self).show()
 
 
+class MemPageCache(object):
+    """
+    LRU of rendered memory pages, shared by the Meminfo objects created for
+    successive ranges and states.
+    """
+    #: number of addresses per page
+    PAGE_SIZE = 0x1000
+
+    def __init__(self, max_pages=64):
+        self.max_pages = max_pages
+        #: (State, region, page start address) ->
+        #:   (html list, char list, type list)
+        self.pages = collections.OrderedDict()
+        #: (State, region) of the last built block index
+        self.index_key = None
+        #: (sorted list of start addresses, list of [Value], list of block
+        #: stops) for index_key, see Meminfo._block_index
+        self.index = None
+        #: Value -> (html, char), rendering does not depend on the address
+        self.rendered = {}
+
+    def get(self, key):
+        page = self.pages.pop(key, None)
+        if page is not None:
+            # most recently used
+            self.pages[key] = page
+        return page
+
+    def put(self, key, page):
+        self.pages[key] = page
+        while len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+
+    def clear(self):
+        self.pages.clear()
+        self.index_key = None
+        self.index = None
+
+
 class Meminfo(object):
     """
     Helper class to access memory as a str
+
+    Rendered data is fetched from the state by aligned pages of
+    MemPageCache.PAGE_SIZE bytes, the first time one of their bytes is
+    displayed.
     """
-    def __init__(self, state, region, ranges):
+    def __init__(self, state, region, ranges, page_cache=None):
         self.state = state
         self.region = region
         #: list of ranges: [[begin int, end int], ...]
         self.ranges = ranges
         self.start = ranges[0][0]
         self.length = ranges[-1][1]-self.start+1
-        self.char_cache = {}
-        self.html_cache = {}
+        if page_cache is None:
+            page_cache = MemPageCache()
+        self.page_cache = page_cache
 
     @staticmethod
     def color_valtaint(strval, strtaint):
@@ -177,58 +230,120 @@ class Meminfo(object):
                 color_str += "<font color='#c1ad01'>"+c+"</font>"
         return color_str
 
-    def char(self, idx):
-        """ relative get of ASCII char """
-        if idx in self.char_cache:
-            return self.char_cache[idx]
-        try:
-            values = self[idx]
-        except IndexError:
-            # between two ranges
-            return ""
-        if not values or values[0] is None:
-            res = "_"
+    @staticmethod
+    def render_byte(value):
+        """
+        Returns (html hex representation, html char) for a 1-byte Value
+        """
+        html = Meminfo.color_valtaint(value.__valuerepr__(16, True),
+                                      value.__taintrepr__(16, True))
+        # value
+        if value.is_concrete():
+            char = chr(value.value)
+            if char in string.printable:
+                res = char
+            else:
+                res = '.'
+        else:
+            res = "?"
+        # taint
+        if value.ttop != 0 or value.tbot != 0:
+            # top or bot
+            res = "<font color='blue'>%s</font>" % res
+        elif value.taint == 0:
+            pass
+        elif value.taint == 0xFF:
+            res = "<font color='green'>%s</font>" % res
         else:
-            value = values[0]
-            # value
-            if value.is_concrete():
-                char = chr(value.value)
-                if char in string.printable:
-                    res = char
+            res = "<font color='#c1ad01'>%s</font>" % res
+        return html, res
+
+    def _block_index(self):
+        """
+        Returns (sorted list of start addresses, list of [Value], list of
+        stops) for all memory blocks of this region in the state.
+        stops[i] is the highest address + 1 covered by blocks 0..i, so that
+        blocks overlapping an address can be found by bisecting stops.
+        """
+        cache = self.page_cache
+        key = (self.state, self.region)
+        if cache.index_key is None or cache.index_key[0] is not self.state \
+                or cache.index_key[1] != self.region:
+            blocks = sorted((addr.value, vlist) for addr, vlist
+                            in self.state.regaddrs.iteritems()
+                            if addr.region == self.region)
+            stops = []
+            stop = 0
+            for start, vlist in blocks:
+                stop = max(stop, start + len(vlist))
+                stops.append(stop)
+            cache.index = ([b[0] for b in blocks], [b[1] for b in blocks],
+                           stops)
+            cache.index_key = key
+        return cache.index
+
+    def _page(self, abs_addr):
+        """
+        Returns rendered (html list, char list, type list) for the page
+        containing abs_addr.
+        """
+        page_size = MemPageCache.PAGE_SIZE
+        page_start = abs_addr - abs_addr % page_size
+        key = (self.state, self.region, page_start)
+        page = self.page_cache.get(key)
+        if page is not None:
+            return page
+        # undefined bytes
+        html = [""] * page_size
+        chars = [""] * page_size
+        types = [""] * page_size
+        page_stop = page_start + page_size
+        rendered = self.page_cache.rendered
+        if len(rendered) > 0x10000:
+            rendered.clear()
+        starts, vlists, stops = self._block_index()
+        # first block that may overlap the page, including blocks starting
+        # before a shorter block that precedes the page
+        bidx = bisect.bisect_right(stops, page_start)
+        while bidx < len(starts) and starts[bidx] < page_stop:
+            bstart = starts[bidx]
+            vlist = vlists[bidx]
+            bidx += 1
+            for addr in xrange(max(bstart, page_start),
+                               min(bstart + len(vlist), page_stop)):
+                value = vlist[addr - bstart]
+                if value is None:
+                    res = ("__", "_")
                 else:
-                    res = '.'
-            else:
-                res = "?"
-            # taint
-            if value.ttop != 0 or value.tbot != 0:
-                # top or bot
-                res = "<font color='blue'>%s</font>" % res
-            elif value.taint == 0:
-                pass
-            elif value.taint == 0xFF:
-                res = "<font color='green'>%s</font>" % res
-            else:
-                res = "<font color='#c1ad01'>%s</font>" % res
+                    res = rendered.get(value)
+                    if res is None:
+                        res = rendered[value] = self.render_byte(value)
+                html[addr - page_start], chars[addr - page_start] = res
+        for addr, t in self.state.regtypes.iteritems():
+            if (t and addr.region == self.region and
+                    page_start <= addr.value < page_stop):
+                types[addr.value - page_start] = t[0]
+        page = (html, chars, types)
+        self.page_cache.put(key, page)
+        return page
+
+    def _rendered(self, idx, col):
+        abs_addr = self.abs_addr_from_idx(idx)
+        if not abs_addr:
+            # outside of displayed ranges
+            return ""
+        if self.state is None or not any(
+                start <= abs_addr <= stop for start, stop in self.ranges):
+            # between two ranges
+            return ("__", "_", "")[col]
+        return self._page(abs_addr)[col][abs_addr % MemPageCache.PAGE_SIZE]
 
-        self.char_cache[idx] = res
-        return res
+    def char(self, idx):
+        """ relative get of ASCII char """
+        return self._rendered(idx, 1)
 
     def html_color(self, idx):
-        # often used => cache
-        if idx in self.html_cache:
-            return self.html_cache[idx]
-        try:
-            values = self[idx]
-        except IndexError:
-            return ""
-        if not values or values[0] is None:
-            res = "__"
-        else:
-            res = Meminfo.color_valtaint(
-                values[0].__valuerepr__(16, True),
-                values[0].__taintrepr__(16, True))
-        self.html_cache[idx] = res
-        return res
+        return self._rendered(idx, 0)
 
     def hexstr(self, idx):
         if isinstance(idx, slice):
@@ -253,18 +368,7 @@ class Meminfo(object):
         return res
 
     def get_type(self, idx):
-        abs_addr = self.abs_addr_from_idx(idx)
-        if not abs_addr:
-            return ""
-        addr_value = cfa.Value(self.region, abs_addr, 32)
-        in_range = filter(
-            lambda r: abs_addr >= r[0] and abs_addr <= r[1], self.ranges)
-        if not in_range:
-            return ""
-        t = self.state.regtypes.get(addr_value, None)
-        if t:
-            return t[0]
-        return ""
+        return self._rendered(idx, 2)
 
     def abs_addr_from_idx(self, idx):
         """
@@ -291,6 +395,8 @@ class BinCATMemForm_t(idaapi.PluginForm):
         self.mem_ranges = None
         self.current_region = None
         self.current_range_idx = None
+        #: rendered memory pages, shared by successive Meminfo objects
+        self.page_cache = MemPageCache()
         #: region name (1 letter) -> address
         self.last_visited = dict((k, None) for k in cfa.PRETTY_REGIONS.keys())
         self.pretty_to_int_map = \
@@ -346,7 +452,8 @@ class BinCATMemForm_t(idaapi.PluginForm):
         new_range = self.mem_ranges[cur_reg][crangeidx]
         # XXX only create a new Meminfo object on EA change, load ranges from
         # state in Meminfo __init__ ?
-        meminfo = Meminfo(self.s.current_state, cur_reg, [new_range])
+        meminfo = Meminfo(self.s.current_state, cur_reg, [new_range],
+                          self.page_cache)
         self.hexwidget.setNewMem(meminfo)
         self.last_visited[cur_reg] = new_range[0]
 
@@ -402,18 +509,8 @@ class BinCATMemForm_t(idaapi.PluginForm):
             return
 
         if self.s.current_state:
-            self.mem_ranges = self.s.current_state.mem_ranges()
             # merge region separated by less than 0x100 bytes
-            for region in self.mem_ranges:
-                last_addr = None
-                merged = []
-                for start, stop in self.mem_ranges[region]:
-                    if last_addr and start - last_addr < 0x100:
-                        merged[-1] = (merged[-1][0], stop)
-                    else:
-                        merged.append((start, stop))
-                    last_addr = stop
-                self.mem_ranges[region] = merged
+            self.mem_ranges = self.s.current_state.mem_ranges(gap=0xfe)
 
             if not self.mem_ranges:
                 # happens in backward mode: states having no defined memory
@@ -474,6 +571,8 @@ class BinCATConfigForm_t(idaapi.PluginForm):
         self.created = False
         self.s = state
         self.index = None
+        #: analysis progress, displayed next to the Start button
+        self.status = ""
 
     def OnCreate(self, form):
         self.created = True
@@ -642,6 +741,10 @@ class BinCATConfigForm_t(idaapi.PluginForm):
         self.btn_start.clicked.connect(self.launch_analysis)
         btn_split.addWidget(self.btn_start)
 
+        # Analysis progress
+        self.lbl_status = QtWidgets.QLabel(self.status)
+        btn_split.addWidget(self.lbl_status)
+
         self.chk_remap = QtWidgets.QCheckBox('&Remap binary')
         # Only check by default if the file is not an ELF
         if ConfigHelpers.get_file_type() != "elf":
@@ -749,20 +852,22 @@ class BinCATConfigForm_t(idaapi.PluginForm):
             self._save_config()
 
         if self.chk_remap.isChecked():
-            if (self.s.remapped_bin_path is None or
-                    not os.path.isfile(self.s.remapped_bin_path)):
+            fname = self.s.remapped_bin_path
+            if fname is None or not os.path.isfile(fname):
                 fname = ConfigHelpers.askfile(None, "Save remapped binary")
                 if not fname:
                     bc_log.error(
                         'No filename provided. You can provide a filename or '
                         'uncheck the "Remap binary" option.')
                     return
-                sections = dump_binary(fname)
-                if not sections:
-                    bc_log.error("Could not remap binary")
-                    return
-                self.s.remapped_bin_path = fname
-                self.s.remapped_sections = sections
+            # skipped if the IDB has not changed since the last dump, else
+            # only segments that have changed are written again
+            sections = dump_binary(fname, self.s.dump_tracker)
+            if not sections:
+                bc_log.error("Could not remap binary")
+                return
+            self.s.remapped_bin_path = fname
+            self.s.remapped_sections = sections
             self.s.remap_binary = True
             self.s.edit_config.binary_filepath = self.s.remapped_bin_path
             self.s.edit_config.format = "manual"
@@ -882,6 +987,11 @@ class BinCATConfigForm_t(idaapi.PluginForm):
         if editdlg.exec_() == QtWidgets.QDialog.Accepted:
             self.update_from_edit_config()
 
+    def set_status(self, text):
+        self.status = text
+        if self.shown:
+            self.lbl_status.setText(text)
+
     def OnClose(self, form):
         self.shown = False
 
@@ -1369,6 +1479,15 @@ class ValueTaintModel(QtCore.QAbstractTableModel):
         #: list of Value (addresses)
         self.rows = []
         self.changed_rows = set()
+        #: per row: (register name, rendered value)
+        self.display = []
+        #: per row: tooltip (register type), or None
+        self.tooltips = []
+        #: per row: (register name font, value font)
+        self.fonts = []
+        #: register value (tuple of (Value, length)) -> rendered value. Shared
+        #: by all nodes, since most registers do not change between nodes.
+        self.rendered = {}
         self.default_font = QtGui.QFont("AnyStyle")
         self.mono_font = QtGui.QFont("Monospace")
         self.diff_font = QtGui.QFont("AnyStyle", weight=QtGui.QFont.Bold)
@@ -1403,26 +1522,78 @@ class ValueTaintModel(QtCore.QAbstractTableModel):
         else:
             return (2, row)
 
+    @staticmethod
+    def render_value(v):
+        """
+        Returns the HTML representation of the value and taint of a register
+        """
+        concatv = v[0]
+        strval = ''
+        for idx, nextv in enumerate(v[1:]):
+            if idx > 50:
+                strval = concatv.__valuerepr__(16, True) + '...'
+                break
+            concatv = concatv & nextv
+        if not strval:
+            strval = concatv.__valuerepr__(16, True)
+        concatv = v[0]
+        strtaint = ''
+        for idx, nextv in enumerate(v[1:]):
+            if idx > 50:
+                strtaint = concatv.__taintrepr__(16, True) + '...'
+                break
+            concatv = concatv & nextv
+        if not strtaint:
+            strtaint = concatv.__taintrepr__(16, True)
+        if strtaint != "":
+            strval = Meminfo.color_valtaint(strval, strtaint)
+        return strval
+
     def endResetModel(self):
         """
-        Rebuild a list of rows
+        Rebuild a list of rows, and precompute everything that is displayed
         """
         state = self.s.current_state
         #: list of Values (addresses)
         self.rows = []
         self.changed_rows = set()
+        self.display = []
+        self.tooltips = []
+        self.fonts = []
         if state:
             self.rows = filter(lambda x: x.region == "reg", state.regaddrs)
             self.rows = sorted(self.rows, key=ValueTaintModel.rowcmp)
+            row_index = dict((regaddr, idx)
+                             for idx, regaddr in enumerate(self.rows))
 
             # find parent state
-            parents = [nodeid for nodeid in self.s.cfa.edges
-                       if state.node_id in self.s.cfa.edges[nodeid]]
+            parents = self.s.cfa.parent_node_ids(state.node_id)
             for pnode in parents:
                 pstate = self.s.cfa[pnode]
                 for k in state.list_modified_keys(pstate):
-                    if k in self.rows:
-                        self.changed_rows.add(self.rows.index(k))
+                    if k in row_index:
+                        self.changed_rows.add(row_index[k])
+
+            if len(self.rendered) > 10000:
+                self.rendered = {}
+            regtypes = state.regtypes
+            for idx, regaddr in enumerate(self.rows):
+                v = state[regaddr]
+                if v:
+                    key = tuple((val, val.length) for val in v)
+                    strval = self.rendered.get(key)
+                    if strval is None:
+                        strval = self.render_value(v)
+                        self.rendered[key] = strval
+                else:
+                    strval = ""
+                self.display.append((str(regaddr.value), strval))
+                t = regtypes.get(regaddr, None)
+                self.tooltips.append(t[0] if t else None)
+                if idx in self.changed_rows:
+                    self.fonts.append((self.diff_font, self.diff_font_mono))
+                else:
+                    self.fonts.append((self.default_font, self.mono_font))
 
         super(ValueTaintModel, self).endResetModel()
 
@@ -1440,53 +1611,11 @@ class ValueTaintModel(QtCore.QAbstractTableModel):
             # XXX not obeyed. why?
             return QtCore.QSize(self.colswidths[col], 20)
         elif role == Qt.FontRole:
-            if index.row() in self.changed_rows:
-                if col in [1, 3]:
-                    return self.diff_font_mono
-                else:
-                    return self.diff_font
-            else:
-                if col in [1, 3]:
-                    return self.mono_font
-                else:
-                    return self.default_font
+            return self.fonts[index.row()][col]
         elif role == Qt.ToolTipRole:
-            regaddr = self.rows[index.row()]
-            t = self.s.current_state.regtypes.get(regaddr, None)
-            if t:
-                return t[0]
-            return
-        elif role != Qt.DisplayRole:
-            return
-        regaddr = self.rows[index.row()]
-
-        if col == 0:  # register name
-            return str(regaddr.value)
-        v = self.s.current_state[regaddr]
-        if not v:
-            return ""
-        if col == 1:  # value
-            concatv = v[0]
-            strval = ''
-            for idx, nextv in enumerate(v[1:]):
-                if idx > 50:
-                    strval = concatv.__valuerepr__(16, True) + '...'
-                    break
-                concatv = concatv & nextv
-            if not strval:
-                strval = concatv.__valuerepr__(16, True)
-            concatv = v[0]
-            strtaint = ''
-            for idx, nextv in enumerate(v[1:]):
-                if idx > 50:
-                    strtaint = concatv.__taintrepr__(16, True) + '...'
-                    break
-                concatv = concatv & nextv
-            if not strtaint:
-                strtaint = concatv.__taintrepr__(16, True)
-            if strtaint != "":
-                strval = Meminfo.color_valtaint(strval, strtaint)
-            return strval
+            return self.tooltips[index.row()]
+        elif role == Qt.DisplayRole:
+            return self.display[index.row()][col]
 
     def rowCount(self, parent):
         return len(self.rows)
@@ -1803,7 +1932,7 @@ class HandleRemap(idaapi.action_handler_t):
         # display config window
         fname = ConfigHelpers.askfile("*.*", "Save to binary")
         if fname:
-            dump_binary(fname)
+            dump_binary(fname, self.state.dump_tracker)
             self.state.remapped_bin_path = fname
         return 1
 
@@ -1934,6 +2063,17 @@ class GUI(object):
         self.BinCATMemForm.Show()
         self.BinCATConfigForm.Show()
 
+    def set_analysis_status(self, text):
+        self.BinCATConfigForm.set_status(text)
+
+    def results_shown(self):
+        """
+        True if a view displaying analysis results is shown
+        """
+        return (self.BinCATRegistersForm.shown or
+                self.BinCATMemForm.shown or
+                self.BinCATDebugForm.shown)
+
     def before_change_ea(self):
         self.vtmodel.beginResetModel()
 
@@ -25,7 +25,7 @@
 import base64
 import binascii
 import logging
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 from PyQt5.QtGui import QColor
 from PyQt5.QtGui import QIcon
@@ -69,10 +69,44 @@ bc_log = logging.getLogger('bincat.hexview')
 bc_log.setLevel(logging.DEBUG)
 
 
-class HexItemDelegate(QStyledItemDelegate):
-    pixcache = {}
+class PixmapCache(object):
+    """
+    LRU cache of rendered cells, bounded by the memory used by pixmaps.
+    Keys are (rendered text, highlighted, width, height).
+    """
+    def __init__(self, max_bytes=32*1024*1024):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self._pixmaps = OrderedDict()
+
+    @staticmethod
+    def _size(pixmap):
+        return pixmap.width() * pixmap.height() * 4
+
+    def get(self, key):
+        pixmap = self._pixmaps.pop(key, None)
+        if pixmap is not None:
+            # most recently used
+            self._pixmaps[key] = pixmap
+        return pixmap
+
+    def put(self, key, pixmap):
+        old = self._pixmaps.pop(key, None)
+        if old is not None:
+            self.used_bytes -= self._size(old)
+        self._pixmaps[key] = pixmap
+        self.used_bytes += self._size(pixmap)
+        while self.used_bytes > self.max_bytes and len(self._pixmaps) > 1:
+            _, evicted = self._pixmaps.popitem(last=False)
+            self.used_bytes -= self._size(evicted)
+
+    def clear(self):
+        self._pixmaps.clear()
+        self.used_bytes = 0
 
-    def __init__(self, model, parent, *args):
+
+class HexItemDelegate(QStyledItemDelegate):
+    def __init__(self, model, parent, pixcache=None, *args):
         super(HexItemDelegate, self).__init__(parent)
         # compute size hint for hex view
         dh = QTextDocument()
@@ -83,13 +117,18 @@ class HexItemDelegate(QStyledItemDelegate):
         dc.setHtml("W")
         self.char_hint = QtCore.QSize(dc.idealWidth()-dc.documentMargin(), 22)
         self._model = model
+        if pixcache is None:
+            pixcache = PixmapCache()
+        self.pixcache = pixcache
 
     def get_pixmap(self, txt, hl, rect):
         """
-        store pixmap cache. Switch to LRU cache if too much memory is used.
+        Returns the pixmap for a cell, from the pixmap cache if possible.
         """
-        if (hl, txt) in HexItemDelegate.pixcache:
-            return HexItemDelegate.pixcache[(hl, txt)]
+        key = (txt, hl, rect.width(), rect.height())
+        pixmap = self.pixcache.get(key)
+        if pixmap is not None:
+            return pixmap
 
         # FIXME use correct size? on non-hdpi screen, 15x22 real size
         pixmap = QPixmap(rect.width(), rect.height())
@@ -107,7 +146,7 @@ class HexItemDelegate(QStyledItemDelegate):
         painter.begin(pixmap)
         doc.drawContents(painter)
         painter.end()
-        HexItemDelegate.pixcache[txt] = pixmap
+        self.pixcache.put(key, pixmap)
         return pixmap
 
     def paint(self, qpainter, option, qindex):
@@ -116,7 +155,7 @@ class HexItemDelegate(QStyledItemDelegate):
         qpainter.save()
 
         pixmap = self.get_pixmap(option.text,
-                                 option.state & QStyle.State_Selected,
+                                 bool(option.state & QStyle.State_Selected),
                                  option.rect)
 
         qpainter.translate(option.rect.left(), option.rect.top())
@@ -237,12 +276,18 @@ class HexTableModel(QAbstractTableModel):
             return None
 
     def _emit_data_changed(self, start_bindex, end_bindex):
-        for i in range(start_bindex, end_bindex):
-            # mark data changed to encourage re-rendering of cell
-            qib = self.index2qindexb(i)
-            qic = self.index2qindexc(i)
-            self.dataChanged.emit(qib, qib)
-            self.dataChanged.emit(qic, qic)
+        """
+        mark data changed to encourage re-rendering of cells, using one
+        signal per pane for the rows containing [start_bindex, end_bindex[
+        """
+        if end_bindex <= start_bindex:
+            return
+        first_row = self.index2qindexb(start_bindex).row()
+        last_row = self.index2qindexb(end_bindex - 1).row()
+        self.dataChanged.emit(self.index(first_row, 0),
+                              self.index(last_row, 0xf))
+        self.dataChanged.emit(self.index(first_row, 0x11),
+                              self.index(last_row, 0x20))
 
 
 class HexItemSelectionModel(QItemSelectionModel):
@@ -296,7 +341,6 @@ class HexItemSelectionModel(QItemSelectionModel):
             ......xxxxxx......
             ..................
          """
-        self.select(QItemSelection(), QItemSelectionModel.Clear)
         if start_bindex > end_bindex:
             start_bindex, end_bindex = end_bindex, start_bindex
 
@@ -328,7 +372,9 @@ class HexItemSelectionModel(QItemSelectionModel):
                           end_row_end_idx - 0x10)
             self._bselect(selection, end_row_start_idx, end_bindex)
 
-        self.select(selection, QItemSelectionModel.SelectCurrent)
+        # replace the previous selection in one step, so that only cells
+        # whose selection state changes are repainted
+        self.select(selection, QItemSelectionModel.ClearAndSelect)
         self.start = start_bindex
         self.end = end_bindex
         self.selectionRangeChanged.emit(end_bindex)
@@ -657,11 +703,24 @@ class HexViewWidget(QWidget, HexViewBase, LoggingObject):
         self.view.setFont(f)
         self.statusLabel.setFont(f)
 
-        self.view.setItemDelegate(HexItemDelegate(self._model, self))
+        #: rendered cells, shared by all delegates of this widget
+        self.pixcache = PixmapCache()
+        self.view.setItemDelegate(
+            HexItemDelegate(self._model, self, self.pixcache))
 
         self.statusLabel.setText("")
 
     def setNewMem(self, meminfo):
+        old = self._meminfo
+        if (old is not None and old.start == meminfo.start and
+                old.length == meminfo.length and
+                old.ranges[-1][1] == meminfo.ranges[-1][1]):
+            # same layout (ex. other state, same range): only repaint cells,
+            # keeping the scroll position and selection
+            self._meminfo = meminfo
+            self._model.setNewMem(meminfo)
+            self._model._emit_data_changed(0, meminfo.length)
+            return
         self._model.beginResetModel()
         self._meminfo = meminfo
         self._model.setNewMem(meminfo)
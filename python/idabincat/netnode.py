@@ -5,12 +5,19 @@
 
 import zlib
 import json
+import itertools
 import logging
+import StringIO
 
 import idaapi
 
 
 CHUNK_SIZE = 1024
+#: size of blocks read from files when storing binary values
+READ_BLOCK_SIZE = 64 * 1024
+#: prefix of binary (not JSON-encoded) values. zlib streams never start with
+#: a null byte.
+BINARY_MARKER = "\x00"
 OUR_NETNODE = "$ com.bincat"
 CHUNK_INDEX_TAG = "M"
 CHUNK_TAG = "N"
@@ -35,7 +42,10 @@ class Netnode(object):
       numbers, and allows values to be larger than 1024 bytes in length.
     
     This class supports keys that are numbers or strings. 
-    Values must be JSON-encodable.
+    Values must be JSON-encodable. Binary values (byte strings), stored using
+    set_binary or set_stream, are not JSON-encoded: they are returned as
+    str, and can be stored from and read as file-like objects (see
+    set_stream and open) without being fully loaded in memory.
    
     Implementation:
       The major limitation of the underlying netnode API is the fixed
@@ -43,6 +53,8 @@ class Netnode(object):
         bytes.
     
       The first enhancement is transparently zlib-encoding all values.
+      Binary values are stored as BINARY_MARKER followed by the zlib-encoded
+      value.
 
       To support arbitrarily sized values, we split the value data into
         chunks (each of length 1024), and store them in a separate
@@ -98,120 +110,182 @@ class Netnode(object):
     def _decode(data):
         return json.loads(data)
 
-    def __getitem__(self, key):
-        fget = None
+    def _accessors(self, key):
+        """
+        Returns (get, set) netnode functions to be used for key
+        """
         if isinstance(key, basestring):
-            fget = self._n.hashval
+            return self._n.hashval, self._n.hashset
         elif isinstance(key, (int, long)):
-            fget = self._n.supval
+            return self._n.supval, self._n.supset
         else:
             raise TypeError("cannot use {} as key".format(type(key)))
 
+    def _iter_chunks(self, key):
+        """
+        Yields stored chunks for key, one at a time
+        """
+        fget, _ = self._accessors(key)
         try:
             v = fget(key)
         except TypeError:
             raise KeyError("'{}' not found".format(key))
         if v is None:
             raise KeyError("'{}' not found".format(key))
+        return self._iter_chunk_run(key, v)
 
-        if len(v) == CHUNK_SIZE:
-            chunks = [v]
-            index_refs = fget(key, CHUNK_INDEX_TAG)
-            if index_refs is not None:
-                first, last = self._decode(self._decompress(index_refs))
-                g_logger.debug("get: chunk run: 0x%x to 0x%x (0x%x chunks)",
-                               first, last, last-first+1)
-                for index_ref in range(first, last + 1):
-                    chunk = self._n.supval(index_ref, CHUNK_TAG)
-                    chunks.append(chunk)
-            g_logger.debug("get: fetched 0x%x chunks", len(chunks))
-            g_logger.debug("get: data length: 0x%x", len("".join(chunks)))
-            return self._decode(self._decompress("".join(chunks)))
-        else:
-            return self._decode(self._decompress(v))
-
-    def __setitem__(self, key, value):
-        fset = None
-        fget = None
-        flast = None
+    def _iter_chunk_run(self, key, v):
+        fget, _ = self._accessors(key)
+        yield v
+        if len(v) != CHUNK_SIZE:
+            return
+        index_refs = fget(key, CHUNK_INDEX_TAG)
+        if index_refs is None:
+            return
+        first, last = self._decode(self._decompress(index_refs))
+        g_logger.debug("get: chunk run: 0x%x to 0x%x (0x%x chunks)",
+                       first, last, last-first+1)
+        for index_ref in xrange(first, last + 1):
+            yield self._n.supval(index_ref, CHUNK_TAG)
+
+    def _delete_chunk_run(self, key):
+        fget, _ = self._accessors(key)
+        index_refs = fget(key, CHUNK_INDEX_TAG)
+        if index_refs is None:
+            return
+        first, last = self._decode(self._decompress(index_refs))
+        for index_ref in range(first, last + 1):
+            self._n.supdel(index_ref, CHUNK_TAG)
         if isinstance(key, basestring):
-            fset = self._n.hashset
-            fget = self._n.hashval
-            flast = self._n.hashlast
-        elif isinstance(key, (int, long)):
-            fset = self._n.supset
-            fget = self._n.supval
-            flast = self._n.suplast
+            self._n.hashdel(key, CHUNK_INDEX_TAG)
         else:
-            raise TypeError("cannot use {} as key".format(type(key)))
+            self._n.supdel(key, CHUNK_INDEX_TAG)
+
+    def __getitem__(self, key):
+        chunks = self._iter_chunks(key)
+        first_chunk = next(chunks)
+        if first_chunk.startswith(BINARY_MARKER):
+            return self.open(key).read()
+        data = "".join(itertools.chain([first_chunk], chunks))
+        g_logger.debug("get: data length: 0x%x", len(data))
+        return self._decode(self._decompress(data))
+
+    def open(self, key):
+        """
+        Returns a read-only file-like object for the value stored at key.
+        Binary values are decompressed chunk by chunk while being read.
+        """
+        chunks = self._iter_chunks(key)
+        first_chunk = next(chunks)
+        if not first_chunk.startswith(BINARY_MARKER):
+            # JSON-encoded value
+            value = self[key]
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            return StringIO.StringIO(value)
+        return NetnodeReader(
+            itertools.chain([first_chunk[len(BINARY_MARKER):]], chunks))
 
+    def __setitem__(self, key, value):
         d = self._compress(self._encode(value))
         g_logger.debug("set: data length: 0x%x", len(d))
- 
+        self._store_chunks(
+            key, (d[i:i+CHUNK_SIZE] for i in xrange(0, len(d), CHUNK_SIZE)))
+
+    def set_binary(self, key, value):
+        """
+        Stores byte string value as a binary value
+        """
+        self.set_stream(key, StringIO.StringIO(value))
+
+    def set_stream(self, key, fileobj):
+        """
+        Stores the contents of fileobj as a binary value. Data is read and
+        compressed by blocks, so that memory usage does not depend on the
+        value size.
+        """
+        self._store_chunks(key, self._compress_stream(fileobj))
+
+    @staticmethod
+    def _compress_stream(fileobj):
+        """
+        Yields CHUNK_SIZE long chunks of compressed data read from fileobj,
+        the last chunk may be shorter.
+        """
+        compressor = zlib.compressobj()
+        pending = [BINARY_MARKER]
+        pending_len = len(BINARY_MARKER)
+        finished = False
+        while not finished:
+            data = fileobj.read(READ_BLOCK_SIZE)
+            if data:
+                data = compressor.compress(data)
+            else:
+                data = compressor.flush()
+                finished = True
+            pending.append(data)
+            pending_len += len(data)
+            if pending_len >= CHUNK_SIZE:
+                buf = "".join(pending)
+                end = len(buf) - len(buf) % CHUNK_SIZE
+                for i in xrange(0, end, CHUNK_SIZE):
+                    yield buf[i:i+CHUNK_SIZE]
+                pending = [buf[end:]]
+                pending_len = len(pending[0])
+        if pending_len:
+            yield "".join(pending)
+
+    def _store_chunks(self, key, chunks):
+        """
+        Stores first chunk in the default hashval/supval table, and the
+        following ones in a contiguous run of the CHUNK_TAG supval table.
+        """
+        _, fset = self._accessors(key)
+        # delete existing chunks
+        self._delete_chunk_run(key)
+
         # always store first chunk in the hashval table
-        fset(key, d[:CHUNK_SIZE])
+        try:
+            first_chunk = next(chunks)
+        except StopIteration:
+            first_chunk = ""
+        fset(key, first_chunk)
 
         # store remaining chunks in the supval table CHUNK_TAG.
         # indices are stored in the hashval table CHUNK_INDEX_TAG
         # using `key`.
-        if len(d) > 1024:
-            # delete existing chunks
-            index_refs = fget(key, CHUNK_INDEX_TAG)
-            if index_refs is not None:
-                first, last = self._decode(self._decompress(index_refs))
-                for index_ref in range(first, last + 1):
-                    self._n.supdel(index_ref, CHUNK_TAG)
-
-            # add each chunk of data to the next available supval slot
-            chunk_refs = []
-            for i in range(CHUNK_SIZE, len(d), CHUNK_SIZE):
-                chunk = d[i:i+CHUNK_SIZE]
-
-                # race, but we're already dealing with writing to the IDB...
-                # note: we assume all these allocations are continuous!
-                chunk_ref = self._n.suplast(CHUNK_TAG)
-                if chunk_ref == idaapi.BADNODE or chunk_ref is None:
-                    chunk_ref = 0
-                chunk_ref += 1
-
-                self._n.supset(chunk_ref, chunk, CHUNK_TAG)
-                chunk_refs.append(chunk_ref)
-
-            first = chunk_refs[0]
-            last = chunk_refs[-1]
-            g_logger.debug("set: chunk run: 0x%x to 0x%x (0x%x chunks)",
-                           first, last, last-first+1)
-            refs = self._compress(self._encode((first, last)))
-            
-            if len(refs) > CHUNK_SIZE:
-                raise BufferError()
-
-            fset(key, refs, CHUNK_INDEX_TAG)
+        # allocate a run starting after the last used supval slot
+        first = self._n.suplast(CHUNK_TAG)
+        if first == idaapi.BADNODE or first is None:
+            first = 0
+        first += 1
+        last = first - 1
+        for chunk in chunks:
+            last += 1
+            self._n.supset(last, chunk, CHUNK_TAG)
+        if last < first:
+            return
+
+        g_logger.debug("set: chunk run: 0x%x to 0x%x (0x%x chunks)",
+                       first, last, last-first+1)
+        refs = self._compress(self._encode((first, last)))
+
+        if len(refs) > CHUNK_SIZE:
+            raise BufferError()
+
+        fset(key, refs, CHUNK_INDEX_TAG)
 
     def __delitem__(self, key):
         if key not in self:
             raise KeyError("'{}' not found".format(key))
 
-        fdel = None
-        fget = None
         if isinstance(key, basestring):
-            fdel = self._n.hashdel
-            fget = self._n.hashval
-        elif isinstance(key, (int, long)):
-            fdel = self._n.supdel
-            fget = self._n.supval
+            self._n.hashdel(key)
         else:
-            raise TypeError("cannot use {} as key".format(type(key)))
+            self._n.supdel(key)
 
-        fdel(key)
-        
         # delete existing chunks
-        index_refs = fget(key, CHUNK_INDEX_TAG)
-        if index_refs is not None:
-            first, last = self._decode(self._decompress(index_refs))
-            for index_ref in range(first, last + 1):
-                self._n.supdel(index_ref, CHUNK_TAG)
-            fdel(key, CHUNK_INDEX_TAG)
+        self._delete_chunk_run(key)
 
     def get(self, key, default=None):
         try:
@@ -220,6 +294,13 @@ class Netnode(object):
             return default
 
     def __contains__(self, key):
+        try:
+            first_chunk = next(self._iter_chunks(key))
+        except (KeyError, TypeError):
+            return False
+        if first_chunk.startswith(BINARY_MARKER):
+            # binary values are never None, do not decompress them
+            return True
         try:
             if self[key] is not None:
                 return True
@@ -260,3 +341,67 @@ class Netnode(object):
         self._n.kill()
         self._n = idaapi.netnode(self._netnode_name, 0, True)
 
+
+class NetnodeReader(object):
+    """
+    Read-only file-like object, decompresses binary netnode values chunk by
+    chunk.
+    """
+    def __init__(self, chunks):
+        #: iterator on compressed chunks
+        self._chunks = chunks
+        self._decompressor = zlib.decompressobj()
+        #: decompressed data that has not been read yet
+        self._buf = ""
+        self._eof = False
+
+    def _fill(self):
+        """
+        Decompresses the next chunk. Returns False if there is no data left.
+        """
+        if self._eof:
+            return False
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._eof = True
+            self._buf += self._decompressor.flush()
+            return True
+        self._buf += self._decompressor.decompress(chunk)
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = [self._buf]
+            self._buf = ""
+            while self._fill():
+                data.append(self._buf)
+                self._buf = ""
+            return "".join(data)
+        while len(self._buf) < size and self._fill():
+            pass
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def readline(self):
+        while "\n" not in self._buf and self._fill():
+            pass
+        pos = self._buf.find("\n") + 1
+        if pos == 0:
+            pos = len(self._buf)
+        data, self._buf = self._buf[:pos], self._buf[pos:]
+        return data
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self._chunks = iter(())
+        self._buf = ""
+        self._eof = True
@@ -16,10 +16,14 @@
     along with BinCAT.  If not, see <http://www.gnu.org/licenses/>.
 """
 # This file can be also used as an IDA script.
+import distutils.spawn
+import os
 import re
 import tempfile
 import os.path
+import hashlib
 import logging
+import shutil
 import subprocess
 try:
     import idaapi
@@ -35,6 +39,89 @@ class NpkGenException(Exception):
     pass
 
 
+def toolchain_id():
+    """
+    Returns a string identifying the tools used by NpkGen.generate_tnpk,
+    which changes when they are upgraded
+    """
+    ids = []
+    for prog in ("gcc", "c2newspeak"):
+        path = distutils.spawn.find_executable(prog)
+        if path is None:
+            ids.append("%s:missing" % prog)
+        else:
+            st = os.stat(path)
+            ids.append("%s:%s:%d:%d" % (prog, path, st.st_size,
+                                        st.st_mtime))
+    return ";".join(ids)
+
+
+class TnpkCache(object):
+    """
+    Content-addressed cache of generated .no files. Keys are computed from
+    the headers contents and from an identifier of the toolchain used to
+    compile them.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def key(headers_data, toolchain):
+        h = hashlib.sha256()
+        h.update(toolchain)
+        h.update("\0")
+        h.update(headers_data)
+        return h.hexdigest()
+
+    def _fname(self, key):
+        return os.path.join(self.path, key + ".no")
+
+    def workdir(self):
+        """
+        Returns a new temporary directory in the cache, to be used for
+        compilation intermediates. The caller must remove it.
+        """
+        tmp_path = os.path.join(self.path, "tmp")
+        if not os.path.isdir(tmp_path):
+            os.makedirs(tmp_path)
+        return tempfile.mkdtemp('bincat-generate-header', dir=tmp_path)
+
+    def get(self, key, destfname):
+        """
+        Copies the cached file for key to destfname. Returns True on success.
+        """
+        cached = self._fname(key)
+        if not os.path.isfile(cached):
+            return False
+        try:
+            shutil.copyfile(cached, destfname)
+        except (IOError, OSError):
+            npk_log.warning("Could not copy cached TNPK file %s", cached,
+                            exc_info=True)
+            return False
+        return True
+
+    def put(self, key, fname):
+        """
+        Adds a copy of fname to the cache
+        """
+        tmp = None
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            # copy then rename, so that incomplete files are never used
+            with tempfile.NamedTemporaryFile(
+                    dir=self.path, suffix=".tmp", delete=False) as tmp:
+                with open(fname, 'rb') as src:
+                    shutil.copyfileobj(src, tmp)
+            os.rename(tmp.name, self._fname(key))
+        except (IOError, OSError):
+            npk_log.warning("Could not store TNPK file in cache %s",
+                            self.path, exc_info=True)
+            if tmp is not None and os.path.exists(tmp.name):
+                os.remove(tmp.name)
+
+
 class NpkGen(object):
 
     def get_header_data(self):
@@ -52,9 +139,8 @@ class NpkGen(object):
         for ordinal in range(0, nimps):
             idaapi.enum_import_names(ordinal, self.imp_cb)
 
-        # Fix local types by iterating until all types are defined
-        while self.add_types() > 0:
-            pass
+        # Fix local types: import all types they depend on
+        self.add_types()
 
         class str_sink(idaapi.text_sink_t):
             """
@@ -62,26 +148,21 @@ class NpkGen(object):
             """
             def __init__(self):
                 idaapi.text_sink_t.__init__(self)
-                self.text = ""
+                self.parts = []
 
             def _print(self, defstr):
-                self.text += defstr
+                self.parts.append(defstr)
                 return 0
 
             def res(self):
-                return self.text
+                return "".join(self.parts)
         sink = str_sink()
         idaapi.print_decls(
             sink, idaapi.cvar.idati, [],
             idaapi.PDF_INCL_DEPS | idaapi.PDF_DEF_FWD | idaapi.PDF_DEF_BASE)
 
         # Generate fixed .h
-        res = sink.res()
-        for s in self.structs:
-            if "struct " not in s:
-                search = r"(^\s*(?:typedef )?)\b%s\b" % s
-                res = re.sub(
-                    search, r"\1struct %s" % s, res, flags=re.MULTILINE)
+        res = self.fix_structs(sink.res())
         res += "\n\n"+"\n".join(self.imports)
         res = re.sub(r"__attribute__.*? ", " ", res)
 
@@ -89,12 +170,15 @@ class NpkGen(object):
 
         return res
 
-    def generate_tnpk(self, imports_data="", destfname=None):
+    def generate_tnpk(self, imports_data="", destfname=None, dirname=None):
+        """
+        :param dirname: directory where intermediate files are written,
+            defaults to a new temporary directory
+        """
         # required: c2newspeak requires a file, checks its extension
-        dirname = tempfile.mkdtemp('bincat-generate-header')
+        if dirname is None:
+            dirname = tempfile.mkdtemp('bincat-generate-header')
         npk_log.debug("Generating TNPK file in %s", dirname)
-        cwd = os.getcwd()
-        os.chdir(dirname)
 
         # 1. get imports_data
         if not imports_data:
@@ -125,9 +209,10 @@ class NpkGen(object):
         if destfname is None:
             destfname = os.path.join(dirname, "pre-processed.no")
         try:
+            # do not chdir: this may be run concurrently, from webbincat
             out = subprocess.check_output(
                 ["c2newspeak", "--typed-npk", "-o", destfname,
-                 "pre-processed.c"], stderr=subprocess.STDOUT)
+                 "pre-processed.c"], cwd=dirname, stderr=subprocess.STDOUT)
             if out:
                 npk_log.debug(out)
         except OSError as e:
@@ -144,7 +229,6 @@ class NpkGen(object):
             npk_log.error(error_msg, exc_info=True)
             raise NpkGenException(error_msg)
         # output is in destfname
-        os.chdir(cwd)
         npk_log.debug("TNPK file has been successfully generated.")
         return destfname
 
@@ -188,11 +272,12 @@ class NpkGen(object):
         """
         # print "analyze_type : "+str(tinfo)
         has_new_type = False
-        if str(tinfo) in self.seen:
+        type_name = str(tinfo)
+        if type_name in self.seen:
             return False
         else:
-            self.seen.add(str(tinfo))
-            self.import_name(str(tinfo))
+            self.seen.add(type_name)
+            self.import_name(type_name)
             has_new_type = True
 
         # Struct or union ? Walk members
@@ -203,9 +288,9 @@ class NpkGen(object):
             # this hack seems to fix it (maybe we could use
             # get_next_type_name)
             # print "---\t %s %s" % (tinfo.get_final_type_name(), str(tinfo))
-            if tinfo.get_final_type_name() == str(tinfo):
+            if tinfo.get_final_type_name() == type_name:
                 # print "adding to structs"
-                self.structs.add(str(tinfo))
+                self.structs.add(type_name)
 
             u = idaapi.udt_member_t()
             # struct members
@@ -237,14 +322,40 @@ class NpkGen(object):
         return has_new_type
 
     def add_types(self):
+        """
+        Analyzes each local type once. Types imported while doing so are
+        appended to local types, they are analyzed in turn until no new type
+        is added.
+        Returns the number of local types that added new types.
+        """
         local_type = idaapi.tinfo_t()
         count = 0
-        for ordinal in range(1, idaapi.get_ordinal_qty(idaapi.cvar.idati)):
-            local_type.get_numbered_type(idaapi.cvar.idati, ordinal)
-            if self.analyze_type(local_type):
-                count += 1
+        next_ordinal = 1
+        qty = idaapi.get_ordinal_qty(idaapi.cvar.idati)
+        while next_ordinal < qty:
+            for ordinal in range(next_ordinal, qty):
+                local_type.get_numbered_type(idaapi.cvar.idati, ordinal)
+                if self.analyze_type(local_type):
+                    count += 1
+            # only visit types that have just been imported
+            next_ordinal = qty
+            qty = idaapi.get_ordinal_qty(idaapi.cvar.idati)
         return count
 
+    def fix_structs(self, header):
+        """
+        Adds the missing "struct" keyword in front of struct names used at
+        the beginning of a line, for all structs at once
+        """
+        names = [s for s in self.structs if "struct " not in s]
+        if not names:
+            return header
+        # longest names first, so that prefixes do not shadow them
+        names.sort(key=len, reverse=True)
+        search = r"(^\s*(?:typedef )?)\b(%s)\b" % "|".join(
+            re.escape(name) for name in names)
+        return re.sub(search, r"\1struct \2", header, flags=re.MULTILINE)
+
 
 if __name__ == '__main__':
     NpkGen().generate_tnpk()
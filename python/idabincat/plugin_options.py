@@ -47,6 +47,10 @@ class PluginOptions(object):
         def_options = {
             "save_to_idb": "False",  # config only - results are always saved
             "load_from_idb": "True",
+            "lazy_load_from_idb": "True",
+            "prefetch_depth": "2",  # config only
+            "prefetch_max_states": "64",  # config only
+            "max_parsed_states": "4096",  # config only
             "server_url": "http://localhost:5000",
             "web_analyzer": "False",
             "autostart": "False"}
@@ -18,20 +18,25 @@
 
 import subprocess
 import ConfigParser
-from collections import defaultdict
+from collections import defaultdict, namedtuple, OrderedDict
 import re
 from pybincat.tools import parsers
 from pybincat import PyBinCATException
 import tempfile
 import functools
+import marshal
+import threading
 
 
-def reg_len(regname):
+def reg_len(regname, arch=None):
     """
-    Returns register length in bits. CFA.arch must have been set, either
-    manually or by parsing a bincat output file.
+    Returns register length in bits. If arch is not provided, CFA.arch must
+    have been set, either manually or by running an analysis using
+    CFA.from_filenames.
     """
-    if CFA.arch == "armv8":
+    if arch is None:
+        arch = CFA.arch
+    if arch == "armv8":
         return {
             "x0": 64, "x1": 64, "x2": 64, "x3": 64, "x4": 64, "x5": 64,
             "x6": 64, "x7": 64, "x8": 64, "x9": 64, "x10": 64, "x11": 64,
@@ -46,13 +51,13 @@ def reg_len(regname):
             "q24": 128, "q25": 128, "q26": 128, "q27": 128, "q28": 128, "q29": 128,
             "q30": 128, "q31": 128,
             "pc": 64, "xzr":64,"c": 1, "n": 1, "v": 1, "z": 1}[regname]
-    elif CFA.arch == "armv7":
+    elif arch == "armv7":
         return {
             "r0": 32, "r1": 32, "r2": 32, "r3": 32, "r4": 32, "r5": 32,
             "r6": 32, "r7": 32, "r8": 32, "r9": 32, "r10": 32, "r11": 32,
             "r12": 32, "sp": 32, "lr": 32, "pc": 32, "itstate": 8,
             "c": 1, "n": 1, "v": 1, "z": 1, "t": 1}[regname]
-    elif CFA.arch == "x86":
+    elif arch == "x86":
         return {
             "eax": 32, "ebx": 32, "ecx": 32, "edx": 32,
             "esi": 32, "edi": 32, "esp": 32, "ebp": 32,
@@ -64,7 +69,7 @@ def reg_len(regname):
             "df": 1, "of": 1, "nt": 1, "rf": 1, "vm": 1, "ac": 1, "vif": 1,
             "vip": 1, "id": 1}[regname]
     else:
-        raise KeyError("Unkown arch %s" % CFA.arch)
+        raise KeyError("Unkown arch %s" % arch)
 
 
 #: maps short region names to pretty names
@@ -79,20 +84,74 @@ RE_VALTAINT = re.compile(
     "(?P<memreg>[a-zA-Z])(?P<value>0[xb][0-9a-fA-F_?]+)(!(?P<taint>\S+)|)?")
 
 
+#: summary of the memory defined in a State region
+#: ranges: sorted, coalesced list of (start, stop) tuples
+#: nbytes: number of defined bytes; ntainted: number of tainted bytes
+MemRegionSummary = namedtuple('MemRegionSummary',
+                              ['ranges', 'nbytes', 'ntainted'])
+
+
+#: snapshot file header, followed by the format version
+SNAPSHOT_MAGIC = "BCSNAP"
+SNAPSHOT_VERSION = 2
+#: size of the end of the analyzer log that is kept in snapshots
+SNAPSHOT_LOG_TAIL = 0x10000
+
+
 class PyBinCATParseError(PyBinCATException):
     pass
 
 
+class PyBinCATParseCancelled(PyBinCATException):
+    pass
+
+
+class ParsedStates(object):
+    """
+    Least recently used parsed states of a CFA. Once more than max_states
+    states have been parsed, the least recently used ones are reset to their
+    unparsed form by trim, and parsed again when needed. States are
+    recorded by any thread, and trimmed by the thread that uses them.
+    """
+    def __init__(self, max_states=None):
+        #: None: unbounded, parsed data is never dropped
+        self.max_states = max_states
+        #: node_id -> State, least recently used first
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._states)
+
+    def add(self, state):
+        with self._lock:
+            self._states.pop(state.node_id, None)
+            self._states[state.node_id] = state
+
+    def touch(self, state):
+        with self._lock:
+            if state.node_id in self._states:
+                del self._states[state.node_id]
+                self._states[state.node_id] = state
+
+    def trim(self):
+        with self._lock:
+            if self.max_states is None:
+                return
+            while len(self._states) > self.max_states:
+                _, state = self._states.popitem(last=False)
+                state._evict()
+
+
 class CFA(object):
     """
     Holds State for each defined node_id.
     Several node_ids may share the same address (ex. loops, partitions)
     """
-    #: Cache to speed up value parsing. (str, length) -> [Value, ...]
-    _valcache = {}
+    #: default architecture used by reg_len
     arch = None
 
-    def __init__(self, states, edges, nodes):
+    def __init__(self, states, edges, nodes, arch=None, addr_tainted=None):
         #: Value (address) -> [node_id]. Nodes marked "final" come first.
         self.states = states
         #: node_id (string) -> list of node_id (string)
@@ -100,13 +159,47 @@ class CFA(object):
         #: node_id (string) -> State
         self.nodes = nodes
         self.logs = None
+        #: architecture of the analyzed code
+        self.arch = arch
+        #: node_id -> list of parent node_ids, built when first needed
+        self._parents = None
+        if addr_tainted is None:
+            addr_tainted = {}
+            for state in nodes.itervalues():
+                address = state.address.value
+                addr_tainted[address] = (addr_tainted.get(address, False) or
+                                         state.tainted)
+        #: address (int) -> True if a node at this address is tainted
+        self.addr_tainted = addr_tainted
+        #: serializes background parsing of this CFA's states
+        self.parse_lock = threading.Lock()
+        #: bounds the number of parsed states kept in memory
+        self.parsed_states = ParsedStates()
+        for state in nodes.itervalues():
+            state._parse_lock = self.parse_lock
+            state._parsed_states = self.parsed_states
 
     @classmethod
-    def parse(cls, filename, logs=None):
+    def parse(cls, filename, logs=None, progress_cb=None):
+        """
+        Parses bincat output file. Does not modify any class-level state, so
+        that several files may be parsed concurrently (ex. from a worker
+        thread).
+
+        :param filename: string, path to output file
+        :param logs: string, path to log file
+        :param progress_cb: function called with (parsed sections, total
+            sections) while parsing. Parsing is cancelled, raising
+            PyBinCATParseCancelled, if it returns False.
+        """
 
         states = defaultdict(list)
         edges = defaultdict(list)
         nodes = {}
+        addr_tainted = {}
+        #: Cache to speed up value parsing. (str, length) -> [Value, ...]
+        #: shared by all states of this CFA
+        valcache = {}
 
         config = ConfigParser.RawConfigParser()
         try:
@@ -124,8 +217,13 @@ class CFA(object):
                 filename)
             return None
 
-        cls.arch = config.get('loader', 'architecture')
-        for section in config.sections():
+        arch = config.get('loader', 'architecture')
+        sections = config.sections()
+        for idx, section in enumerate(sections):
+            if progress_cb and idx % 1000 == 0:
+                if progress_cb(idx, len(sections)) is False:
+                    raise PyBinCATParseCancelled(
+                        "Parsing of %s has been cancelled" % filename)
             if section == 'edges':
                 for edgename, edge in config.items(section):
                     src, dst = edge.split(' -> ')
@@ -133,19 +231,23 @@ class CFA(object):
                 continue
             elif section.startswith('node = '):
                 node_id = section[7:]
-                state = State.parse(node_id, dict(config.items(section)))
+                state = State.parse(node_id, dict(config.items(section)),
+                                    valcache, arch)
                 address = state.address
                 if state.final:
                     states[address].insert(0, state.node_id)
                 else:
                     states[address].append(state.node_id)
                 nodes[state.node_id] = state
+                if state.tainted or address.value not in addr_tainted:
+                    addr_tainted[address.value] = state.tainted
                 continue
             elif section == 'loader':
                 continue
 
-        CFA._valcache = dict()
-        cfa = cls(states, edges, nodes)
+        cfa = cls(states, edges, nodes, arch, addr_tainted)
+        if progress_cb:
+            progress_cb(len(sections), len(sections))
         if logs:
             cfa.logs = open(logs, 'rb').read()
         return cfa
@@ -186,7 +288,130 @@ class CFA(object):
         except ImportError:
             # XXX log warning
             subprocess.call(["bincat", initfname, outfname, logfname])
-        return cls.parse(outfname, logs=logfname)
+        cfa = cls.parse(outfname, logs=logfname)
+        cls.arch = cfa.arch
+        return cfa
+
+    def save_snapshot(self, fileobj, progress_cb=None):
+        """
+        Writes a compact binary snapshot of this CFA, including parsed state
+        data and the end of the logs, that can be loaded without parsing the
+        analyzer output file again. Strings and values are interned.
+        States that have not been parsed yet are parsed.
+
+        :param fileobj: file opened in binary mode
+        :param progress_cb: function called with (saved states, total
+            states). Saving is cancelled, raising PyBinCATParseCancelled, if
+            it returns False.
+        """
+        strings = []
+        #: string -> index in strings
+        str_idx = {}
+        #: (region, value, length, vtop, vbot, taint, ttop, tbot) tuples
+        values = []
+        #: Value tuple -> index in values
+        val_idx = {}
+
+        def intern(string):
+            idx = str_idx.get(string)
+            if idx is None:
+                idx = str_idx[string] = len(strings)
+                strings.append(string)
+            return idx
+
+        def intern_value(value):
+            if value is None:
+                return -1
+            key = (intern(value.region), value.value, value.length,
+                   value.vtop, value.vbot, value.taint, value.ttop,
+                   value.tbot)
+            idx = val_idx.get(key)
+            if idx is None:
+                idx = val_idx[key] = len(values)
+                values.append(key)
+            return idx
+
+        nodes = []
+        for idx, (node_id, state) in enumerate(self.nodes.iteritems()):
+            if progress_cb and idx % 1000 == 0:
+                if progress_cb(idx, len(self.nodes)) is False:
+                    raise PyBinCATParseCancelled(
+                        "Snapshot has been cancelled")
+            regaddrs = tuple(
+                (intern_value(k), tuple(intern_value(v) for v in vlist))
+                for k, vlist in state.regaddrs.iteritems())
+            regtypes = tuple(
+                (intern_value(k), tuple(intern(t) for t in types))
+                for k, types in state.regtypes.iteritems())
+            nodes.append((node_id, intern(state.address.region),
+                          state.address.value, state.final,
+                          intern(state.statements), intern(state.bytes),
+                          tuple(intern(t) for t in state.taintsrc),
+                          regaddrs, regtypes))
+        # address index: (region, address, node ids)
+        addresses = [(intern(addr.region), addr.value, tuple(node_ids))
+                     for addr, node_ids in self.states.iteritems()
+                     if node_ids]
+        data = (self.arch, strings, values, nodes, addresses,
+                dict((k, tuple(v)) for k, v in self.edges.iteritems()),
+                self.addr_tainted,
+                self.logs and self.logs[-SNAPSHOT_LOG_TAIL:])
+        fileobj.write(SNAPSHOT_MAGIC)
+        marshal.dump(SNAPSHOT_VERSION, fileobj)
+        marshal.dump(data, fileobj)
+        if progress_cb:
+            progress_cb(len(self.nodes), len(self.nodes))
+
+    @classmethod
+    def load_snapshot(cls, fileobj):
+        """
+        Loads a CFA written by save_snapshot. States are loaded already
+        parsed.
+
+        :param fileobj: file opened in binary mode
+        """
+        if fileobj.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise PyBinCATException("Invalid snapshot file")
+        try:
+            version = marshal.load(fileobj)
+            if version != SNAPSHOT_VERSION:
+                raise PyBinCATException(
+                    "Unsupported snapshot version %s" % version)
+            data = marshal.load(fileobj)
+        except (EOFError, ValueError, TypeError) as e:
+            raise PyBinCATException("Invalid snapshot file: %s" % e)
+        (arch, strings, svalues, snodes, addresses, sedges, addr_tainted,
+         logs) = data
+
+        # Value objects are shared between states, as when using CFA.parse
+        values = [Value(strings[v[0]], *v[1:]) for v in svalues]
+
+        nodes = {}
+        for (node_id, region, address, final, statements, bytes_, taintsrc,
+             regaddrs, regtypes) in snodes:
+            state = State(node_id, Value(strings[region], address, 0))
+            state._arch = arch
+            state.final = final
+            state.statements = strings[statements]
+            state.bytes = strings[bytes_]
+            state.taintsrc = [strings[t] for t in taintsrc]
+            state.tainted = bool(taintsrc)
+            state._regaddrs = dict(
+                (values[k], [values[v] if v >= 0 else None for v in vlist])
+                for k, vlist in regaddrs)
+            state._regtypes = dict(
+                (values[k], [strings[t] for t in types])
+                for k, types in regtypes)
+            nodes[node_id] = state
+        states = defaultdict(list)
+        for region, address, node_ids in addresses:
+            states[Value(strings[region], address, 0)] = list(node_ids)
+        edges = defaultdict(list)
+        for src, dsts in sedges.iteritems():
+            edges[src] = list(dsts)
+        cfa = cls(states, edges, nodes, arch, addr_tainted)
+        cfa.logs = logs
+        return cfa
 
     def _toValue(self, eip, region="g"):
         if type(eip) in [int, long]:
@@ -205,10 +430,16 @@ class CFA(object):
     def __getitem__(self, node_id):
         """
         Returns State at provided node_id if it exists, else None.
+        Parsed data of least recently returned states may be dropped, see
+        ParsedStates.
         """
         if type(node_id) is int:
             node_id = str(node_id)
-        return self.nodes.get(node_id, None)
+        state = self.nodes.get(node_id, None)
+        if state is not None and self.parsed_states.max_states is not None:
+            self.parsed_states.touch(state)
+            self.parsed_states.trim()
+        return state
 
     def node_id_from_addr(self, addr):
         addr = self._toValue(addr)
@@ -220,6 +451,18 @@ class CFA(object):
         """
         return [self[n] for n in self.edges[str(node_id)]]
 
+    def parent_node_ids(self, node_id):
+        """
+        Returns a list of node_id (string) that have an edge to node_id
+        """
+        if self._parents is None:
+            parents = defaultdict(list)
+            for src, dsts in self.edges.items():
+                for dst in dsts:
+                    parents[dst].append(src)
+            self._parents = parents
+        return self._parents.get(str(node_id), [])
+
 
 class State(object):
     """
@@ -242,7 +485,9 @@ class State(object):
     example valtaints: G0x1234 G0x12!0xF0 S0x12!ALL
     """
     __slots__ = ['address', 'node_id', '_regaddrs', '_regtypes', 'final',
-                 'statements', 'bytes', 'tainted', 'taintsrc', '_outputkv']
+                 'statements', 'bytes', 'tainted', 'taintsrc', '_outputkv',
+                 '_memsummaries', '_valcache', '_arch', '_parse_lock',
+                 '_parsed_states']
 
     def __init__(self, node_id, address=None, lazy_init=None):
         self.address = address
@@ -256,12 +501,47 @@ class State(object):
         self.statements = ""
         self.bytes = ""
         self.tainted = False
+        #: gap -> {region: MemRegionSummary}, reset by __setitem__
+        self._memsummaries = {}
+        #: value parsing cache, shared with other states from the same CFA
+        self._valcache = None
+        #: architecture, used to get register lengths
+        self._arch = None
+        #: lock shared with other states from the same CFA, see prefetch
+        self._parse_lock = None
+        #: ParsedStates of the CFA
+        self._parsed_states = None
+
+    def _parse_regaddrs_once(self, blocking=False):
+        """
+        Parses deferred data, unless another thread already did it.
+        If blocking is False and a background thread is parsing, do not wait
+        for it: parse concurrently, results are only published once
+        complete.
+        """
+        lock = self._parse_lock
+        if lock is None or not lock.acquire(blocking):
+            self.parse_regaddrs()
+            return
+        try:
+            if self._regaddrs is None:
+                self.parse_regaddrs()
+        finally:
+            lock.release()
+
+    def prefetch(self):
+        """
+        Parses deferred data from a background thread. Background parsing of
+        states from the same CFA is serialized.
+        """
+        if self._regaddrs is None:
+            self._parse_regaddrs_once(blocking=True)
 
     @property
     def regaddrs(self):
         if self._regaddrs is None:
             try:
-                self.parse_regaddrs()
+                self._parse_regaddrs_once()
             except Exception as e:
                 import traceback
                 traceback.print_exc(e)
@@ -274,7 +554,7 @@ class State(object):
     def regtypes(self):
         if self._regtypes is None:
             try:
-                self.parse_regaddrs()
+                self._parse_regaddrs_once()
             except Exception as e:
                 import traceback
                 traceback.print_exc(e)
@@ -284,13 +564,18 @@ class State(object):
         return self._regtypes
 
     @classmethod
-    def parse(cls, node_id, outputkv):
+    def parse(cls, node_id, outputkv, valcache=None, arch=None):
         """
         :param outputkv: list of (key, value) tuples for each property set by
             the analyzer at this EIP
+        :param valcache: dict used to cache parsed values, may be shared
+            between states of the same CFA
+        :param arch: architecture, defaults to CFA.arch
         """
 
         new_state = State(node_id)
+        new_state._valcache = valcache
+        new_state._arch = arch
         addr = outputkv.pop("address")
         m = RE_VALTAINT.match(addr)
         new_state.address = Value(m.group("memreg"), int(m.group("value"), 0), 0)
@@ -321,9 +606,19 @@ class State(object):
         """
         Parses entries containing taint & type data
         """
-        self._regaddrs = {}
-        self._regtypes = {}
-        for k, v in self._outputkv.iteritems():
+        # results are only published once they are complete, since they may
+        # be read from another thread
+        outputkv = getattr(self, '_outputkv', None)
+        if outputkv is None or self._regaddrs is not None:
+            # already parsed, ex. by another thread
+            return
+        regaddrs = {}
+        regtypes = {}
+        valcache = self._valcache
+        if valcache is None:
+            valcache = self._valcache = {}
+        arch = self._arch
+        for k, v in outputkv.iteritems():
             if k.startswith("t-"):
                 typedata = True
                 k = k[2:]
@@ -357,15 +652,18 @@ class State(object):
                     length = 8
                     # XXX allow non-aligned access (current: assume no overlap)
             elif region == "reg":
-                length = reg_len(addr)
+                length = reg_len(addr, arch)
 
             # build value
             concat_value = []
-            regaddr = Value.parse(region, addr, '0', 0)
+            if region == "reg":
+                regaddr = Value(region, addr, length)
+            else:
+                regaddr = Value.parse(region, addr, '0', 0)
             if typedata:
-                self._regtypes[regaddr] = v.split(', ')
+                regtypes[regaddr] = v.split(', ')
                 continue
-            if (v, length) not in CFA._valcache:
+            if (v, length) not in valcache:
                 # add to cache
                 off_vals = []
                 for idx, val in enumerate(v.split(', ')):
@@ -381,10 +679,28 @@ class State(object):
                     concat_value.append(new_value)
 
                 off_vals.append(concat_value)
-                CFA._valcache[(v, length)] = off_vals
-            for val in CFA._valcache[(v, length)]:
-                self._regaddrs[regaddr] = val
-        del(self._outputkv)
+                valcache[(v, length)] = off_vals
+            for val in valcache[(v, length)]:
+                regaddrs[regaddr] = val
+        self._regtypes = regtypes
+        self._regaddrs = regaddrs
+        parsed_states = self._parsed_states
+        if parsed_states is None or parsed_states.max_states is None:
+            self._outputkv = None
+        else:
+            # kept, so that parsed data can be dropped and parsed again
+            parsed_states.add(self)
+
+    def _evict(self):
+        """
+        Drops parsed data, unless it cannot be parsed again (modified
+        states, states loaded from a snapshot)
+        """
+        if getattr(self, '_outputkv', None) is None:
+            return
+        self._regaddrs = None
+        self._regtypes = None
+        self._memsummaries = {}
 
     def __getitem__(self, item):
         """
@@ -410,30 +726,55 @@ class State(object):
                     return vlist[item.value-addr.value:]
             raise IndexError
 
-    def mem_ranges(self):
+    def mem_summary(self, gap=0):
         """
-        Return a dict of regions pointing to a list of tuples
-        the tuples indicate the valid memory ranges
-        ranges are sorted and coleasced
-        """
-        ranges = defaultdict(list)
-        for addr in self.regaddrs.keys():
-            if addr.region != 'reg':
-                ranges[addr.region].append((addr.value, addr.value+len(self.regaddrs[addr])-1))
-        # Sort ranges
-        for region in ranges:
-            ranges[region].sort(key=lambda x: x[0])
+        Return a dict of regions pointing to a MemRegionSummary.
+        Memory ranges are sorted and coalesced; ranges separated by at most
+        gap unmapped bytes are merged. Bytes covered by several overlapping
+        blocks are only counted once in nbytes and ntainted.
+        Results are cached until the state is modified using __setitem__.
+        """
+        if gap in self._memsummaries:
+            return self._memsummaries[gap]
+        blocks = defaultdict(list)
+        for addr, vals in self.regaddrs.iteritems():
+            if addr.region == 'reg':
+                continue
+            blocks[addr.region].append(
+                (addr.value, addr.value+len(vals)-1, vals))
+        summaries = {}
+        for region, rblocks in blocks.iteritems():
+            rblocks.sort(key=lambda x: x[0])
             # merge
-            merged = []
-            last_addr = None
-            for crange in ranges[region]:
-                if last_addr and crange[0] == (last_addr+1):
-                    merged[-1] = (merged[-1][0], crange[1])
+            ranges = []
+            nbytes = 0
+            ntainted = 0
+            # last address counted in nbytes
+            covered = None
+            for start, stop, vals in rblocks:
+                if ranges and start - ranges[-1][1] - 1 <= gap:
+                    ranges[-1] = (ranges[-1][0], max(ranges[-1][1], stop))
                 else:
-                    merged.append(crange)
-                last_addr = crange[1]
-            ranges[region] = merged
-        return ranges
+                    ranges.append((start, stop))
+                first = start if covered is None else max(start, covered+1)
+                if first > stop:
+                    continue
+                nbytes += stop - first + 1
+                ntainted += sum(1 for v in vals[first-start:]
+                                if v.is_tainted())
+                covered = stop
+            summaries[region] = MemRegionSummary(ranges, nbytes, ntainted)
+        self._memsummaries[gap] = summaries
+        return summaries
+
+    def mem_ranges(self, gap=0):
+        """
+        Return a dict of regions pointing to a list of tuples
+        the tuples indicate the valid memory ranges
+        ranges are sorted and coleasced, see mem_summary
+        """
+        return dict((region, list(summary.ranges))
+                    for region, summary in self.mem_summary(gap).iteritems())
 
     def get_mem_range(self, region, start, length):
         m = []
@@ -471,6 +812,10 @@ class State(object):
         return "".join(m)
 
     def __setitem__(self, item, val):
+        self._memsummaries = {}
+        # parse, and never drop modifications
+        self.regaddrs
+        self._outputkv = None
         if type(val[0]) is list:
             val = val[0]
         if type(item.value) is str:
@@ -0,0 +1,75 @@
+"""
+    This file is part of BinCAT.
+    Copyright 2014-2017 - Airbus Group
+
+    BinCAT is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or (at your
+    option) any later version.
+
+    BinCAT is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with BinCAT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import re
+
+#: progress records periodically written to analyzer.log by the analyzer
+PROGRESS_RE = re.compile(
+    r"^\[PROGRESS\] address=(?P<address>\S+) processed=(?P<processed>\d+) "
+    r"waiting=(?P<waiting>\d+)\s*$")
+
+
+def parse_progress(line):
+    """
+    Returns a dict (address, processed, waiting) if line is a progress
+    record, else None
+    """
+    m = PROGRESS_RE.match(line)
+    if m is None:
+        return None
+    return {'address': m.group('address'),
+            'processed': int(m.group('processed')),
+            'waiting': int(m.group('waiting'))}
+
+
+class LogTail(object):
+    """
+    Reads lines appended to a log file which is still being written.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.offset = 0
+        #: incomplete last line
+        self.partial = ""
+
+    def lines(self):
+        """
+        Returns complete lines that have been written since the last call
+        """
+        try:
+            with open(self.fname, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except IOError:
+            # not created yet
+            return []
+        self.offset += len(data)
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        return lines
+
+    def progress(self):
+        """
+        Returns the latest progress record written since the last call, or
+        None
+        """
+        latest = None
+        for line in self.lines():
+            record = parse_progress(line)
+            if record is not None:
+                latest = record
+        return latest
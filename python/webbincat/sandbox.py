@@ -0,0 +1,77 @@
+"""
+    This file is part of BinCAT.
+    Copyright 2014-2017 - Airbus Group
+
+    BinCAT is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or (at your
+    option) any later version.
+
+    BinCAT is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with BinCAT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# Runs bincat inside a firejail sandbox
+import subprocess
+
+
+def firejail_cmdline(firejail, dirname, args):
+    """
+    Returns the argv used to run args in a sandbox, which can only access
+    dirname
+    """
+    # do not use chroot: not compatible with grsec
+    return [firejail,
+            "--nosound", "--caps.drop=all",
+            "--quiet",
+            "--private",  # new /root, /home
+            "--private-dev",  # new /dev, few devices
+            "--private-etc=ld.so.cache,ld.so.conf,ld.so.conf.d",  # new /etc
+            "--nogroups",  # no supplementary groups
+            "--noroot",  # new user namespace
+            "--nonewprivs",  # NO_NEW_PRIVS
+            "--seccomp",  # default seccomp blacklist
+            "--net=none",  # no network
+            "--whitelist=%s" % dirname,  # only allow analysis dir from /tmp
+            "--"] + list(args)
+
+
+def run_bincat(firejail, dirname, initfname, outfname, logfname):
+    """
+    Runs bincat in dirname, which is also the subprocess' working directory:
+    relative input paths from init.ini are resolved there.
+    Returns (exit code, stdout+stderr)
+    """
+    cmdline = firejail_cmdline(firejail, dirname,
+                               ["bincat", initfname, outfname, logfname])
+    err = 0
+    try:
+        out = subprocess.check_output(
+            cmdline, cwd=dirname,
+            stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as exc:
+        err = exc.returncode
+        out = exc.output
+
+    return err, out
+
+
+def bincat_version(firejail, dirname):
+    """
+    Returns the version printed by the sandboxed bincat, run in dirname, or
+    "" if it cannot be run
+    """
+    cmdline = firejail_cmdline(firejail, dirname, ["bincat"])
+    try:
+        # prints its version, then usage
+        out = subprocess.check_output(cmdline, cwd=dirname,
+                                      stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as exc:
+        out = exc.output or ""
+    except OSError:
+        out = ""
+    return out.split('\n')[0].strip()
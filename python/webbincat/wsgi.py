@@ -17,17 +17,26 @@
 """
 import ConfigParser
 import distutils.spawn
+import errno
+import fcntl
 import hashlib
+import json
+import multiprocessing
 import os
 import shutil
 import re
-import subprocess
+import StringIO
 import sys
 import tempfile
+import threading
+import time
+import uuid
 import flask
 import zlib
 import logging
 import idabincat.npkgen
+import webbincat.sandbox
+from pybincat.tools.progress import LogTail
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -37,8 +46,13 @@ logging.basicConfig(level=logging.DEBUG)
 # tested with firejail 0.9.40
 
 SHA256_RE = re.compile('[a-fA-F0-9]{64}')
+#: size of blocks used when streaming files
+BLOCK_SIZE = 1024*1024
+JOB_ID_RE = re.compile('^[a-f0-9]{32}$')
+#: delay between two checks for new progress records, in seconds
+PROGRESS_POLL_INTERVAL = 1
 app = flask.Flask(__name__)
-API_VERSION = "1.2"
+API_VERSION = "1.3"
 
 # check existence of binary storage folder
 if 'BINARY_STORAGE_FOLDER' not in app.config:
@@ -49,6 +63,57 @@ if not os.path.isdir(app.config['BINARY_STORAGE_FOLDER']):
                      app.config['BINARY_STORAGE_FOLDER'])
     sys.exit(1)
 
+# zlib-compressed variants of stored files
+ZLIB_FOLDER = os.path.join(app.config['BINARY_STORAGE_FOLDER'], 'zlib')
+if not os.path.isdir(ZLIB_FOLDER):
+    os.mkdir(ZLIB_FOLDER)
+
+# maximum number of analyses running at the same time
+if 'ANALYSIS_WORKERS' not in app.config:
+    app.config['ANALYSIS_WORKERS'] = 4
+
+# job status files
+JOBS_FOLDER = os.path.join(app.config['BINARY_STORAGE_FOLDER'], 'jobs')
+if not os.path.isdir(JOBS_FOLDER):
+    os.mkdir(JOBS_FOLDER)
+
+# memoized analysis results: maximum number of entries (0 disables the
+# cache), and eviction policy: "lru" or "fifo"
+if 'RESULT_CACHE_SIZE' not in app.config:
+    app.config['RESULT_CACHE_SIZE'] = 1000
+if 'RESULT_CACHE_POLICY' not in app.config:
+    app.config['RESULT_CACHE_POLICY'] = "lru"
+if app.config['RESULT_CACHE_POLICY'] not in ("lru", "fifo"):
+    app.logger.error("Unsupported RESULT_CACHE_POLICY %s",
+                     app.config['RESULT_CACHE_POLICY'])
+    sys.exit(1)
+RESULTS_FOLDER = os.path.join(app.config['BINARY_STORAGE_FOLDER'], 'results')
+if not os.path.isdir(RESULTS_FOLDER):
+    os.mkdir(RESULTS_FOLDER)
+
+# storage maintenance: maximum size of stored files in bytes (0: unlimited),
+# minimum delay since their last access before they can be evicted, delay
+# before job status files and stale temporary files are removed, and delay
+# between two maintenance runs, in seconds
+if 'STORAGE_QUOTA' not in app.config:
+    app.config['STORAGE_QUOTA'] = 10*1024*1024*1024
+if 'STORAGE_MIN_AGE' not in app.config:
+    app.config['STORAGE_MIN_AGE'] = 3600
+if 'JOB_RETENTION' not in app.config:
+    app.config['JOB_RETENTION'] = 24*3600
+if 'MAINTENANCE_INTERVAL' not in app.config:
+    app.config['MAINTENANCE_INTERVAL'] = 300
+# keep analysis directories, for debugging purposes
+if 'KEEP_JOB_DIRS' not in app.config:
+    app.config['KEEP_JOB_DIRS'] = False
+# files which must not be evicted: input files of queued and running jobs,
+# results of jobs which have not been cleaned up yet
+PINS_FOLDER = os.path.join(app.config['BINARY_STORAGE_FOLDER'], 'pins')
+if not os.path.isdir(PINS_FOLDER):
+    os.mkdir(PINS_FOLDER)
+#: suffix of analysis directories
+JOB_DIR_SUFFIX = 'bincat-web-analysis'
+
 # check whether firejail is installed
 firejail = distutils.spawn.find_executable("firejail")
 if firejail is None:
@@ -67,6 +132,15 @@ def version():
     return API_VERSION
 
 
+@app.route("/toolchain_version")
+def toolchain_version():
+    """
+    Identifies the tools used by /convert_to_tnpk, so that clients can
+    cache generated TNPK files
+    """
+    return idabincat.npkgen.toolchain_id()
+
+
 @app.route("/download/<sha256>/<string:compression>", methods=['HEAD', 'GET'])
 @app.route("/download/<sha256>", methods=['HEAD', 'GET'],
            defaults={'compression': 'none'})
@@ -76,36 +150,133 @@ def download(sha256, compression):
             "SHA256 expected as endpoint parameter.", 400)
     sha256 = sha256.lower()
     filename = os.path.join(app.config['BINARY_STORAGE_FOLDER'], sha256)
-    if os.path.isfile(filename):
-        with open(filename, 'rb') as f:
-            if compression == 'zlib':
-                return zlib.compress(f.read())
-            else:
-                return f.read()
-    else:
+    if not os.path.isfile(filename):
         return flask.make_response(
             "No file having sha256=%s has been uploaded." % sha256, 404)
+    touch_blob(sha256)
+    if compression == 'zlib':
+        filename = compressed_fname(sha256)
+    # served by the WSGI server's file wrapper, or by the front-end web server
+    # if USE_X_SENDFILE is set
+    return flask.send_file(filename, mimetype='application/octet-stream',
+                           conditional=True)
+
+
+@app.route("/exists", methods=['POST'])
+def exists():
+    """
+    Expects a JSON object: {"sha256": [list of hashes]}.
+    Returns lists of hashes of files which are present in, and missing from,
+    storage.
+    """
+    req = flask.request.get_json(silent=True)
+    if not isinstance(req, dict) or not isinstance(req.get('sha256'), list):
+        return flask.make_response(
+            "This request was expected to include a JSON list of sha256 "
+            "named 'sha256'.", 400)
+    result = {'present': [], 'missing': []}
+    for sha256 in req['sha256']:
+        if not isinstance(sha256, basestring) or not SHA256_RE.match(sha256):
+            return flask.make_response(
+                "Invalid sha256 (%r)." % sha256, 400)
+        sha256 = sha256.lower()
+        fname = os.path.join(app.config['BINARY_STORAGE_FOLDER'], sha256)
+        if os.path.isfile(fname):
+            touch_blob(sha256)
+            result['present'].append(sha256)
+        else:
+            result['missing'].append(sha256)
+    return flask.make_response(flask.jsonify(**result), 200)
 
 
 @app.route("/add", methods=['PUT'])
 def upload():
+    """
+    Stores every file named 'file' included in the request.
+    Returns their sha256 in 'files', in the same order. 'sha256' contains the
+    hash of the first file.
+    """
     if 'file' not in flask.request.files:
         return flask.make_response(
             "This request was expected to include a file named 'file'.", 400)
-    f = flask.request.files['file']
-    sha256 = store_string_to_file(f.read())
-    result = {'sha256': sha256}
+    hashes = [store_stream(f.stream)
+              for f in flask.request.files.getlist('file')]
+    result = {'sha256': hashes[0], 'files': hashes}
     return flask.make_response(flask.jsonify(**result), 200)
 
 
+def store_stream(fileobj):
+    """
+    Writes data read from fileobj to storage, hashing it on the fly.
+    Returns its sha256.
+    """
+    h = hashlib.new('sha256')
+    with tempfile.NamedTemporaryFile(
+            dir=app.config['BINARY_STORAGE_FOLDER'], suffix='.tmp',
+            delete=False) as f:
+        try:
+            while True:
+                data = fileobj.read(BLOCK_SIZE)
+                if not data:
+                    break
+                h.update(data)
+                f.write(data)
+        except:
+            os.remove(f.name)
+            raise
+    sha256 = h.hexdigest().lower()
+    fname = os.path.join(app.config['BINARY_STORAGE_FOLDER'], sha256)
+    if os.path.exists(fname):
+        # already stored
+        os.remove(f.name)
+        touch_blob(sha256)
+    else:
+        os.rename(f.name, fname)
+    return sha256
+
+
+def compressed_fname(sha256):
+    """
+    Returns the path to the zlib-compressed variant of stored file sha256,
+    which is created if it does not exist yet.
+    """
+    zname = os.path.join(ZLIB_FOLDER, sha256)
+    if os.path.exists(zname):
+        return zname
+    compressor = zlib.compressobj()
+    with tempfile.NamedTemporaryFile(dir=ZLIB_FOLDER, suffix='.tmp',
+                                     delete=False) as zf:
+        try:
+            with open(os.path.join(app.config['BINARY_STORAGE_FOLDER'],
+                                   sha256), 'rb') as f:
+                while True:
+                    data = f.read(BLOCK_SIZE)
+                    if not data:
+                        break
+                    zf.write(compressor.compress(data))
+            zf.write(compressor.flush())
+        except:
+            os.remove(zf.name)
+            raise
+    os.rename(zf.name, zname)
+    return zname
+
+
 def store_string_to_file(s, alt_path=None):
     """
     Write file to storage, with hardlink to alt_path if supplied
     """
     h = calc_sha256(s)
     fname = os.path.join(app.config['BINARY_STORAGE_FOLDER'], h)
-    with open(fname, 'wb') as f:
-        f.write(s)
+    if os.path.exists(fname):
+        touch_blob(h)
+    else:
+        # write then rename: concurrent requests never see partial files
+        with tempfile.NamedTemporaryFile(
+                dir=app.config['BINARY_STORAGE_FOLDER'], suffix='.tmp',
+                delete=False) as f:
+            f.write(s)
+        os.rename(f.name, fname)
     if alt_path is not None:
         try:
             os.link(fname, alt_path)
@@ -121,12 +292,42 @@ def calc_sha256(s):
     return h.hexdigest().lower()
 
 
-@app.route("/analyze", methods=['POST'])
-def analyze():
+def calc_file_sha256(path):
+    h = hashlib.new('sha256')
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(BLOCK_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest().lower()
+
+
+def store_file(path):
+    """
+    Adds a hard link to the file at path to storage.
+    Returns its sha256, or "" if path does not exist.
+    """
+    if not os.path.isfile(path):
+        return ""
+    h = calc_file_sha256(path)
+    try:
+        os.link(path, os.path.join(app.config['BINARY_STORAGE_FOLDER'], h))
+    except OSError:
+        # file exists, record the access
+        touch_blob(h)
+    return h
+
+
+def parse_init_ini():
+    """
+    Validates the init.ini file sent with the current request.
+    Returns (init.ini contents, list of input files sha256, None), or
+    (None, None, error response)
+    """
     if 'init.ini' not in flask.request.files:
-        return flask.make_response(
+        return None, None, flask.make_response(
             "No file named 'init.ini' has been uploaded.", 400)
-    result = {}
     init_file = flask.request.files['init.ini']
     init_file.seek(0)
 
@@ -137,13 +338,13 @@ def analyze():
     try:
         config.readfp(init_file)
     except ConfigParser.MissingSectionHeaderError:
-        return flask.make_response(
+        return None, None, flask.make_response(
             "Supplied init.ini file format is incorrect (missing section "
             "header).", 400)
     # check required sections are present
     for section in ["program", "analyzer"]:
         if not config.has_section(section):
-            return flask.make_response(
+            return None, None, flask.make_response(
                 "No [%s] section in supplied init.ini file." % section, 400)
     # check required values are present
     for section, key in [("program", "filepath"),
@@ -153,7 +354,7 @@ def analyze():
         try:
             config.get(section, key)
         except ConfigParser.NoOptionError:
-            return flask.make_response(
+            return None, None, flask.make_response(
                 "No %s key in [%s] section in supplied init.ini file."
                 % (section, key), 400)
     binary_name = config.get('program', 'filepath').lower()
@@ -175,80 +376,651 @@ def analyze():
     input_files = [s.replace('"', '') for s in input_files]
     for fname in input_files:
         if not SHA256_RE.match(fname):
-            return flask.make_response(
+            return None, None, flask.make_response(
                 "Filepath (%s) is not a valid sha256 hex string."
                 % fname, 400)
         fpath = os.path.join(app.config['BINARY_STORAGE_FOLDER'], fname)
         if not os.path.exists(fpath):
-            return flask.make_response(
+            return None, None, flask.make_response(
                 "Input file %s has not yet been uploaded." % fname, 400)
+        touch_blob(fname)
+    sio = StringIO.StringIO()
+    config.write(sio)
+    return sio.getvalue(), input_files, None
+
+
+def run_analysis(init_ini, input_files, dirname=None):
+    """
+    Runs bincat in dirname, or in a new directory, stores output files.
+    Returns a dict containing the sha256 of output files, and bincat's exit
+    code.
+    """
+    result = {}
+    config = ConfigParser.RawConfigParser()
+    config.optionxform = str
+    config.readfp(StringIO.StringIO(init_ini))
     # ini file references known input files, proceeding
-    # I miss python3's tempfile.TemporaryDirectory...
-    dirname = tempfile.mkdtemp('bincat-web-analysis')
+    if dirname is None:
+        # I miss python3's tempfile.TemporaryDirectory...
+        dirname = tempfile.mkdtemp(JOB_DIR_SUFFIX)
     app.logger.debug("created %s", dirname)
+    # only absolute paths are used: several analyses may run concurrently
+    # in the same process, cwd cannot be changed
+    paths = dict((name, os.path.join(dirname, name)) for name in
+                 ('init.ini', 'out.ini', 'analyzer.log', 'cfaout.marshal',
+                  'stdout.txt'))
+    config.set('analyzer', 'out_marshalled_cfa_file',
+               '"%s"' % paths['cfaout.marshal'])
 
-    cwd = os.getcwd()
-    os.chdir(dirname)
-    config.set('analyzer', 'out_marshalled_cfa_file', '"cfaout.marshal"')
     # prepare input files
-    config.write(open(os.path.join(dirname, 'init.ini'), 'wb'))
+    with open(paths['init.ini'], 'wb') as f:
+        config.write(f)
     for fname in input_files:
         os.link(os.path.join(app.config['BINARY_STORAGE_FOLDER'], fname),
                 os.path.join(dirname, fname))
+        touch_blob(fname)
     # run bincat
-    err, stdout = run_bincat(dirname)
+    err, stdout = webbincat.sandbox.run_bincat(
+        firejail, dirname, paths['init.ini'], paths['out.ini'],
+        paths['analyzer.log'])
 
     # gather and store outputs
-    stdout_sha256 = store_string_to_file(
-        stdout, os.path.join(dirname, 'stdout.txt'))
+    stdout_sha256 = store_string_to_file(stdout, paths['stdout.txt'])
     result['stdout.txt'] = stdout_sha256
 
     result['errorcode'] = err
     if config.get('analyzer', 'store_marshalled_cfa') == 'true':
-        if os.path.isfile('cfaout.marshal'):
-            with open('cfaout.marshal', 'rb') as f:
-                fname = calc_sha256(f.read())
-                fpath = os.path.join(app.config['BINARY_STORAGE_FOLDER'],
-                                     fname)
-                try:
-                    os.link('cfaout.marshal', fpath)
-                except OSError:
-                    # file exists, ignore
-                    pass
-                result['cfaout.marshal'] = fname
-    logfname = os.path.join(dirname, 'analyzer.log')
-    if os.path.isfile(logfname):
-        with open(logfname, 'rb') as f:
-            fname = calc_sha256(f.read())
-            fpath = os.path.join(app.config['BINARY_STORAGE_FOLDER'],
-                                 fname)
+        fname = store_file(paths['cfaout.marshal'])
+        if fname:
+            result['cfaout.marshal'] = fname
+    result['analyzer.log'] = store_file(paths['analyzer.log'])
+    result['out.ini'] = store_file(paths['out.ini'])
+    # outputs are fetched compressed by the plugin
+    for k in ('cfaout.marshal', 'analyzer.log', 'out.ini'):
+        if result.get(k):
+            compressed_fname(result[k])
+
+    return result
+
+
+# --- memoized analysis results
+#: hit/miss counters for this server process
+result_cache_stats = {'hits': 0, 'misses': 0}
+_result_cache_lock = threading.Lock()
+_analyzer_version = None
+#: (section, key) of init.ini entries which reference input files
+FILE_REFERENCES = set([('program', 'filepath'),
+                       ('analyzer', 'in_marshalled_cfa_file'),
+                       ('analyzer', 'headers')])
+
+
+def analyzer_version():
+    """
+    Returns the version string printed by bincat when run in the same
+    sandbox as analyses, or ANALYZER_VERSION if it has been configured.
+    """
+    global _analyzer_version
+    if _analyzer_version is None:
+        if 'ANALYZER_VERSION' in app.config:
+            _analyzer_version = app.config['ANALYZER_VERSION']
+        else:
+            dirname = tempfile.mkdtemp(JOB_DIR_SUFFIX)
+            try:
+                _analyzer_version = webbincat.sandbox.bincat_version(
+                    firejail, dirname)
+            finally:
+                shutil.rmtree(dirname, ignore_errors=True)
+    return _analyzer_version
+
+
+def result_cache_key(init_ini):
+    """
+    Returns the memoization key for an analysis. init.ini is normalized:
+    sections and keys are sorted, file references are replaced with the
+    sha256 of the referenced files, and paths which depend on the client or
+    are not used by the analysis are ignored.
+    Returns None if the analyzer version is unknown.
+    """
+    version = analyzer_version()
+    if not version:
+        return None
+    config = ConfigParser.RawConfigParser()
+    config.optionxform = str
+    config.readfp(StringIO.StringIO(init_ini))
+    ignored = set([('analyzer', 'out_marshalled_cfa_file')])
+    if config.get('analyzer', 'analysis').lower() not in ("forward_cfa",
+                                                          "backward"):
+        ignored.add(('analyzer', 'in_marshalled_cfa_file'))
+    normalized = [version]
+    for section in sorted(config.sections()):
+        items = []
+        for k, v in sorted(config.items(section)):
+            if (section, k) in ignored:
+                continue
+            if (section, k) in FILE_REFERENCES:
+                # stored file names are their sha256, see parse_init_ini
+                v = [f.replace('"', '').strip().lower()
+                     for f in v.split(',') if f.strip()]
+            else:
+                v = v.strip()
+            items.append((k, v))
+        normalized.append([section, items])
+    return calc_sha256(json.dumps(normalized))
+
+
+def result_cache_fname(key):
+    return os.path.join(RESULTS_FOLDER, key + '.json')
+
+
+def get_cached_result(key):
+    """
+    Returns the stored result dict for key, or None. Results referencing
+    files that are no longer in storage are dropped.
+    """
+    fname = result_cache_fname(key)
+    try:
+        with open(fname, 'rb') as f:
+            result = json.load(f)
+    except (IOError, ValueError):
+        return None
+    for k, h in result.items():
+        if k == 'errorcode' or not h:
+            continue
+        if not os.path.exists(
+                os.path.join(app.config['BINARY_STORAGE_FOLDER'], h)):
+            os.remove(fname)
+            return None
+        touch_blob(h)
+    if app.config['RESULT_CACHE_POLICY'] == 'lru':
+        os.utime(fname, None)
+    return result
+
+
+def store_cached_result(key, result):
+    """
+    Stores result, evicts the oldest entries if the cache is full
+    """
+    size = app.config['RESULT_CACHE_SIZE']
+    if size <= 0:
+        return
+    fname = result_cache_fname(key)
+    with open(fname + '.tmp', 'wb') as f:
+        json.dump(result, f)
+    os.rename(fname + '.tmp', fname)
+    entries = [os.path.join(RESULTS_FOLDER, e)
+               for e in os.listdir(RESULTS_FOLDER) if e.endswith('.json')]
+    if len(entries) <= size:
+        return
+    entries.sort(key=lambda e: os.stat(e).st_mtime)
+    for e in entries[:len(entries)-size]:
+        try:
+            os.remove(e)
+        except OSError:
+            # already evicted by another process
+            pass
+
+
+@app.route("/result_cache")
+def result_cache():
+    """
+    Returns hit/miss counters of this server process
+    """
+    with _result_cache_lock:
+        result = dict(result_cache_stats)
+    result['size'] = app.config['RESULT_CACHE_SIZE']
+    result['policy'] = app.config['RESULT_CACHE_POLICY']
+    return flask.make_response(flask.jsonify(**result), 200)
+
+
+# --- analysis jobs
+#: pool of analysis worker processes, created by start_maintenance
+_job_pool = None
+_job_pool_lock = threading.Lock()
+
+
+def get_job_pool():
+    global _job_pool
+    with _job_pool_lock:
+        if _job_pool is None:
+            _job_pool = multiprocessing.Pool(app.config['ANALYSIS_WORKERS'])
+        return _job_pool
+
+
+def job_status_fname(job_id):
+    return os.path.join(JOBS_FOLDER, job_id + '.json')
+
+
+def set_job_status(job_id, status, **kwargs):
+    """
+    Job status is stored in a file, so that it can be read by any server
+    process. kwargs are stored along with the status.
+    """
+    kwargs['job_id'] = job_id
+    kwargs['status'] = status
+    fname = job_status_fname(job_id)
+    with open(fname + '.tmp', 'wb') as f:
+        json.dump(kwargs, f)
+    os.rename(fname + '.tmp', fname)
+
+
+def get_job_status(job_id):
+    """
+    Returns the job status dict, or None if job_id is unknown
+    """
+    try:
+        with open(job_status_fname(job_id), 'rb') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def process_alive(pid):
+    if pid is None:
+        # status written by a previous version
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def get_live_job_status(job_id):
+    """
+    Same as get_job_status. Running jobs whose worker process has died (ex.
+    killed by the OOM killer) are marked as failed: the job pool never
+    reports them.
+    """
+    status = get_job_status(job_id)
+    if (status is not None and status['status'] == 'running' and
+            not process_alive(status.get('pid'))):
+        app.logger.error("Analysis job %s: worker process %s died", job_id,
+                         status['pid'])
+        unpin_files(job_id)
+        set_job_status(job_id, 'failed',
+                       error="analysis worker process died")
+        status = get_job_status(job_id)
+    return status
+
+
+def run_job(job_id, init_ini, input_files, cache_key=None):
+    """
+    Runs in a worker process of the job pool. Successful results are
+    memoized under cache_key.
+    """
+    dirname = None
+    try:
+        dirname = tempfile.mkdtemp(JOB_DIR_SUFFIX)
+        # logfname is used to report progress, it is not sent to clients
+        # pid is used to detect dead workers, see get_live_job_status
+        set_job_status(job_id, 'running', pid=os.getpid(),
+                       logfname=os.path.join(dirname, 'analyzer.log'))
+        result = run_analysis(init_ini, input_files, dirname)
+    except Exception as e:
+        app.logger.exception("Analysis job %s failed", job_id)
+        unpin_files(job_id)
+        set_job_status(job_id, 'failed', error=str(e))
+        return None
+    finally:
+        # outputs have been linked to storage
+        if dirname is not None and not app.config['KEEP_JOB_DIRS']:
+            shutil.rmtree(dirname, ignore_errors=True)
+    if cache_key is not None and result['errorcode'] == 0:
+        store_cached_result(cache_key, result)
+    # keep results until the job is cleaned up, instead of input files
+    pin_files(job_id, result_files(result))
+    set_job_status(job_id, 'done', result=result)
+    return result
+
+
+def submit_job(init_ini, input_files):
+    """
+    Queues an analysis. Returns (job id, multiprocessing.AsyncResult), the
+    latter being None if a memoized result has been found: the job is done.
+    """
+    job_id = uuid.uuid4().hex
+    cache_key = None
+    if app.config['RESULT_CACHE_SIZE'] > 0:
+        cache_key = result_cache_key(init_ini)
+    if cache_key is not None:
+        result = get_cached_result(cache_key)
+        with _result_cache_lock:
+            if result is None:
+                result_cache_stats['misses'] += 1
+            else:
+                result_cache_stats['hits'] += 1
+        if result is not None:
+            app.logger.debug("analysis result found in cache (%s)",
+                             cache_key)
+            pin_files(job_id, result_files(result))
+            set_job_status(job_id, 'done', result=result)
+            return job_id, None
+    set_job_status(job_id, 'queued')
+    pin_files(job_id, input_files)
+    async_result = get_job_pool().apply_async(
+        run_job, (job_id, init_ini, input_files, cache_key))
+    return job_id, async_result
+
+
+@app.route("/jobs", methods=['POST'])
+def new_job():
+    init_ini, input_files, error = parse_init_ini()
+    if error is not None:
+        return error
+    job_id, _ = submit_job(init_ini, input_files)
+    result = {'job_id': job_id, 'status': 'queued'}
+    return flask.make_response(flask.jsonify(**result), 202)
+
+
+@app.route("/jobs/<job_id>", methods=['GET'])
+def job(job_id):
+    """
+    Returns job status: queued, running, failed (with an error message) or
+    done. When done, the result is the same as the one returned by /analyze.
+    """
+    if not JOB_ID_RE.match(job_id):
+        return flask.make_response("Invalid job id.", 400)
+    status = get_live_job_status(job_id)
+    if status is None:
+        return flask.make_response("No job having id=%s." % job_id, 404)
+    status.pop('logfname', None)
+    status.pop('pid', None)
+    return flask.make_response(flask.jsonify(**status), 200)
+
+
+@app.route("/jobs/<job_id>/progress", methods=['GET'])
+def job_progress(job_id):
+    """
+    Streams job progress as server-sent events:
+    - "status" events contain the job status, each time it changes
+    - unnamed events contain progress records written by the analyzer
+      (address, processed, waiting)
+    The stream ends after the job is done or has failed. Comments are sent
+    periodically, so that clients can detect stale connections.
+    A server thread (or worker, for servers that do not use threads) is
+    held for the whole stream: the server must be able to handle one more
+    concurrent request per followed job. Clients that cannot follow the
+    stream should poll /jobs/<job_id> instead.
+    """
+    if not JOB_ID_RE.match(job_id):
+        return flask.make_response("Invalid job id.", 400)
+    if get_job_status(job_id) is None:
+        return flask.make_response("No job having id=%s." % job_id, 404)
+
+    def events():
+        tail = None
+        current = None
+        while True:
+            status = get_live_job_status(job_id) or {'status': 'failed'}
+            if tail is None and 'logfname' in status:
+                tail = LogTail(status['logfname'])
+            if tail is not None:
+                record = tail.progress()
+                if record is not None:
+                    yield "data: %s\n\n" % json.dumps(record)
+            if status['status'] != current:
+                current = status['status']
+                yield "event: status\ndata: %s\n\n" % json.dumps(current)
+            if current in ('done', 'failed'):
+                return
+            yield ": keepalive\n\n"
+            time.sleep(PROGRESS_POLL_INTERVAL)
+    return flask.Response(events(), mimetype='text/event-stream',
+                          headers={'Cache-Control': 'no-cache'})
+
+
+# --- storage maintenance
+def touch_blob(sha256):
+    """
+    Records an access to a stored file: files are evicted in least recently
+    used order.
+    """
+    try:
+        os.utime(os.path.join(app.config['BINARY_STORAGE_FOLDER'], sha256),
+                 None)
+    except OSError:
+        # evicted meanwhile
+        pass
+
+
+def result_files(result):
+    """
+    Returns the sha256 of files referenced by an analysis result
+    """
+    return [h for k, h in result.items() if k != 'errorcode' and h]
+
+
+def pin_files(job_id, hashes):
+    """
+    Prevents files used by job job_id from being evicted: input files of
+    queued and running jobs, results of jobs which have not been cleaned up
+    yet. Replaces files previously pinned by job_id.
+    """
+    fname = os.path.join(PINS_FOLDER, job_id + '.json')
+    with open(fname + '.tmp', 'wb') as f:
+        json.dump(hashes, f)
+    os.rename(fname + '.tmp', fname)
+
+
+def unpin_files(job_id):
+    try:
+        os.remove(os.path.join(PINS_FOLDER, job_id + '.json'))
+    except OSError:
+        pass
+
+
+def pinned_files():
+    pinned = set()
+    for entry in os.listdir(PINS_FOLDER):
+        if not entry.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(PINS_FOLDER, entry), 'rb') as f:
+                pinned.update(json.load(f))
+        except (IOError, ValueError):
+            continue
+    return pinned
+
+
+def remove_old_files(folder, max_age, predicate):
+    """
+    Removes entries of folder matching predicate, which have not been
+    modified for max_age seconds. Returns the number of removed entries.
+    """
+    now = time.time()
+    count = 0
+    for entry in os.listdir(folder):
+        if not predicate(entry):
+            continue
+        path = os.path.join(folder, entry)
+        try:
+            if now - os.lstat(path).st_mtime < max_age:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            count += 1
+        except OSError:
+            continue
+    return count
+
+
+def cleanup_jobs():
+    """
+    Removes status files and pins of jobs which have been done or have failed
+    for JOB_RETENTION seconds, stale temporary files, and analysis
+    directories left behind by jobs that did not complete. Queued and running
+    jobs are kept.
+    """
+    retention = app.config['JOB_RETENTION']
+    storage = app.config['BINARY_STORAGE_FOLDER']
+    count = 0
+    # directories of jobs that are still running
+    running_dirs = set()
+    #: job id -> status
+    statuses = {}
+    for entry in os.listdir(JOBS_FOLDER):
+        if not entry.endswith('.json'):
+            continue
+        job_id = entry[:-len('.json')]
+        status = get_live_job_status(job_id)
+        if status is None:
+            continue
+        statuses[job_id] = status['status']
+        if status['status'] == 'running':
+            running_dirs.add(os.path.basename(
+                os.path.dirname(status['logfname'])))
+
+    def finished(entry):
+        return (entry.endswith('.json') and
+                statuses.get(entry[:-len('.json')]) in ('done', 'failed'))
+
+    def orphan(entry):
+        # pins of a job whose status has been removed
+        return (entry.endswith('.json') and
+                entry[:-len('.json')] not in statuses)
+
+    count += remove_old_files(JOBS_FOLDER, retention, finished)
+    count += remove_old_files(PINS_FOLDER, retention,
+                              lambda e: finished(e) or orphan(e))
+    for folder in (storage, ZLIB_FOLDER, RESULTS_FOLDER, JOBS_FOLDER,
+                   PINS_FOLDER):
+        count += remove_old_files(folder, retention,
+                                  lambda e: e.endswith('.tmp'))
+    if not app.config['KEEP_JOB_DIRS']:
+        count += remove_old_files(
+            tempfile.gettempdir(), retention,
+            lambda e: e.endswith(JOB_DIR_SUFFIX) and e not in running_dirs)
+    if count:
+        app.logger.info("storage maintenance: removed %d stale job files",
+                        count)
+
+
+def enforce_quota():
+    """
+    Evicts least recently used files until stored files fit in
+    STORAGE_QUOTA. Files which are pinned by a job, or have been accessed
+    recently are kept. Accesses are recorded by touch_blob.
+    """
+    quota = app.config['STORAGE_QUOTA']
+    storage = app.config['BINARY_STORAGE_FOLDER']
+    # sha256 -> [last access, size including compressed variant]
+    blobs = {}
+    total = 0
+    for entry in os.listdir(storage):
+        if len(entry) != 64 or not SHA256_RE.match(entry):
+            continue
+        try:
+            st = os.stat(os.path.join(storage, entry))
+        except OSError:
+            continue
+        blobs[entry] = [st.st_mtime, st.st_size]
+        total += st.st_size
+    for entry in os.listdir(ZLIB_FOLDER):
+        zname = os.path.join(ZLIB_FOLDER, entry)
+        if entry.endswith('.tmp'):
+            continue
+        if entry not in blobs:
+            # orphan compressed variant
             try:
-                os.link(logfname, fpath)
+                os.remove(zname)
             except OSError:
-                # file exists, ignore
                 pass
-            result['analyzer.log'] = fname
-    else:
-        result['analyzer.log'] = ""
-    outfname = os.path.join(dirname, 'out.ini')
-    if os.path.isfile(outfname):
-        with open(outfname, 'rb') as f:
-            fname = calc_sha256(f.read())
-            fpath = os.path.join(app.config['BINARY_STORAGE_FOLDER'],
-                                 fname)
+            continue
+        try:
+            size = os.stat(zname).st_size
+        except OSError:
+            continue
+        blobs[entry][1] += size
+        total += size
+    if not quota or total <= quota:
+        return
+    pinned = pinned_files()
+    min_age = time.time() - app.config['STORAGE_MIN_AGE']
+    candidates = sorted((mtime, size, sha256)
+                        for sha256, (mtime, size) in blobs.items()
+                        if sha256 not in pinned and mtime < min_age)
+    count = 0
+    freed = 0
+    for mtime, size, sha256 in candidates:
+        if total - freed <= quota:
+            break
+        for path in (os.path.join(storage, sha256),
+                     os.path.join(ZLIB_FOLDER, sha256)):
             try:
-                os.link(outfname, fpath)
+                os.remove(path)
             except OSError:
-                # file exists, ignore
                 pass
-            result['out.ini'] = fname
-    else:
-        result['out.ini'] = ""
+        count += 1
+        freed += size
+    app.logger.info("storage maintenance: evicted %d files (%d bytes), "
+                    "%d bytes used, quota is %d bytes", count, freed,
+                    total - freed, quota)
+    if total - freed > quota:
+        app.logger.warning("storage quota exceeded, remaining files are in "
+                           "use or have been accessed recently")
 
-    os.chdir(cwd)
-    # shutil.rmtree(dirname)
 
-    return flask.make_response(flask.jsonify(**result), 200)
+def storage_maintenance():
+    """
+    Runs maintenance tasks, unless they are already being run by another
+    server process
+    """
+    lockfname = os.path.join(app.config['BINARY_STORAGE_FOLDER'],
+                             'maintenance.lock')
+    with open(lockfname, 'a') as lockf:
+        try:
+            fcntl.flock(lockf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return
+        try:
+            cleanup_jobs()
+            enforce_quota()
+        finally:
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+
+
+def maintenance_loop():
+    while True:
+        try:
+            storage_maintenance()
+        except Exception:
+            app.logger.exception("storage maintenance failed")
+        time.sleep(app.config['MAINTENANCE_INTERVAL'])
+
+
+@app.before_first_request
+def start_maintenance():
+    # started in each server process, after server processes are forked.
+    # Job pool workers are forked before the maintenance thread is started.
+    get_job_pool()
+    thread = threading.Thread(target=maintenance_loop,
+                              name="storage maintenance")
+    thread.daemon = True
+    thread.start()
+
+
+@app.route("/analyze", methods=['POST'])
+def analyze():
+    """
+    Runs an analysis job, and waits for its result
+    """
+    init_ini, input_files, error = parse_init_ini()
+    if error is not None:
+        return error
+    job_id, async_result = submit_job(init_ini, input_files)
+    # the job pool never reports jobs whose worker process has died
+    while async_result is not None and not async_result.ready():
+        status = get_live_job_status(job_id) or {}
+        if status.get('status') not in ('queued', 'running'):
+            break
+        async_result.wait(PROGRESS_POLL_INTERVAL)
+    status = get_job_status(job_id) or {}
+    if status.get('status') != 'done':
+        return flask.make_response(
+            "Analysis failed: %s" % status.get('error', 'unknown error'), 500)
+    return flask.make_response(flask.jsonify(**status['result']), 200)
 
 
 @app.route("/convert_to_tnpk/<sha256>", methods=['POST'])
@@ -262,6 +1034,7 @@ def convert_to_tnpk(sha256):
             "Input file %s has not yet been uploaded." % sha256, 400)
     with open(fpath, 'rb') as f:
         headers_data = f.read()
+    touch_blob(sha256)
     try:
         npk_fname = idabincat.npkgen.NpkGen().generate_tnpk(
             imports_data=headers_data)
@@ -275,32 +1048,5 @@ def convert_to_tnpk(sha256):
     return flask.make_response(flask.jsonify(**result), 200)
 
 
-def run_bincat(dirname):
-    # do not use chroot: not compatible with grsec
-    cmdline = ("%s --nosound --caps.drop=all"
-               " --quiet"
-               " --private"  # new /root, /home
-               " --private-dev"  # new /dev, few devices
-               " --private-etc=ld.so.cache,ld.so.conf,ld.so.conf.d"  # new /etc
-               " --nogroups"  # no supplementary groups
-               " --noroot"  # new user namespace
-               " --nonewprivs"  # NO_NEW_PRIVS
-               " --seccomp"  # default seccomp blacklist
-               " --net=none"  # no network
-               " --whitelist=%s"  # only allow current analysis dir from /tmp
-               " -- ") % (firejail, dirname)
-    cmdline += "bincat init.ini out.ini analyzer.log"
-    err = 0
-    try:
-        out = subprocess.check_output(
-            cmdline.split(' '),
-            stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as exc:
-        err = exc.returncode
-        out = exc.output
-
-    return err, out
-
-
 if __name__ == "__main__":
     app.run()
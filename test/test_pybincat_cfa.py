@@ -0,0 +1,213 @@
+#!/usr/bin/env python2
+"""
+Tests pybincat.cfa result parsing helpers
+"""
+
+import pytest
+from pybincat import cfa
+
+OUT_INI = """
+[loader]
+architecture = x86
+
+[node = 0]
+address = G0x1000
+final = true
+reg [eax] = G0x12345678!0xFF
+t-reg [eax] = int32
+mem[G0x2000*4] = G0x41!0xFF
+mem[G0x2004, G0x2005] = G0x42, G0x43
+mem[G0x2010*2] = G0x0
+mem[S0x100*8] = S0x0!0x0F
+
+[node = 1]
+address = G0x1002
+tainted = t-0
+reg [eax] = G0x0
+
+[node = 2]
+address = G0x1002
+reg [eax] = G0x1
+
+[edges]
+e0 = 0 -> 1
+e1 = 1 -> 2
+"""
+
+
+@pytest.fixture
+def result(tmpdir):
+    outf = tmpdir.join('out.ini')
+    outf.write(OUT_INI)
+    return cfa.CFA.parse(str(outf))
+
+
+def test_mem_summary(result):
+    summary = result['0'].mem_summary()
+    assert sorted(summary.keys()) == ['g', 's']
+    assert summary['g'].ranges == [(0x2000, 0x2005), (0x2010, 0x2011)]
+    assert summary['g'].nbytes == 8
+    assert summary['g'].ntainted == 4
+    assert summary['s'].ranges == [(0x100, 0x107)]
+    assert summary['s'].ntainted == 8
+    # cached until the state is modified
+    assert result['0'].mem_summary() is summary
+
+
+def test_mem_ranges_gap(result):
+    state = result['0']
+    assert state.mem_ranges()['g'] == [(0x2000, 0x2005), (0x2010, 0x2011)]
+    assert state.mem_ranges(gap=0xff)['g'] == [(0x2000, 0x2011)]
+    assert result['1'].mem_ranges() == {}
+
+
+def test_mem_ranges_gap_boundary(tmpdir):
+    outf = tmpdir.join('out.ini')
+    outf.write("""
+[loader]
+architecture = x86
+
+[node = 0]
+address = G0x1000
+mem[G0x3000*2] = G0x0
+mem[G0x3100*1] = G0x0
+mem[G0x3200*1] = G0x0
+""")
+    state = cfa.CFA.parse(str(outf))['0']
+    # merged when separated by less than 0x100 bytes
+    assert state.mem_ranges(gap=0xfe)['g'] == [(0x3000, 0x3100),
+                                               (0x3200, 0x3200)]
+
+
+def test_mem_summary_overlap(tmpdir):
+    outf = tmpdir.join('out.ini')
+    outf.write("""
+[loader]
+architecture = x86
+
+[node = 0]
+address = G0x1000
+mem[G0x4000*4] = G0x41!0xFF
+mem[G0x4001*1] = G0x41!0xFF
+mem[G0x4002*4] = G0x0
+""")
+    summary = cfa.CFA.parse(str(outf))['0'].mem_summary()
+    assert summary['g'].ranges == [(0x4000, 0x4005)]
+    assert summary['g'].nbytes == 6
+    assert summary['g'].ntainted == 4
+
+
+def test_mem_summary_invalidation(result):
+    state = result['0']
+    state.mem_summary()
+    state[cfa.Value('g', 0x2006, 8)] = [cfa.Value('g', 0x44, 8, taint=0xFF)]
+    summary = state.mem_summary()
+    assert summary['g'].ranges == [(0x2000, 0x2006), (0x2010, 0x2011)]
+    assert summary['g'].ntainted == 5
+
+
+def test_parse_arch(result):
+    assert result.arch == "x86"
+    eax = [k for k in result['0'].regaddrs if k.region == 'reg'][0]
+    assert eax.value == 'eax'
+    assert eax.length == 32
+
+
+def test_parse_progress(tmpdir):
+    outf = tmpdir.join('out.ini')
+    outf.write(OUT_INI)
+    calls = []
+
+    def progress(done, total):
+        calls.append((done, total))
+    cfa.CFA.parse(str(outf), progress_cb=progress)
+    assert calls[0] == (0, 5)
+    assert calls[-1] == (5, 5)
+
+    with pytest.raises(cfa.PyBinCATParseCancelled):
+        cfa.CFA.parse(str(outf), progress_cb=lambda done, total: False)
+
+
+def test_addr_tainted(result):
+    assert result.addr_tainted == {0x1000: False, 0x1002: True}
+    rebuilt = cfa.CFA(result.states, result.edges, result.nodes)
+    assert rebuilt.addr_tainted == result.addr_tainted
+
+
+def test_snapshot(tmpdir):
+    outf = tmpdir.join('out.ini')
+    outf.write(OUT_INI)
+    logf = tmpdir.join('analyzer.log')
+    logf.write('x' * 0x10000 + 'last line\n')
+    result = cfa.CFA.parse(str(outf), logs=str(logf))
+    with open(str(tmpdir.join('snapshot')), 'wb') as f:
+        result.save_snapshot(f)
+    with open(str(tmpdir.join('snapshot')), 'rb') as f:
+        loaded = cfa.CFA.load_snapshot(f)
+
+    assert loaded.arch == "x86"
+    assert loaded.addr_tainted == result.addr_tainted
+    assert loaded.node_id_from_addr(0x1002) == ['1', '2']
+    assert loaded.next_states('0')[0].node_id == '1'
+    assert loaded['1'].tainted and loaded['1'].taintsrc == ['t-0']
+    assert loaded.logs == result.logs[-cfa.SNAPSHOT_LOG_TAIL:]
+    assert loaded.logs.endswith('last line\n')
+    for node_id in result.nodes:
+        # loaded already parsed
+        assert loaded[node_id]._regaddrs is not None
+        assert loaded[node_id].regaddrs == result[node_id].regaddrs
+        assert loaded[node_id].regtypes == result[node_id].regtypes
+    assert loaded['0'].regtypes.values() == [['int32']]
+    assert loaded['0'].mem_summary() == result['0'].mem_summary()
+
+
+def test_snapshot_cancelled(result, tmpdir):
+    with pytest.raises(cfa.PyBinCATParseCancelled):
+        result.save_snapshot(tmpdir.join('snapshot').open('wb'),
+                             progress_cb=lambda done, total: False)
+
+
+def test_snapshot_invalid(tmpdir):
+    snap = tmpdir.join('snapshot')
+    snap.write('BCSNAP')
+    with pytest.raises(cfa.PyBinCATException):
+        cfa.CFA.load_snapshot(snap.open('rb'))
+    snap.write('out.ini')
+    with pytest.raises(cfa.PyBinCATException):
+        cfa.CFA.load_snapshot(snap.open('rb'))
+
+
+def test_parent_node_ids(result):
+    assert result.parent_node_ids('2') == ['1']
+    assert result.parent_node_ids(1) == ['0']
+    assert result.parent_node_ids('0') == []
+
+
+def test_parse_while_prefetching(result, tmpdir):
+    other = cfa.CFA.parse(str(tmpdir.join('out.ini')))
+    assert result['0']._parse_lock is result['1']._parse_lock
+    assert result['0']._parse_lock is not other['0']._parse_lock
+    # a background parse holds the lock: do not wait for it
+    with result.parse_lock:
+        assert result['0'].regaddrs
+    result['1'].prefetch()
+    assert result['1']._regaddrs is not None
+
+
+def test_parsed_states_lru(result):
+    result.parsed_states.max_states = 1
+    assert result['0'].regaddrs
+    assert result['1'].regaddrs
+    assert len(result.parsed_states) == 2
+    # least recently used state is reset, and parsed again when needed
+    state = result['2']
+    assert len(result.parsed_states) == 1
+    assert result.nodes['0']._regaddrs is None
+    assert result.nodes['1']._regaddrs is not None
+    assert result['0'].regtypes
+    assert state.regaddrs
+    # modified states are never reset
+    state[cfa.Value('reg', 'ebx', 32)] = [cfa.Value('g', 1, 32)]
+    result['0']
+    result['1']
+    assert state._regaddrs is not None
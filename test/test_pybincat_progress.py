@@ -0,0 +1,26 @@
+#!/usr/bin/env python2
+"""
+Tests analysis progress records parsing
+"""
+
+from pybincat.tools.progress import parse_progress, LogTail
+
+
+def test_parse_progress():
+    rec = parse_progress(
+        "[PROGRESS] address=0x1000 processed=42 waiting=3\n")
+    assert rec == {'address': '0x1000', 'processed': 42, 'waiting': 3}
+    assert parse_progress("[INFO]  interpreter: processed=42") is None
+
+
+def test_log_tail(tmpdir):
+    logf = tmpdir.join('analyzer.log')
+    tail = LogTail(str(logf))
+    assert tail.lines() == []
+    logf.write("[INFO]  a\n[PROGRESS] address=0x10 processed=1 waiting=1\n"
+               "[PROGRESS] address=0x12 processed=2 wai")
+    assert tail.progress()['address'] == '0x10'
+    assert tail.progress() is None
+    logf.write("ting=0\n", mode='a')
+    assert tail.progress() == {'address': '0x12', 'processed': 2,
+                               'waiting': 0}
@@ -0,0 +1,50 @@
+#!/usr/bin/env python2
+"""
+Tests the sandboxed bincat command line used by webbincat
+"""
+
+import subprocess
+from webbincat import sandbox
+
+
+def test_run_bincat_argv(monkeypatch):
+    calls = []
+
+    def check_output(args, **kwargs):
+        calls.append((args, kwargs))
+        return "BinCAT\n"
+    monkeypatch.setattr(subprocess, "check_output", check_output)
+    err, out = sandbox.run_bincat("/usr/bin/firejail", "/tmp/job",
+                                  "/tmp/job/init.ini", "/tmp/job/out.ini",
+                                  "/tmp/job/analyzer.log")
+    assert (err, out) == (0, "BinCAT\n")
+    args, kwargs = calls[0]
+    assert "" not in args
+    assert args[0] == "/usr/bin/firejail"
+    assert "--whitelist=/tmp/job" in args
+    assert args[args.index("--")+1:] == [
+        "bincat", "/tmp/job/init.ini", "/tmp/job/out.ini",
+        "/tmp/job/analyzer.log"]
+    assert kwargs["cwd"] == "/tmp/job"
+
+
+def test_run_bincat_error(monkeypatch):
+    def check_output(args, **kwargs):
+        raise subprocess.CalledProcessError(2, args, output="failed")
+    monkeypatch.setattr(subprocess, "check_output", check_output)
+    assert sandbox.run_bincat("firejail", "/tmp/job", "i", "o", "l") == \
+        (2, "failed")
+
+
+def test_bincat_version(monkeypatch):
+    calls = []
+
+    def check_output(args, **kwargs):
+        calls.append(args)
+        raise subprocess.CalledProcessError(
+            1, args, output="BinCAT 1.2\nusage: bincat init out log\n")
+    monkeypatch.setattr(subprocess, "check_output", check_output)
+    assert sandbox.bincat_version("firejail", "/tmp/v") == "BinCAT 1.2"
+    # same sandbox as analyses
+    assert calls[0][0] == "firejail"
+    assert calls[0][calls[0].index("--")+1:] == ["bincat"]